@@ -1,3 +1,26 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import Conversation, Message
+
+
+class MessageInline(admin.TabularInline):
+    model = Message
+    fields = ("role", "content", "image_hash", "created_at")
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+
+@admin.register(Conversation)
+class ConversationAdmin(admin.ModelAdmin):
+    list_display = ("session_key", "created_at")
+    search_fields = ("session_key",)
+    inlines = [MessageInline]
+
+
+@admin.register(Message)
+class MessageAdmin(admin.ModelAdmin):
+    list_display = ("conversation", "role", "has_image", "created_at")
+    list_filter = ("role",)
+    search_fields = ("content", "conversation__session_key")
+    raw_id_fields = ("conversation",)
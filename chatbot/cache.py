@@ -0,0 +1,372 @@
+import hashlib
+import os
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+
+# Pointer to the active (blue/green) collection, rewritten by ingest_documents when it
+# switches collections. Its content doubles as the index version for cache invalidation.
+INDEX_VERSION_FILE = os.path.join(os.path.dirname(__file__), "chroma_db", "index_version")
+
+# How often (seconds) caches and the vector store re-read the index version marker
+VERSION_CHECK_INTERVAL = 5
+
+
+def read_index_version() -> str:
+    """Return the current index version, i.e. the active collection name ('' if never switched)"""
+    try:
+        with open(INDEX_VERSION_FILE, encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def write_index_version(version: str):
+    """Atomically point every worker at a new index version"""
+    os.makedirs(os.path.dirname(INDEX_VERSION_FILE), exist_ok=True)
+    tmp_path = f"{INDEX_VERSION_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, INDEX_VERSION_FILE)
+
+
+def normalize_query(query: str) -> str:
+    """Case- and whitespace-insensitive form of a query used for cache keys"""
+    return re.sub(r"\s+", " ", query or "").strip().lower()
+
+
+def make_cache_key(query: str, context: str = "", chat_history: Optional[List[Dict]] = None,
+                   image_data: Optional[Any] = None) -> str:
+    """
+    Build a response cache key from everything that shapes the answer.
+
+    The full normalized query, the retrieved context, the history messages that go into
+    the prompt and the image contents are hashed, so different queries never share a key.
+    """
+    digest = hashlib.sha256()
+    digest.update(normalize_query(query).encode("utf-8"))
+    digest.update(b"\x00")
+    digest.update(context.encode("utf-8"))
+    for msg in chat_history or []:
+        digest.update(b"\x00")
+        digest.update(f"{msg['role']}:{msg['content']}:{bool(msg.get('image'))}".encode("utf-8"))
+    if image_data:
+        digest.update(b"\x00image:")
+        # Preprocessed images are keyed by the hash of their re-encoded bytes, so re-uploads hit the cache
+        image_data = getattr(image_data, "content_hash", image_data)
+        digest.update(image_data.encode("utf-8") if isinstance(image_data, str) else image_data)
+    return digest.hexdigest()
+
+
+def _sizeof(value: Any) -> int:
+    """Approximate memory footprint of a cached value in bytes"""
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, (list, tuple)) and value and isinstance(value[0], float):
+        return 8 * len(value)
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def shared_cache(alias: Optional[str] = None):
+    """The cross-worker cache configured as CHATBOT_CACHE_ALIAS (or alias) in Django's CACHES"""
+    return caches[alias or getattr(settings, "CHATBOT_CACHE_ALIAS", "default")]
+
+
+def shared_get(key: str, default: Any = None, alias: Optional[str] = None) -> Any:
+    """Read from the shared cache; backend errors count as a miss"""
+    try:
+        return shared_cache(alias).get(key, default)
+    except Exception as e:
+        print(f"Shared cache read failed: {str(e)}")
+        return default
+
+
+def shared_set(key: str, value: Any, timeout: Optional[float] = None, alias: Optional[str] = None):
+    """Write to the shared cache; backend errors are logged and ignored"""
+    try:
+        shared_cache(alias).set(key, value, timeout)
+    except Exception as e:
+        print(f"Shared cache write failed: {str(e)}")
+
+
+async def ashared_get(key: str, default: Any = None, alias: Optional[str] = None) -> Any:
+    """Async version of shared_get (blocking backends run in a thread)"""
+    try:
+        return await shared_cache(alias).aget(key, default)
+    except Exception as e:
+        print(f"Shared cache read failed: {str(e)}")
+        return default
+
+
+async def ashared_set(key: str, value: Any, timeout: Optional[float] = None, alias: Optional[str] = None):
+    """Async version of shared_set"""
+    try:
+        await shared_cache(alias).aset(key, value, timeout)
+    except Exception as e:
+        print(f"Shared cache write failed: {str(e)}")
+
+
+def shared_delete(key: str, alias: Optional[str] = None):
+    """Delete from the shared cache; backend errors are logged and ignored"""
+    try:
+        shared_cache(alias).delete(key)
+    except Exception as e:
+        print(f"Shared cache delete failed: {str(e)}")
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache bounded by entry count, total size in bytes and a TTL.
+
+    Entries are dropped whenever the index version changes, so answers built from an
+    old document collection are not served after re-ingestion.
+    """
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 5 * 1024 * 1024, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._version = read_index_version()
+        self._version_checked = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.resets = 0
+
+    @property
+    def version(self) -> str:
+        """Index version the cached entries belong to"""
+        self._check_version()
+        return self._version
+
+    def get(self, key: str) -> Optional[Any]:
+        self._check_version()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] >= time.monotonic()
+
+    def set(self, key: str, value: Any):
+        size = len(key) + _sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, size, value)
+            self._bytes += size
+            # Evict least recently used entries until both bounds hold
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.resets += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "resets": self.resets,
+            }
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _check_version(self):
+        """Clear the cache if ingest_documents has rebuilt the collection since the last check"""
+        now = time.monotonic()
+        if now - self._version_checked < VERSION_CHECK_INTERVAL:
+            return
+        self._version_checked = now
+        version = read_index_version()
+        if version != self._version:
+            self._version = version
+            self.clear()
+
+
+class TieredCache:
+    """
+    In-process ResponseCache (L1) in front of the shared Django cache (L2).
+
+    L2 hits are copied into L1, and writes go to both, so one worker paying for an Azure
+    call benefits the others. With versioned=True the L2 keys include the index version,
+    which retires shared entries after re-ingestion the same way L1 is cleared. With
+    persistent=True L2 entries never expire (the L1 TTL still applies).
+    """
+
+    def __init__(self, local: ResponseCache, prefix: str, versioned: bool = False,
+                 alias: Optional[str] = None, persistent: bool = False):
+        self.local = local
+        self.prefix = prefix
+        self.versioned = versioned
+        self.alias = alias
+        self.shared_timeout = None if persistent else local.ttl
+        self.shared_hits = 0
+
+    def _shared_key(self, key: str) -> str:
+        if self.versioned:
+            return f"{self.prefix}:{self.local.version}:{key}"
+        return f"{self.prefix}:{key}"
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        value = shared_get(self._shared_key(key), alias=self.alias)
+        if value is not None:
+            self.shared_hits += 1
+            self.local.set(key, value)
+        return value
+
+    def set(self, key: str, value: Any):
+        self.local.set(key, value)
+        shared_set(self._shared_key(key), value, self.shared_timeout, alias=self.alias)
+
+    async def aget(self, key: str) -> Optional[Any]:
+        """Async version of get: an L1 miss reads the shared cache without blocking the event loop"""
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        value = await ashared_get(self._shared_key(key), alias=self.alias)
+        if value is not None:
+            self.shared_hits += 1
+            self.local.set(key, value)
+        return value
+
+    async def aset(self, key: str, value: Any):
+        self.local.set(key, value)
+        await ashared_set(self._shared_key(key), value, self.shared_timeout, alias=self.alias)
+
+    def clear(self):
+        """Clear the local tier (shared entries expire or are retired by version)"""
+        self.local.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.local.stats(), "shared_hits": self.shared_hits}
+
+
+class SemanticCache:
+    """
+    Near-duplicate answer cache keyed by query embeddings.
+
+    Each language has its own fixed-size matrix of normalized query vectors; a lookup is
+    one matrix-vector product and returns the stored answer of the closest prior query
+    when its cosine similarity reaches the threshold. When a language's matrix is full
+    the oldest row is overwritten. Cleared when the index version changes.
+    """
+
+    def __init__(self, threshold: float = 0.95, max_entries: int = 2000, ttl: float = 3600):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._indexes = {}  # language -> dict(vectors, answers, expires, count, cursor)
+        self._lock = threading.Lock()
+        self._version = read_index_version()
+        self._version_checked = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, vector: List[float], language: str, threshold: Optional[float] = None) -> Optional[str]:
+        """Answer of the most similar cached question, if at least threshold (default self.threshold) similar"""
+        self._check_version()
+        query = self._normalize(vector)
+        with self._lock:
+            index = self._indexes.get(language)
+            if index is None or index["count"] == 0 or index["vectors"].shape[1] != query.shape[0]:
+                self.misses += 1
+                return None
+            scores = index["vectors"][:index["count"]] @ query
+            best = int(np.argmax(scores))
+            if scores[best] < (threshold or self.threshold) or index["expires"][best] < time.monotonic():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return index["answers"][best]
+
+    def add(self, vector: List[float], language: str, answer: str):
+        query = self._normalize(vector)
+        with self._lock:
+            index = self._indexes.get(language)
+            if index is None or index["vectors"].shape[1] != query.shape[0]:
+                index = {
+                    "vectors": np.zeros((self.max_entries, query.shape[0]), dtype=np.float32),
+                    "answers": [None] * self.max_entries,
+                    "expires": np.zeros(self.max_entries),
+                    "count": 0,
+                    "cursor": 0,
+                }
+                self._indexes[language] = index
+            slot = index["cursor"]
+            index["vectors"][slot] = query
+            index["answers"][slot] = answer
+            index["expires"][slot] = time.monotonic() + self.ttl
+            index["cursor"] = (slot + 1) % self.max_entries
+            index["count"] = min(index["count"] + 1, self.max_entries)
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": sum(index["count"] for index in self._indexes.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm else array
+
+    def _check_version(self):
+        now = time.monotonic()
+        if now - self._version_checked < VERSION_CHECK_INTERVAL:
+            return
+        self._version_checked = now
+        version = read_index_version()
+        if version != self._version:
+            self._version = version
+            self.clear()
@@ -0,0 +1,123 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+# Writes between checks of the entry count against max_entries
+CULL_CHECK_INTERVAL = 50
+
+
+class SQLiteCache(BaseCache):
+    """
+    Django cache backend storing entries in a standalone SQLite file.
+
+    Every gunicorn worker on the host opens the same file (WAL mode allows concurrent
+    readers alongside a writer), so it works as a shared cache without Redis and without
+    the createcachetable step the database backend needs. LOCATION is the file path.
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self._path = location
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self._path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self._path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL)"
+            )
+            self._local.conn = conn
+        return conn
+
+    def _expiry(self, timeout):
+        # BaseCache returns an absolute expiry timestamp (None means never expire)
+        return self.get_backend_timeout(timeout)
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        row = self._connection().execute(
+            "SELECT value, expires FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return default
+        if row[1] is not None and row[1] < time.time():
+            self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+            return default
+        return pickle.loads(row[0])
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        self._write("INSERT OR REPLACE", key, value, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        conn = self._connection()
+        # Drop an expired entry first so it doesn't block the insert
+        conn.execute("DELETE FROM cache WHERE key = ? AND expires < ?", (key, time.time()))
+        return self._write("INSERT OR IGNORE", key, value, timeout) > 0
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self._connection().execute(
+            "UPDATE cache SET expires = ? WHERE key = ? AND (expires IS NULL OR expires >= ?)",
+            (self._expiry(timeout), key, time.time())
+        )
+        return cursor.rowcount > 0
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+        return cursor.rowcount > 0
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        row = self._connection().execute(
+            "SELECT 1 FROM cache WHERE key = ? AND (expires IS NULL OR expires >= ?)",
+            (key, time.time())
+        ).fetchone()
+        return row is not None
+
+    def clear(self):
+        self._connection().execute("DELETE FROM cache")
+
+    def close(self, **kwargs):
+        # Connections are per thread and reused across requests
+        pass
+
+    def _write(self, verb, key, value, timeout):
+        conn = self._connection()
+        cursor = conn.execute(
+            f"{verb} INTO cache (key, value, expires) VALUES (?, ?, ?)",
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), self._expiry(timeout))
+        )
+        self._cull(conn)
+        return cursor.rowcount
+
+    def _cull(self, conn):
+        """Keep the table under max_entries, dropping expired then oldest-expiring entries"""
+        self._local.writes = getattr(self._local, "writes", 0) + 1
+        if self._local.writes % CULL_CHECK_INTERVAL:
+            return
+        count = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count <= self._max_entries:
+            return
+        conn.execute("DELETE FROM cache WHERE expires < ?", (time.time(),))
+        count = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count > self._max_entries:
+            excess = max(count // self._cull_frequency, count - self._max_entries) if self._cull_frequency else count
+            conn.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY expires IS NULL, expires LIMIT ?)",
+                (excess,)
+            )
@@ -1,26 +1,123 @@
+import asyncio
 import os
+from concurrent.futures import Future
 import sys
 import warnings
-from langchain_openai import AzureOpenAIEmbeddings
-from langchain_chroma import Chroma
 from django.conf import settings
-from openai import AzureOpenAI
-from typing import List, Dict, Optional
-import threading
-from functools import lru_cache
+from django.db import close_old_connections
+from typing import AsyncIterator, Awaitable, Callable, List, Dict, Optional, Iterator, Tuple
+import hashlib
 import re
+import time
+
+if __name__ == "__main__":
+    # Run as python -m chatbot.chatbot_rag: Django must be set up before the modules
+    # below read their settings
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "goodwish_chatbot.settings")
+    import django
+    django.setup()
+
+from .cache import ResponseCache, SemanticCache, TieredCache, make_cache_key, normalize_query
+from .keyword_index import KeywordIndex, keyword_index_path, reciprocal_rank_fusion
+from .vector_snapshot import VectorSnapshot
+from .context_builder import build_context, trim_history, usage_counts
+from .tokens import CHAT_ENCODING, count_tokens
+from .image_processing import ImageProcessingError, ProcessedImage
+from .metrics import REGISTRY, observe_stage, record_cache, record_error, record_tokens, timed
+from .clients import ClientManager
+from .llm import CircuitBreaker, ResilientLLM
+from .single_flight import FlightAbandoned, SingleFlight
+from .stages import StageGraph
 
 # Suppress LangChain deprecation warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning, module="langchain")
 
-# Cache for embeddings and responses
-RESPONSE_CACHE = {}
-EMBEDDING_CACHE = {}
+# Cache for embeddings and responses (local L1 in front of the shared CACHES backend)
+RESPONSE_CACHE = TieredCache(ResponseCache(**getattr(settings, "CHATBOT_RESPONSE_CACHE", {})), "response", versioned=True)
+EMBEDDING_CACHE = TieredCache(
+    ResponseCache(max_entries=1000, max_bytes=16 * 1024 * 1024, ttl=86400),
+    "embedding", alias="embeddings", persistent=True
+)
+SEMANTIC_CACHE = SemanticCache(**getattr(settings, "CHATBOT_SEMANTIC_CACHE", {}))
+
+
+def _cache_stats() -> Dict[Tuple[str, str], int]:
+    """Local tier counters and sizes of the response and embedding caches, for the metrics endpoint"""
+    return {
+        (name, stat): value
+        for name, cache in (("response", RESPONSE_CACHE), ("embedding", EMBEDDING_CACHE))
+        for stat, value in cache.stats().items()
+    }
+
+
+REGISTRY.gauge("chatbot_cache_stats", "In-process cache entries, bytes, hits, misses, evictions, expirations, resets and shared-tier hits",
+               ["cache", "stat"], _cache_stats)
+
+# Concurrent cache misses for the same query embedding share one request
+EMBEDDING_FLIGHTS = SingleFlight()
+
+# BM25 index of the active collection (None if it has no persisted index)
+keyword_index = None
+keyword_index_collection = None
+
+# Memory-mapped embedding matrix of the active collection (CHATBOT_RETRIEVAL_ENGINE = "snapshot")
+vector_snapshot = None
+vector_snapshot_collection = None
+
+# Legacy collection, used until ingest_documents first switches to a versioned one
+DEFAULT_COLLECTION_NAME = "goodwish_chatbot"
+
+# Azure OpenAI, embedding and Chroma clients, shared by all requests
+CLIENTS = ClientManager(
+    os.path.join(os.path.dirname(__file__), "chroma_db"),
+    DEFAULT_COLLECTION_NAME,
+    getattr(settings, "CHATBOT_HTTP", {})
+)
 
-# Global clients
-client = None
-embeddings = None
-vectorstore = None
+# Number of context chunks retrieved per query
+RETRIEVAL_K = 3
+
+# Number of previous messages included in the prompt
+HISTORY_WINDOW = 3
+
+# Token budgets for the retrieved context and the chat history in the system prompt
+PROMPT_BUDGET = {"context_tokens": 1200, "history_tokens": 400, **getattr(settings, "CHATBOT_PROMPT_BUDGET", {})}
+
+# Completion token limit per response
+MAX_COMPLETION_TOKENS = 200
+
+# Completions with per-attempt timeouts, retries, optional hedging and a circuit breaker
+LLM_CONFIG = {**getattr(settings, "CHATBOT_LLM", {})}
+LLM = ResilientLLM(
+    CLIENTS.client,
+    CLIENTS.async_client,
+    LLM_CONFIG.pop("deployments", None) or [settings.AZURE_OPENAI_DEPLOYMENT_NAME],
+    breaker=CircuitBreaker(LLM_CONFIG.pop("failure_threshold", 5), LLM_CONFIG.pop("reset_timeout", 30)),
+    **LLM_CONFIG
+)
+
+# Concurrent cache misses for the same response key share one completion. Followers wait,
+# and the cross-worker lock lives, as long as the completion can take with its retries.
+RESPONSE_FLIGHTS = SingleFlight(**{
+    "timeout": LLM.deadline, "lock_timeout": LLM.deadline, **getattr(settings, "CHATBOT_SINGLE_FLIGHT", {})
+})
+
+# Minimum similarity of a semantic cache answer served while Azure OpenAI is failing
+DEGRADED_SIMILARITY = 0.85
+
+
+# Common Romanized Nepali words, used to tell Romanized Nepali queries from English ones
+ROMANIZED_NEPALI_WORDS = {
+    "ke", "cha", "chha", "ho", "hoina", "kasari", "kati", "kun", "kaha", "kina", "tapai",
+    "tapaiko", "timi", "mero", "hamro", "garna", "garne", "sakchu", "sakinchha", "bhanne",
+    "dinu", "malai", "kehi", "ramro", "namaste", "dhanyabad", "huncha", "hunchha", "parcha",
+}
+
+FALLBACK_RESPONSE = "Sorry, I couldn't process that. Try WishChat Enterprise at info@goodwish.com.np!"
+
+# Markdown characters stripped from model output ('#', '*' and parentheses)
+MARKDOWN_TRANSLATION = str.maketrans("", "", "#*()")
 
 
 def remove_brackets(text):
@@ -31,64 +128,494 @@ def remove_brackets(text):
     return result
 
 
+def clean_response(text):
+    """Remove markdown formatting and bracketed text from a model response"""
+    return remove_brackets(text.translate(MARKDOWN_TRANSLATION))
+
+
+class StreamCleaner:
+    """
+    Incremental version of clean_response for streamed tokens.
+
+    Markdown characters are dropped as they arrive. Text from an opening '[' is held
+    back until the matching ']' (dropped) or a newline (released, as remove_brackets
+    never matches across lines), so a bracket split across tokens is still removed.
+    """
+
+    def __init__(self):
+        self._pending = ""
+
+    def feed(self, text):
+        text = self._pending + text.translate(MARKDOWN_TRANSLATION)
+        self._pending = ""
+        output = []
+        position = 0
+        while position < len(text):
+            start = text.find('[', position)
+            if start == -1:
+                output.append(text[position:])
+                break
+            output.append(text[position:start])
+            end = text.find(']', start)
+            newline = text.find('\n', start)
+            if end == -1 and newline == -1:
+                # Bracket still open, wait for more tokens
+                self._pending = text[start:]
+                break
+            if end == -1 or (newline != -1 and newline < end):
+                # No match from this '[', keep it and continue scanning
+                output.append('[')
+                position = start + 1
+            else:
+                position = end + 1
+        return "".join(output)
+
+    def flush(self):
+        """Return any held back text once the stream is finished"""
+        text, self._pending = self._pending, ""
+        return text
+
+
 def initialize_clients():
-    """Initialize clients once to avoid repeated initialization"""
-    global client, embeddings, vectorstore
-    
-    if client is None:
-        client = AzureOpenAI(
-            azure_endpoint=settings.AZURE_OPENAI_ENDPOINT,
-            api_key=settings.AZURE_OPENAI_API_KEY,
-            api_version="2025-01-01-preview"
-        )
-    
-    if embeddings is None:
-        embeddings = AzureOpenAIEmbeddings(
-            azure_deployment=settings.AZURE_EMBEDDING_DEPLOYMENT,
-            openai_api_version=settings.AZURE_EMBEDDING_API_VERSION,
-            azure_endpoint=settings.AZURE_OPENAI_ENDPOINT,
-            api_key=settings.AZURE_OPENAI_API_KEY
-        )
-    
-    if vectorstore is None:
-        vectorstore = Chroma(
-            persist_directory=os.path.join(os.path.dirname(__file__), "chroma_db"),
-            embedding_function=embeddings,
-            collection_name="goodwish_chatbot"
-        )
-    
-    return client, embeddings, vectorstore
+    """The shared (client, embeddings, vectorstore), built on first use"""
+    return CLIENTS.get()
+
+
+def initialize_async_client():
+    """The async Azure OpenAI client used by the ASGI views"""
+    return CLIENTS.async_client()
+
+
+def warm_up():
+    """
+    Build the clients, open connections and load the retrieval indexes before the first
+    request. Called by the WSGI/ASGI entry points; failures are only logged, requests
+    then initialize lazily.
+    """
+    try:
+        CLIENTS.warm_up()
+        get_keyword_index()
+        get_vector_snapshot()
+    except Exception as e:
+        print(f"Warm-up failed: {str(e)}")
+
+
+def _embedding_cache_key(query):
+    """Embedding cache key: deployment name plus the normalized query (the query itself is embedded)"""
+    text = normalize_query(query)
+    return hashlib.sha256(f"{settings.AZURE_EMBEDDING_DEPLOYMENT}\x00{text}".encode("utf-8")).hexdigest()
+
 
-# LRU cache for embeddings
-@lru_cache(maxsize=100)
 def get_cached_embedding(query):
     """Cache embeddings for common queries"""
-    client, embeddings, _ = initialize_clients()
-    return embeddings.embed_query(query)
-
-# Background task for non-critical operations
-def background_task(fn):
-    """Run function in background thread"""
-    def wrapper(*args, **kwargs):
-        thread = threading.Thread(target=fn, args=args, kwargs=kwargs)
-        thread.daemon = True
-        thread.start()
-    return wrapper
-
-@background_task
-def log_token_usage(query, response):
-    """Log token usage in background"""
-    # Your token logging code here
-    pass
-
-def get_chatbot_response(query: str, image_data: Optional[str] = None, chat_history: List[Dict] = None) -> str:
+    key = _embedding_cache_key(query)
+    embedding = EMBEDDING_CACHE.get(key)
+    record_cache("embedding", embedding is not None)
+    if embedding is None:
+        def embed():
+            client, embeddings, _ = initialize_clients()
+            with timed("embed"):
+                embedding = embeddings.embed_query(query)
+            EMBEDDING_CACHE.set(key, embedding)
+            return embedding
+
+        # The semantic cache and retrieval stages embed the same text concurrently
+        embedding, _ = EMBEDDING_FLIGHTS.do(key, embed)
+    return embedding
+
+
+async def aget_cached_embedding(query):
+    """Async version of get_cached_embedding"""
+    key = _embedding_cache_key(query)
+    embedding = await EMBEDDING_CACHE.aget(key)
+    record_cache("embedding", embedding is not None)
+    if embedding is None:
+        async def embed():
+            with timed("embed"):
+                embedding = await CLIENTS.async_embeddings().aembed_query(query)
+            await EMBEDDING_CACHE.aset(key, embedding)
+            return embedding
+
+        embedding, _ = await EMBEDDING_FLIGHTS.ado(key, embed)
+    return embedding
+
+
+def log_token_usage(query, response, usage=None, prompt_estimate=0):
+    """Record prompt/completion token counts (estimated if the API sent no usage)"""
+    counts = usage_counts(usage)
+    if counts is None:
+        counts = {"prompt_tokens": prompt_estimate, "completion_tokens": count_tokens(response, CHAT_ENCODING)}
+    record_tokens(counts["prompt_tokens"], counts["completion_tokens"])
+
+def _search_query(query: str) -> str:
+    """Text used for retrieval (image-only requests get a generic description query)"""
+    return query if query else "Describe the provided image"
+
+
+def get_keyword_index() -> Optional[KeywordIndex]:
+    """BM25 index persisted by ingest_documents for the active collection"""
+    global keyword_index, keyword_index_collection
+    initialize_clients()
+    if keyword_index_collection != CLIENTS.collection:
+        try:
+            keyword_index = KeywordIndex.load(keyword_index_path(CLIENTS.collection))
+        except (OSError, ValueError, KeyError):
+            keyword_index = None
+        keyword_index_collection = CLIENTS.collection
+    return keyword_index
+
+
+def get_vector_snapshot() -> Optional[VectorSnapshot]:
+    """In-memory snapshot of the active collection, or None when Chroma should be queried"""
+    global vector_snapshot, vector_snapshot_collection
+    if getattr(settings, "CHATBOT_RETRIEVAL_ENGINE", "chroma") != "snapshot":
+        return None
+    initialize_clients()
+    if vector_snapshot_collection != CLIENTS.collection:
+        try:
+            vector_snapshot = VectorSnapshot.load(CLIENTS.collection)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Vector snapshot unavailable for {CLIENTS.collection}, using Chroma: {str(e)}")
+            vector_snapshot = None
+        vector_snapshot_collection = CLIENTS.collection
+    return vector_snapshot
+
+
+def _lexical_texts(search_query: str) -> Optional[List[str]]:
+    """
+    Answer exact-token queries (URLs, emails, domains present in the corpus) from the
+    keyword index alone, without embedding the query or touching Chroma.
+    """
+    index = get_keyword_index()
+    if index is None or not index.exact_matches(search_query):
+        return None
+    return [index.texts[position] for position, _ in index.search(search_query, RETRIEVAL_K)]
+
+
+def _fuse_results(search_query: str, vector_docs) -> List[str]:
+    """Reciprocal-rank fusion of the vector hits with BM25 hits from the keyword index"""
+    texts = {doc.id or doc.page_content: doc.page_content for doc in vector_docs}
+    rankings = [list(texts)]
+    index = get_keyword_index()
+    if index is not None:
+        keyword_hits = index.search(search_query, RETRIEVAL_K)
+        rankings.append([index.ids[position] for position, _ in keyword_hits])
+        texts.update({index.ids[position]: index.texts[position] for position, _ in keyword_hits})
+    return [texts[item_id] for item_id in reciprocal_rank_fusion(rankings)[:RETRIEVAL_K]]
+
+
+def _build_context(texts: List[str]) -> str:
+    """Deduplicated, token-budgeted context from chunk texts in relevance order"""
+    return build_context(texts, PROMPT_BUDGET["context_tokens"])
+
+
+def _retrieve_context(query: str) -> str:
+    """Retrieve context text for the query (keyword index and ChromaDB)"""
+    search_query = _search_query(query)
+    lexical = _lexical_texts(search_query)
+    if lexical is not None:
+        return _build_context(lexical)
+
+    # Initialize clients (uses globals to avoid repeated initialization)
+    client, embeddings, vectorstore = initialize_clients()
+
+    # Search by the cached query vector so repeated queries skip the embedding round trip
+    query_embedding = get_cached_embedding(search_query)
+    snapshot = get_vector_snapshot()
+    if snapshot is not None:
+        context_docs = snapshot.search(query_embedding, k=RETRIEVAL_K)
+    else:
+        context_docs = vectorstore.similarity_search_by_vector(query_embedding, k=RETRIEVAL_K)  # Reduced from 5 to 3
+    return _build_context(_fuse_results(search_query, context_docs))
+
+
+async def _aretrieve_context(query: str) -> str:
+    """Async version of _retrieve_context: embeds the query without blocking the event loop"""
+    search_query = _search_query(query)
+    lexical = _lexical_texts(search_query)
+    if lexical is not None:
+        return _build_context(lexical)
+
+    _, embeddings, vectorstore = initialize_clients()
+
+    query_embedding = await aget_cached_embedding(search_query)
+    snapshot = get_vector_snapshot()
+    if snapshot is not None:
+        # A dot product over the in-memory matrix, cheap enough to run on the loop
+        context_docs = snapshot.search(query_embedding, k=RETRIEVAL_K)
+    else:
+        # Chroma lookups are local disk/HNSW work, keep them off the event loop
+        context_docs = await asyncio.to_thread(vectorstore.similarity_search_by_vector, query_embedding, k=RETRIEVAL_K)
+    return _build_context(_fuse_results(search_query, context_docs))
+
+
+def detect_language(text: str) -> str:
+    """Return 'ne' for Nepali (Devanagari or Romanized) text and 'en' otherwise"""
+    if re.search(r'[\u0900-\u097F]', text):
+        return "ne"
+    words = re.findall(r"[a-z]+", text.lower())
+    if words and sum(word in ROMANIZED_NEPALI_WORDS for word in words) * 4 >= len(words):
+        return "ne"
+    return "en"
+
+
+def _semantic_cache_applies(query: str, image_data: Optional[ProcessedImage], chat_history: Optional[List[Dict]]) -> bool:
+    """
+    Only standalone text questions use the semantic cache: a follow-up such as
+    "tell me more" means something different in every conversation.
+    """
+    if not (getattr(settings, "CHATBOT_SEMANTIC_CACHE_ENABLED", True) and query and not image_data and not chat_history):
+        return False
+    # Exact-token queries are answered from the keyword index without an embedding
+    return _lexical_texts(query) is None
+
+
+def _semantic_lookup(query: str) -> Tuple[Tuple[List[float], str], Optional[str]]:
+    """Look up a paraphrase of the query; returns the (vector, language) entry key and any cached answer"""
+    entry = (get_cached_embedding(query), detect_language(query))
+    cached = SEMANTIC_CACHE.lookup(*entry)
+    record_cache("semantic", cached is not None)
+    return entry, cached
+
+
+async def _asemantic_lookup(query: str) -> Tuple[Tuple[List[float], str], Optional[str]]:
+    """Async version of _semantic_lookup"""
+    entry = (await aget_cached_embedding(query), detect_language(query))
+    cached = SEMANTIC_CACHE.lookup(*entry)
+    record_cache("semantic", cached is not None)
+    return entry, cached
+
+
+def load_history_window(session_key: str) -> List[Dict]:
+    """The session's last HISTORY_WINDOW messages from the conversation store"""
+    from .models import Message
+    return Message.objects.history_window(session_key, HISTORY_WINDOW)
+
+
+def _history_window(chat_history: Optional[List[Dict]]) -> List[Dict]:
+    """Messages from the chat history that are included in the prompt (within the history token budget)"""
+    return trim_history(chat_history[-HISTORY_WINDOW:], PROMPT_BUDGET["history_tokens"]) if chat_history else []
+
+
+def image_data_url(image_data) -> str:
+    """Data URL for a ProcessedImage, or for raw base64 JPEG data"""
+    if isinstance(image_data, ProcessedImage):
+        return image_data.data_url
+    return f"data:image/jpeg;base64,{image_data}"
+
+
+def _assemble_messages(query: str, image_data: Optional[ProcessedImage], chat_history: Optional[List[Dict]], context: str) -> List[Dict]:
+    """Build the system prompt and chat messages from the retrieved context"""
+    # Format chat history for prompt (limiting to just last 3 messages for efficiency)
+    formatted_history = ""
+    for msg in _history_window(chat_history):  # Reduced from 5 to 3
+        content = msg['content']
+        if msg.get('image'):
+            content += " [Image provided]"
+        formatted_history += f"{msg['role']}: {content}\n"
+
+    # Prepare system prompt with fewer constraints
+    system_prompt = f"""
+    ### Role
+    - You are an AI chatbot designed to assist users with helpful and informative responses. You can handle greetings, small talk, and specific queries.
+
+    ### Capabilities
+    1. Language: Respond in English if the query is in English. If the query is in Nepali or Romanized Nepali, respond in pure Nepali (never Romanized Nepali).
+    2. Knowledge: Use the provided context when relevant, but you can also draw on your general knowledge to provide helpful responses.
+    3. Word Limit: Keep responses between 30-50 words.
+    4. Greetings: Respond to greetings like "hello" or "नमस्ते" with a friendly reply.
+    5. If there links provided when fetched from RAG always show that link no matter what.
+    6. When talking about wishchat always provide the link cleverly asking user to navigate there. If link is not provided in response of RAG use this: https://wishchat.goodwish.com.np
+    7. Also give them the goodwish engineering socials when asked if not fetched from RAG.  - Facebook: https://www.facebook.com/Goodwish-Engineering-61571584179109/
+  - LinkedIn: https://www.linkedin.com/company/goodwish-engineering/posts/?feedView=all
+
+
+    Chat history:
+    {formatted_history}
+
+    Context:
+    {context}
+    """
+
+    # Prepare chat messages
+    messages = [
+        {
+            "role": "system",
+            "content": [
+                {"type": "text", "text": system_prompt}
+            ]
+        }
+    ]
+
+    # Add user message with text and/or image
+    user_content = []
+    if query:
+        user_content.append({"type": "text", "text": query})
+    if image_data:
+        user_content.append({
+            "type": "image_url",
+            "image_url": {"url": image_data_url(image_data)}
+        })
+
+    # Append user message (default to image description if no query)
+    messages.append({
+        "role": "user",
+        "content": user_content or [{"type": "text", "text": "Describe the provided image"}]
+    })
+    return messages
+
+
+def _load_history_stage(session_key: str, history_loader: Optional[Callable[[str], List[Dict]]]) -> List[Dict]:
+    try:
+        return (history_loader or load_history_window)(session_key)
+    finally:
+        close_old_connections()  # Stage threads are not request threads
+
+
+def _prepare(query: str, image_data, chat_history: Optional[List[Dict]], session_key: Optional[str],
+             history_loader: Optional[Callable[[str], List[Dict]]] = None
+             ) -> Tuple[Optional[List[Dict]], Optional[ProcessedImage], str, Optional[tuple], Optional[str]]:
+    """
+    Run the stages that precede the completion, overlapping the independent ones:
+
+        retrieve (embed + search) ──────────────────────────┐
+        history (store) ─┬─ semantic cache (standalone text) ┴─ context
+        image (preprocessing pool) ┘
+
+    When the history or the image is still pending, retrieval starts first on the stage
+    pool and runs speculatively while they load and the semantic cache is checked; its
+    result is unused when that cache answers. Otherwise nothing would run beside it, and
+    it runs in the request thread after the semantic cache missed.
+
+    Returns (chat history, image, context, semantic cache entry, cached answer or None).
+    """
+    graph = StageGraph("response")
+    try:
+        def retrieve():
+            with timed("retrieve"):
+                return _retrieve_context(query)
+
+        load_history = chat_history is None and session_key
+        retrieval = None
+        if load_history or isinstance(image_data, Future):
+            retrieval = graph.submit("retrieve", retrieve)
+        history = None
+        if load_history:
+            history = graph.submit("history", _load_history_stage, session_key, history_loader)
+        if isinstance(image_data, Future):
+            image_data = graph.join("image", image_data)
+        if history is not None:
+            chat_history = history.result()
+
+        semantic_entry = None
+        if _semantic_cache_applies(query, image_data, chat_history):
+            semantic_entry, cached = graph.run("semantic", _semantic_lookup, query)
+            if cached is not None:
+                return chat_history, image_data, "", semantic_entry, cached
+
+        context = retrieval.result() if retrieval is not None else graph.run("retrieve", retrieve)
+        return chat_history, image_data, context, semantic_entry, None
+    finally:
+        graph.close()
+
+
+async def _aprepare(query: str, image_data, chat_history: Optional[List[Dict]], session_key: Optional[str],
+                    history_loader: Optional[Callable[[str], Awaitable[List[Dict]]]] = None
+                    ) -> Tuple[Optional[List[Dict]], Optional[ProcessedImage], str, Optional[tuple], Optional[str]]:
+    """Async version of _prepare, with the stages as tasks on the event loop (history_loader is async)"""
+    graph = StageGraph("response")
+    try:
+        async def retrieve():
+            with timed("retrieve"):
+                return await _aretrieve_context(query)
+
+        load_history = chat_history is None and session_key
+        retrieval = None
+        if load_history or isinstance(image_data, Future):
+            retrieval = graph.create_task("retrieve", retrieve())
+        history = None
+        if load_history:
+            history = graph.create_task(
+                "history",
+                history_loader(session_key) if history_loader
+                else asyncio.to_thread(_load_history_stage, session_key, None)
+            )
+        if isinstance(image_data, Future):
+            image_data = await graph.create_task("image", asyncio.wrap_future(image_data))
+        if history is not None:
+            chat_history = await history
+
+        semantic_entry = None
+        if _semantic_cache_applies(query, image_data, chat_history):
+            semantic_entry, cached = await graph.create_task("semantic", _asemantic_lookup(query))
+            if cached is not None:
+                return chat_history, image_data, "", semantic_entry, cached
+
+        context = await (retrieval if retrieval is not None else graph.create_task("retrieve", retrieve()))
+        return chat_history, image_data, context, semantic_entry, None
+    finally:
+        graph.close()
+
+
+def _prompt_tokens(messages: List[Dict]) -> int:
+    """Local estimate of the prompt's text tokens (images are not counted)"""
+    return sum(
+        count_tokens(part["text"], CHAT_ENCODING)
+        for message in messages for part in message["content"] if part["type"] == "text"
+    )
+
+
+def _completion_kwargs(messages: List[Dict], stream: bool = False) -> Dict:
+    """Completion parameters shared by the sync and async clients"""
+    kwargs = dict(
+        model=settings.AZURE_OPENAI_DEPLOYMENT_NAME,
+        messages=messages,
+        max_tokens=MAX_COMPLETION_TOKENS,  # Reduced from 800 to 200
+        temperature=0.0,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0,
+        stop=None,
+        stream=stream
+    )
+    if stream:
+        # Final chunk carries the token usage of the whole stream
+        kwargs["stream_options"] = {"include_usage": True}
+    return kwargs
+
+
+def degraded_response(context: str, semantic_entry: Optional[tuple]) -> str:
+    """
+    Answer while the completion call is failing: a cached answer to a similar question,
+    else the start of the retrieved context, else FALLBACK_RESPONSE. Never cached.
+    """
+    if semantic_entry:
+        cached = SEMANTIC_CACHE.lookup(*semantic_entry, threshold=DEGRADED_SIMILARITY)
+        if cached is not None:
+            record_cache("degraded", True)
+            return cached
+    record_cache("degraded", False)
+    if context:
+        words = clean_response(context).split()
+        return "I can't answer in full right now, but here is what I found: " + " ".join(words[:40]) + (
+            "..." if len(words) > 40 else ""
+        )
+    return FALLBACK_RESPONSE
+
+
+def get_chatbot_response(query: str, image_data: Optional[ProcessedImage] = None, chat_history: List[Dict] = None,
+                         session_key: Optional[str] = None,
+                         history_loader: Optional[Callable[[str], List[Dict]]] = None) -> str:
     """
     Generate a chatbot response using RAG with Azure OpenAI and ChromaDB, supporting text and image inputs.
     
     Args:
         query: User's input text query (can be empty if image is provided).
-        image_data: Base64-encoded image string (optional).
+        image_data: ProcessedImage, a Future of one (preprocessing overlaps retrieval), or a base64-encoded
+            JPEG string (optional).
         chat_history: List of previous messages [{'role': 'user', 'content': str, 'image': str}, ...].
+        session_key: Load the history window from the conversation store when chat_history is not given.
+        history_loader: Loads the session's history instead of the conversation store (called with session_key).
     
     Returns:
         Response string from the chatbot.
@@ -97,134 +624,296 @@ def get_chatbot_response(query: str, image_data: Optional[str] = None, chat_hist
         # Check if valid input is provided
         if not query and not image_data:
             return "Please provide a text query or an image."
-            
-        # Generate cache key based on query, image presence, and recent history
-        history_suffix = ""
-        if chat_history:
-            # Use last 2 messages for cache key to keep it reasonably sized
-            history_suffix = "_" + "_".join([f"{msg['role']}:{msg['content'][:20]}" for msg in chat_history[-2:]])
-        
-        image_suffix = "_with_image" if image_data else ""
-        cache_key = f"{query[:50]}{image_suffix}{history_suffix}"
-        
+
+        # Paraphrases of earlier questions are answered from the semantic cache
+        chat_history, image_data, context, semantic_entry, cached = _prepare(
+            query, image_data, chat_history, session_key, history_loader
+        )
+        if cached is not None:
+            return cached
+
+        cache_key = make_cache_key(query, context, _history_window(chat_history), image_data)
+
         # Check cache first
-        if cache_key in RESPONSE_CACHE:
-            return RESPONSE_CACHE[cache_key]
+        cached = RESPONSE_CACHE.get(cache_key)
+        record_cache("response", cached is not None)
+        if cached is not None:
+            return cached
 
-        # Initialize clients (uses globals to avoid repeated initialization)
-        client, embeddings, vectorstore = initialize_clients()
+        def generate():
+            messages = _assemble_messages(query, image_data, chat_history, context)
+            try:
+                with timed("llm"):
+                    completion = LLM.complete(**_completion_kwargs(messages))
+            except Exception as e:
+                print(f"Completion unavailable: {str(e)}")
+                return degraded_response(context, semantic_entry)
 
-        # Create retriever with more efficient parameters
-        retriever = vectorstore.as_retriever(search_kwargs={"k": 3})  # Reduced from 5 to 3
-        
-        # Retrieve context documents for relevant query
-        search_query = query if query else "Describe the provided image"
-        context_docs = retriever.invoke(search_query)
-        context = "\n".join([doc.page_content for doc in context_docs])
-        
-        # Format chat history for prompt (limiting to just last 3 messages for efficiency)
-        formatted_history = ""
-        if chat_history:
-            for msg in chat_history[-3:]:  # Reduced from 5 to 3
-                content = msg['content']
-                if msg.get('image'):
-                    content += " [Image provided]"
-                formatted_history += f"{msg['role']}: {content}\n"
+            # Extract response and remove any markdown formatting that might appear
+            with timed("postprocess"):
+                response = clean_response(completion.choices[0].message.content)
+
+            # Cache the response
+            RESPONSE_CACHE.set(cache_key, response)
+            if semantic_entry:
+                SEMANTIC_CACHE.add(*semantic_entry, response)
+
+            # Log token usage in background
+            log_token_usage(query, response, completion.usage, _prompt_tokens(messages))
+            return response
+
+        # Identical requests already waiting on Azure share its answer
+        response, shared = RESPONSE_FLIGHTS.do(cache_key, generate, poll=lambda: RESPONSE_CACHE.get(cache_key))
+        record_cache("single_flight", shared)
+        return response
         
-        # Prepare system prompt with fewer constraints
-        system_prompt = f"""
-        ### Role
-        - You are an AI chatbot designed to assist users with helpful and informative responses. You can handle greetings, small talk, and specific queries.
-
-        ### Capabilities
-        1. Language: Respond in English if the query is in English. If the query is in Nepali or Romanized Nepali, respond in pure Nepali (never Romanized Nepali).
-        2. Knowledge: Use the provided context when relevant, but you can also draw on your general knowledge to provide helpful responses.
-        3. Word Limit: Keep responses between 30-50 words.
-        4. Greetings: Respond to greetings like "hello" or "नमस्ते" with a friendly reply.
-        5. If there links provided when fetched from RAG always show that link no matter what.
-        6. When talking about wishchat always provide the link cleverly asking user to navigate there. If link is not provided in response of RAG use this: https://wishchat.goodwish.com.np
-        7. Also give them the goodwish engineering socials when asked if not fetched from RAG.  - Facebook: https://www.facebook.com/Goodwish-Engineering-61571584179109/
-  - LinkedIn: https://www.linkedin.com/company/goodwish-engineering/posts/?feedView=all
+    except ImageProcessingError:
+        raise
+    except Exception as e:
+        print(f"Error generating response: {str(e)}")
+        record_error("response")
+        return FALLBACK_RESPONSE
 
 
-        Chat history:
-        {formatted_history}
+async def aget_chatbot_response(query: str, image_data: Optional[ProcessedImage] = None, chat_history: List[Dict] = None,
+                                session_key: Optional[str] = None,
+                                history_loader: Optional[Callable[[str], Awaitable[List[Dict]]]] = None) -> str:
+    """
+    Async version of get_chatbot_response for the ASGI views.
 
-        Context:
-        {context}
-        """
+    Uses AsyncAzureOpenAI and async query embeddings so the event loop is free while
+    waiting on Azure; shares the response cache with the sync path.
+    """
+    try:
+        if not query and not image_data:
+            return "Please provide a text query or an image."
 
-        # Prepare chat messages
-        messages = [
-            {
-                "role": "system",
-                "content": [
-                    {"type": "text", "text": system_prompt}
-                ]
-            }
-        ]
-        
-        # Add user message with text and/or image
-        user_content = []
-        if query:
-            user_content.append({"type": "text", "text": query})
-        if image_data:
-            user_content.append({
-                "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}
-            })
-        
-        # Append user message (default to image description if no query)
-        messages.append({
-            "role": "user",
-            "content": user_content or [{"type": "text", "text": "Describe the provided image"}]
-        })
-        
-        # Generate completion with optimized parameters
-        completion = client.chat.completions.create(
-            model=settings.AZURE_OPENAI_DEPLOYMENT_NAME,
-            messages=messages,
-            max_tokens=200,  # Reduced from 800 to 200
-            temperature=0.0,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-            stop=None,
-            stream=False
+        chat_history, image_data, context, semantic_entry, cached = await _aprepare(
+            query, image_data, chat_history, session_key, history_loader
         )
-        
-        # Extract response
-        response = completion.choices[0].message.content
-        
-        # Remove any markdown formatting that might appear
-        response = response.replace("###", "").replace("##", "").replace("#", "")
-        response = response.replace("***", "").replace("**", "").replace("*", "")
-        response = response.replace('(',"").replace(')',"")
-        
-        response = remove_brackets(response)
-        
-        # Cache the response
-        RESPONSE_CACHE[cache_key] = response
-        
-        # Log token usage in background
-        log_token_usage(query, response)
-        
+        if cached is not None:
+            return cached
+
+        cache_key = make_cache_key(query, context, _history_window(chat_history), image_data)
+        cached = await RESPONSE_CACHE.aget(cache_key)
+        record_cache("response", cached is not None)
+        if cached is not None:
+            return cached
+
+        async def generate():
+            messages = _assemble_messages(query, image_data, chat_history, context)
+            try:
+                with timed("llm"):
+                    completion = await LLM.acomplete(**_completion_kwargs(messages))
+            except Exception as e:
+                print(f"Completion unavailable: {str(e)}")
+                return degraded_response(context, semantic_entry)
+
+            with timed("postprocess"):
+                response = clean_response(completion.choices[0].message.content)
+            await RESPONSE_CACHE.aset(cache_key, response)
+            if semantic_entry:
+                SEMANTIC_CACHE.add(*semantic_entry, response)
+            log_token_usage(query, response, completion.usage, _prompt_tokens(messages))
+            return response
+
+        response, shared = await RESPONSE_FLIGHTS.ado(cache_key, generate, poll=lambda: RESPONSE_CACHE.get(cache_key))
+        record_cache("single_flight", shared)
         return response
-        
+
+    except ImageProcessingError:
+        raise
     except Exception as e:
         print(f"Error generating response: {str(e)}")
-        return "Sorry, I couldn't process that. Try WishChat Enterprise at info@goodwish.com.np!"
+        record_error("response")
+        return FALLBACK_RESPONSE
 
-if __name__ == "__main__":
-    # Add project directory to sys.path
-    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    sys.path.append(project_dir)
-    
-    # Set Django settings module
-    os.environ["DJANGO_SETTINGS_MODULE"] = "goodwish_chatbot.settings"
-    import django
-    django.setup()
 
+def stream_chatbot_response(query: str, image_data: Optional[ProcessedImage] = None, chat_history: List[Dict] = None,
+                            session_key: Optional[str] = None,
+                            history_loader: Optional[Callable[[str], List[Dict]]] = None) -> Iterator[str]:
+    """
+    Streaming variant of get_chatbot_response.
+
+    Yields cleaned text fragments as the completion is generated. Cached responses are
+    yielded in a single fragment, and the full response is cached once the stream ends.
+    """
+    if not query and not image_data:
+        yield "Please provide a text query or an image."
+        return
+
+    cleaner = StreamCleaner()
+    fragments = []
+    usage = None
+    flight = None
+    context, semantic_entry = "", None
+    try:
+        chat_history, image_data, context, semantic_entry, cached = _prepare(
+            query, image_data, chat_history, session_key, history_loader
+        )
+        if cached is not None:
+            yield cached
+            return
+
+        cache_key = make_cache_key(query, context, _history_window(chat_history), image_data)
+        cached = RESPONSE_CACHE.get(cache_key)
+        record_cache("response", cached is not None)
+        if cached is not None:
+            yield cached
+            return
+
+        # Followers of an in-flight identical request get its full answer in one fragment;
+        # if its leader goes away, one of them leads instead
+        while True:
+            pending, leader = RESPONSE_FLIGHTS.join(cache_key)
+            record_cache("single_flight", not leader)
+            if leader:
+                break
+            try:
+                shared = pending.result(timeout=RESPONSE_FLIGHTS.timeout)
+            except FlightAbandoned:
+                continue
+            yield shared
+            return
+        flight = pending
+
+        messages = _assemble_messages(query, image_data, chat_history, context)
+        started = time.perf_counter()
+        first_token = True
+        for chunk in LLM.stream(**_completion_kwargs(messages, stream=True)):
+            usage = getattr(chunk, "usage", None) or usage
+            # Azure sends an initial chunk with prompt filter results and no choices
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if first_token:
+                observe_stage("llm_first_token", time.perf_counter() - started)
+                first_token = False
+            text = cleaner.feed(chunk.choices[0].delta.content)
+            if text:
+                fragments.append(text)
+                yield text
+        text = cleaner.flush()
+        if text:
+            fragments.append(text)
+            yield text
+        observe_stage("llm", time.perf_counter() - started)
+
+        response = "".join(fragments)
+        RESPONSE_CACHE.set(cache_key, response)
+        RESPONSE_FLIGHTS.finish(cache_key, flight, response)
+    except Exception as e:
+        print(f"Error streaming response: {str(e)}")
+        record_error("stream")
+        # Followers get the same degraded answer as the leader (not the generic fallback)
+        degraded = degraded_response(context, semantic_entry)
+        if flight is not None:
+            RESPONSE_FLIGHTS.finish(cache_key, flight, degraded)
+        if not fragments:
+            yield degraded
+        return
+    finally:
+        if flight is not None and not flight.done():
+            # The client went away mid-stream; a follower takes over
+            RESPONSE_FLIGHTS.abandon(cache_key, flight)
+
+    if semantic_entry:
+        SEMANTIC_CACHE.add(*semantic_entry, response)
+    log_token_usage(query, response, usage, _prompt_tokens(messages))
+
+
+async def astream_chatbot_response(query: str, image_data: Optional[ProcessedImage] = None,
+                                   chat_history: List[Dict] = None, session_key: Optional[str] = None,
+                                   history_loader: Optional[Callable[[str], Awaitable[List[Dict]]]] = None
+                                   ) -> AsyncIterator[str]:
+    """
+    Async version of stream_chatbot_response for the ASGI views.
+
+    Chunks come from the async LLM stream, so fragments are sent as they are generated
+    without holding a thread per open stream.
+    """
+    if not query and not image_data:
+        yield "Please provide a text query or an image."
+        return
+
+    cleaner = StreamCleaner()
+    fragments = []
+    usage = None
+    flight = None
+    context, semantic_entry = "", None
+    try:
+        chat_history, image_data, context, semantic_entry, cached = await _aprepare(
+            query, image_data, chat_history, session_key, history_loader
+        )
+        if cached is not None:
+            yield cached
+            return
+
+        cache_key = make_cache_key(query, context, _history_window(chat_history), image_data)
+        cached = await RESPONSE_CACHE.aget(cache_key)
+        record_cache("response", cached is not None)
+        if cached is not None:
+            yield cached
+            return
+
+        while True:
+            pending, leader = RESPONSE_FLIGHTS.join(cache_key)
+            record_cache("single_flight", not leader)
+            if leader:
+                break
+            try:
+                shared = await asyncio.wait_for(
+                    asyncio.shield(asyncio.wrap_future(pending)), RESPONSE_FLIGHTS.timeout
+                )
+            except FlightAbandoned:
+                continue
+            yield shared
+            return
+        flight = pending
+
+        messages = _assemble_messages(query, image_data, chat_history, context)
+        started = time.perf_counter()
+        first_token = True
+        async for chunk in LLM.astream(**_completion_kwargs(messages, stream=True)):
+            usage = getattr(chunk, "usage", None) or usage
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if first_token:
+                observe_stage("llm_first_token", time.perf_counter() - started)
+                first_token = False
+            text = cleaner.feed(chunk.choices[0].delta.content)
+            if text:
+                fragments.append(text)
+                yield text
+        text = cleaner.flush()
+        if text:
+            fragments.append(text)
+            yield text
+        observe_stage("llm", time.perf_counter() - started)
+
+        response = "".join(fragments)
+        await RESPONSE_CACHE.aset(cache_key, response)
+        RESPONSE_FLIGHTS.finish(cache_key, flight, response)
+    except Exception as e:
+        print(f"Error streaming response: {str(e)}")
+        record_error("stream")
+        # Followers get the same degraded answer as the leader (not the generic fallback)
+        degraded = degraded_response(context, semantic_entry)
+        if flight is not None:
+            RESPONSE_FLIGHTS.finish(cache_key, flight, degraded)
+        if not fragments:
+            yield degraded
+        return
+    finally:
+        if flight is not None and not flight.done():
+            # The client disconnected (the generator was cancelled or closed); a follower takes over
+            RESPONSE_FLIGHTS.abandon(cache_key, flight)
+
+    if semantic_entry:
+        SEMANTIC_CACHE.add(*semantic_entry, response)
+    log_token_usage(query, response, usage, _prompt_tokens(messages))
+
+
+if __name__ == "__main__":
     # Initialize clients on startup
     initialize_clients()
 
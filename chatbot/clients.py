@@ -0,0 +1,212 @@
+import asyncio
+import threading
+import time
+import weakref
+from typing import Dict, Optional, Tuple
+
+import httpx
+from django.conf import settings
+from langchain_chroma import Chroma
+from langchain_openai import AzureOpenAIEmbeddings
+from openai import AsyncAzureOpenAI, AzureOpenAI
+
+from .cache import VERSION_CHECK_INTERVAL, read_index_version
+from .llm import LLM_LOOP
+
+AZURE_API_VERSION = "2025-01-01-preview"
+
+# Connection pool and timeouts of the HTTP clients shared by the Azure OpenAI clients
+HTTP_CONFIG = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 60,  # Seconds an idle connection is kept open
+    "connect_timeout": 5,
+    "read_timeout": 60,
+    "http2": True,  # Needs the h2 package, otherwise HTTP/1.1 is used
+}
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class ClientManager:
+    """
+    Process-wide Azure OpenAI, embedding and Chroma clients.
+
+    Clients are built once, under a lock, so concurrent first requests don't race to
+    create duplicates. The sync clients share one explicitly configured httpx connection
+    pool. An httpx.AsyncClient is bound to the event loop that uses it, so the async
+    pool, and the async chat and embedding clients using it, are kept per loop (one
+    per worker under ASGI). warm_up() builds the clients and opens the connections
+    ahead of the first request.
+    """
+
+    def __init__(self, persist_directory: str, default_collection: str, config: Optional[Dict] = None):
+        self.persist_directory = persist_directory
+        self.default_collection = default_collection
+        self.config = {**HTTP_CONFIG, **(config or {})}
+        self._lock = threading.RLock()
+        self._http_client = None
+        self._client = None
+        self._async_clients = weakref.WeakKeyDictionary()  # event loop -> AsyncAzureOpenAI
+        self._async_http_clients = weakref.WeakKeyDictionary()  # event loop -> httpx.AsyncClient
+        self._async_embeddings = weakref.WeakKeyDictionary()  # event loop -> AzureOpenAIEmbeddings
+        self._embeddings = None
+        self._vectorstore = None
+        # Collection the vectorstore was opened on, and when the active pointer was last checked
+        self.collection = None
+        self._collection_checked = 0.0
+
+    def _http_options(self) -> Dict:
+        return dict(
+            http2=self.config["http2"] and _http2_available(),
+            limits=httpx.Limits(
+                max_connections=self.config["max_connections"],
+                max_keepalive_connections=self.config["max_keepalive_connections"],
+                keepalive_expiry=self.config["keepalive_expiry"],
+            ),
+            timeout=self.timeout,
+        )
+
+    @property
+    def timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(self.config["read_timeout"], connect=self.config["connect_timeout"])
+
+    def http_client(self) -> httpx.Client:
+        if self._http_client is None:
+            with self._lock:
+                if self._http_client is None:
+                    self._http_client = httpx.Client(**self._http_options())
+        return self._http_client
+
+    def client(self) -> AzureOpenAI:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = AzureOpenAI(
+                        azure_endpoint=settings.AZURE_OPENAI_ENDPOINT,
+                        api_key=settings.AZURE_OPENAI_API_KEY,
+                        api_version=AZURE_API_VERSION,
+                        timeout=self.timeout,
+                        http_client=self.http_client()
+                    )
+        return self._client
+
+    def async_http_client(self) -> httpx.AsyncClient:
+        """Connection pool of the running event loop (called from async code)"""
+        loop = asyncio.get_running_loop()
+        http_client = self._async_http_clients.get(loop)
+        if http_client is None:
+            with self._lock:
+                http_client = self._async_http_clients.get(loop)
+                if http_client is None:
+                    http_client = self._async_http_clients[loop] = httpx.AsyncClient(**self._http_options())
+        return http_client
+
+    def async_client(self) -> AsyncAzureOpenAI:
+        """Async client of the running event loop (called from async code)"""
+        loop = asyncio.get_running_loop()
+        async_client = self._async_clients.get(loop)
+        if async_client is None:
+            with self._lock:
+                async_client = self._async_clients.get(loop)
+                if async_client is None:
+                    async_client = self._async_clients[loop] = AsyncAzureOpenAI(
+                        azure_endpoint=settings.AZURE_OPENAI_ENDPOINT,
+                        api_key=settings.AZURE_OPENAI_API_KEY,
+                        api_version=AZURE_API_VERSION,
+                        timeout=self.timeout,
+                        http_client=self.async_http_client()
+                    )
+        return async_client
+
+    def embeddings(self) -> AzureOpenAIEmbeddings:
+        if self._embeddings is None:
+            with self._lock:
+                if self._embeddings is None:
+                    self._embeddings = AzureOpenAIEmbeddings(
+                        azure_deployment=settings.AZURE_EMBEDDING_DEPLOYMENT,
+                        openai_api_version=settings.AZURE_EMBEDDING_API_VERSION,
+                        azure_endpoint=settings.AZURE_OPENAI_ENDPOINT,
+                        api_key=settings.AZURE_OPENAI_API_KEY,
+                        http_client=self.http_client()
+                    )
+        return self._embeddings
+
+    def async_embeddings(self) -> AzureOpenAIEmbeddings:
+        """Embeddings whose aembed_* calls use the running event loop's connection pool"""
+        loop = asyncio.get_running_loop()
+        embeddings = self._async_embeddings.get(loop)
+        if embeddings is None:
+            with self._lock:
+                embeddings = self._async_embeddings.get(loop)
+                if embeddings is None:
+                    embeddings = self._async_embeddings[loop] = AzureOpenAIEmbeddings(
+                        azure_deployment=settings.AZURE_EMBEDDING_DEPLOYMENT,
+                        openai_api_version=settings.AZURE_EMBEDDING_API_VERSION,
+                        azure_endpoint=settings.AZURE_OPENAI_ENDPOINT,
+                        api_key=settings.AZURE_OPENAI_API_KEY,
+                        http_client=self.http_client(),
+                        http_async_client=self.async_http_client()
+                    )
+        return embeddings
+
+    def vectorstore(self) -> Chroma:
+        """Chroma on the active collection, following the blue/green pointer so re-ingestion is picked up"""
+        if self._vectorstore is not None and time.monotonic() - self._collection_checked < VERSION_CHECK_INTERVAL:
+            return self._vectorstore
+        with self._lock:
+            now = time.monotonic()
+            if self._vectorstore is None or now - self._collection_checked >= VERSION_CHECK_INTERVAL:
+                collection_name = read_index_version() or self.default_collection
+                if self._vectorstore is None or collection_name != self.collection:
+                    self._vectorstore = Chroma(
+                        persist_directory=self.persist_directory,
+                        embedding_function=self.embeddings(),
+                        collection_name=collection_name
+                    )
+                    self.collection = collection_name
+                self._collection_checked = now
+            return self._vectorstore
+
+    def get(self) -> Tuple[AzureOpenAI, AzureOpenAIEmbeddings, Chroma]:
+        return self.client(), self.embeddings(), self.vectorstore()
+
+    def warm_up(self):
+        """
+        Build the clients, open a pooled connection to Azure OpenAI and load the Chroma
+        collection's index, so the first request doesn't pay for them. Failures are
+        logged, requests then initialize lazily as before.
+        """
+        start = time.perf_counter()
+        steps = [
+            ("clients", lambda: self.get()),
+            # Any response will do: the TLS connection stays in the keep-alive pool. The sync
+            # pool serves embeddings and streams; completions are made on LLM_LOOP's async pool.
+            ("connection", lambda: self.http_client().head(settings.AZURE_OPENAI_ENDPOINT)),
+            ("completion connection", lambda: LLM_LOOP.run(self._aconnect())),
+            ("vector index", self._load_index),
+        ]
+        for name, step in steps:
+            try:
+                step()
+            except Exception as e:
+                print(f"Warm-up of {name} failed: {str(e)}")
+        print(f"Clients warmed up in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    def _load_index(self):
+        """Query the collection with one of its own vectors, which loads its HNSW index into memory"""
+        collection = self.vectorstore()._collection
+        sample = collection.peek(1)
+        if len(sample["embeddings"]):
+            collection.query(query_embeddings=[sample["embeddings"][0]], n_results=1)
+
+    async def _aconnect(self):
+        """Build the running loop's async client and open a connection in its pool"""
+        self.async_client()
+        await self.async_http_client().head(settings.AZURE_OPENAI_ENDPOINT)
@@ -0,0 +1,88 @@
+from typing import Dict, List, Optional, Sequence
+
+from .tokens import CHAT_ENCODING, count_tokens, truncate_tokens
+
+# Shortest shared prefix/suffix treated as splitter overlap rather than coincidence
+MIN_OVERLAP_CHARS = 10
+
+# A truncated chunk shorter than this is dropped instead of included
+MIN_CHUNK_TOKENS = 32
+
+
+def _overlap(first: str, second: str) -> int:
+    """Length of the longest suffix of first that is also a prefix of second"""
+    for size in range(min(len(first), len(second)), MIN_OVERLAP_CHARS - 1, -1):
+        if first.endswith(second[:size]):
+            return size
+    return 0
+
+
+def dedupe_chunks(chunks: Sequence[str]) -> List[str]:
+    """
+    Remove repeated text from chunks given in relevance order.
+
+    Adjacent chunks from the text splitter share up to chunk_overlap characters; the
+    shared span is kept in the more relevant chunk and cut from the other one. Chunks
+    wholly contained in a more relevant chunk are dropped.
+    """
+    kept = []
+    for chunk in chunks:
+        chunk = chunk.strip()
+        if not chunk or any(chunk in previous for previous in kept):
+            continue
+        for previous in kept:
+            # previous ... | overlap | ... chunk  -> drop the overlap from the start of chunk
+            chunk = chunk[_overlap(previous, chunk):].lstrip()
+            # chunk ... | overlap | ... previous  -> drop it from the end of chunk
+            size = _overlap(chunk, previous)
+            if size:
+                chunk = chunk[:-size].rstrip()
+        if chunk:
+            kept.append(chunk)
+    return kept
+
+
+def build_context(chunks: Sequence[str], max_tokens: int, encoding_name: str = CHAT_ENCODING) -> str:
+    """
+    Join retrieved chunks (most relevant first) into the prompt context.
+
+    Overlapping text is removed, then chunks are added in order until max_tokens is
+    reached; the chunk that crosses the budget is truncated, or dropped if too little
+    of it would fit.
+    """
+    parts = []
+    remaining = max_tokens
+    for chunk in dedupe_chunks(chunks):
+        tokens = count_tokens(chunk, encoding_name) + 1  # joining newline
+        if tokens <= remaining:
+            parts.append(chunk)
+            remaining -= tokens
+            continue
+        if remaining >= MIN_CHUNK_TOKENS:
+            parts.append(truncate_tokens(chunk, remaining - 1, encoding_name))
+        break
+    return "\n".join(parts)
+
+
+def trim_history(messages: List[Dict], max_tokens: int, encoding_name: str = CHAT_ENCODING) -> List[Dict]:
+    """Most recent messages whose content fits in max_tokens (oldest dropped first)"""
+    kept = []
+    remaining = max_tokens
+    for message in reversed(messages):
+        tokens = count_tokens(message.get("content") or "", encoding_name)
+        if tokens > remaining:
+            break
+        kept.append(message)
+        remaining -= tokens
+    return kept[::-1]
+
+
+def usage_counts(usage: Optional[object]) -> Optional[Dict[str, int]]:
+    """prompt/completion/total token counts from an OpenAI usage object"""
+    if usage is None:
+        return None
+    return {
+        "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+        "total_tokens": getattr(usage, "total_tokens", 0) or 0,
+    }
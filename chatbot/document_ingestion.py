@@ -1,80 +1,297 @@
+import hashlib
+import json
 import os
+import time
 import chromadb
-from langchain_community.document_loaders import TextLoader
 from langchain_openai import AzureOpenAIEmbeddings
-from langchain_chroma import Chroma  # Updated import path
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from django.conf import settings
+from .cache import read_index_version, write_index_version
+from .document_loaders import parse_documents, supported_extensions
+from .embedding_pipeline import EmbeddingPipeline
+from .keyword_index import KeywordIndex, keyword_index_path
+from .vector_snapshot import VectorSnapshot, vector_snapshot_paths
 
-def ingest_documents():
-    # Define document paths
-    document_dir = os.path.join(os.path.dirname(__file__), "docs")
-    document_files = [
-        "Goodwish_Engineering_Company_Information.txt",
-        "WishChat_Product_Information.txt"
-    ]
+DOCUMENT_DIR = os.path.join(os.path.dirname(__file__), "docs")
+PERSIST_DIRECTORY = os.path.join(os.path.dirname(__file__), "chroma_db")
+# Legacy collection name, also the prefix of the versioned (blue/green) collections
+COLLECTION_NAME = "goodwish_chatbot"
 
-    # Load documents
-    documents = []
-    for file_name in document_files:
-        file_path = os.path.join(document_dir, file_name)
-        if os.path.exists(file_path):
-            loader = TextLoader(file_path, encoding='utf-8')
-            documents.extend(loader.load())
-        else:
-            print(f"Warning: {file_path} not found")
+# Superseded collection versions kept for requests still reading them
+KEEP_PREVIOUS_VERSIONS = 1
+
+# Records the hash and chunk ids of every ingested file
+MANIFEST_PATH = os.path.join(PERSIST_DIRECTORY, "ingest_manifest.json")
+
+# Vectors embedded by an interrupted run, reused on the next one
+CHECKPOINT_PATH = os.path.join(PERSIST_DIRECTORY, "ingest_checkpoint.jsonl")
+
+# Largest number of records handed to a single Chroma get()/add()
+CHROMA_ADD_BATCH_SIZE = 1000
+
+
+class IngestionError(Exception):
+    """Raised when a newly built collection fails validation"""
+    pass
+
+
+def discover_documents():
+    """Return the names of all supported files in the docs directory"""
+    return sorted(
+        name for name in os.listdir(DOCUMENT_DIR)
+        if not name.startswith(".")
+        and name.lower().endswith(supported_extensions())
+        and os.path.isfile(os.path.join(DOCUMENT_DIR, name))
+    )
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
-    if not documents:
-        print("Error: No documents were loaded. Check file paths.")
-        return
 
-    # Split documents into chunks
+def chunk_id(source, text):
+    """Content-derived chunk id, stable across runs as long as the chunk text is unchanged"""
+    return hashlib.sha256(f"{source}\x00{text}".encode("utf-8")).hexdigest()[:32]
+
+
+def active_collection_name():
+    """Collection the web workers currently read from"""
+    return read_index_version() or COLLECTION_NAME
+
+
+def versioned_collection_name():
+    return f"{COLLECTION_NAME}_v{time.time_ns():x}"
+
+
+def load_manifest(collection_name):
+    try:
+        with open(MANIFEST_PATH, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {"files": {}}
+    if manifest.get("collection") != collection_name:
+        return {"files": {}}
+    return manifest
+
+
+def save_manifest(manifest):
+    tmp_path = f"{MANIFEST_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def split_documents(file_names):
+    """
+    Parse files in parallel and chunk each as soon as it is parsed.
+
+    Yields (file_name, {chunk_id: (text, metadata)}) per file.
+    """
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=1000,
         chunk_overlap=200,
         length_function=len,
     )
-    chunks = text_splitter.split_documents(documents)
+    paths = [os.path.join(DOCUMENT_DIR, file_name) for file_name in file_names]
+    for path, documents in parse_documents(paths, getattr(settings, "CHATBOT_INGEST_PARSE_WORKERS", None)):
+        file_name = os.path.basename(path)
+        chunks = {}
+        for chunk in text_splitter.split_documents(documents):
+            chunk_hash = chunk_id(file_name, chunk.page_content)
+            chunks[chunk_hash] = (chunk.page_content, {**chunk.metadata, "source": file_name, "chunk_hash": chunk_hash})
+        yield file_name, chunks
+
+
+def _copy_chunks(source, target, ids):
+    """Copy already embedded chunks between collections without re-embedding them"""
+    for start in range(0, len(ids), CHROMA_ADD_BATCH_SIZE):
+        records = source.get(ids=ids[start:start + CHROMA_ADD_BATCH_SIZE],
+                             include=["embeddings", "documents", "metadatas"])
+        target.add(ids=records["ids"], embeddings=records["embeddings"],
+                   documents=records["documents"], metadatas=records["metadatas"])
+
 
-    # Initialize embeddings
+def _embed_chunks(target, chunks, ids):
+    """Embed new chunks through the batched pipeline and add them to the target collection"""
+    # Initialize embeddings (retries are handled by the pipeline's backoff)
     embeddings = AzureOpenAIEmbeddings(
         azure_deployment=settings.AZURE_EMBEDDING_DEPLOYMENT,
         openai_api_version=settings.AZURE_EMBEDDING_API_VERSION,
         azure_endpoint=settings.AZURE_OPENAI_ENDPOINT,
-        api_key=settings.AZURE_OPENAI_API_KEY
+        api_key=settings.AZURE_OPENAI_API_KEY,
+        max_retries=0
     )
+    pipeline = EmbeddingPipeline(
+        embeddings.embed_documents,
+        checkpoint_path=CHECKPOINT_PATH,
+        **getattr(settings, "CHATBOT_INGEST_EMBEDDING", {})
+    )
+    vectors = pipeline.embed([(cid, chunks[cid][0]) for cid in ids])
+    for start in range(0, len(ids), CHROMA_ADD_BATCH_SIZE):
+        batch = ids[start:start + CHROMA_ADD_BATCH_SIZE]
+        target.add(
+            ids=batch,
+            embeddings=[vectors[cid] for cid in batch],
+            documents=[chunks[cid][0] for cid in batch],
+            metadatas=[chunks[cid][1] for cid in batch],
+        )
+    pipeline.clear_checkpoint()
 
-    # Initialize ChromaDB client
-    persist_directory = os.path.join(os.path.dirname(__file__), "chroma_db")
-    os.makedirs(persist_directory, exist_ok=True)
-    client = chromadb.PersistentClient(path=persist_directory)
-    
-    # Delete existing collection if it exists
-    collections = client.list_collections()
-    for collection in collections:
-        if collection.name == "goodwish_chatbot":
-            print("Dropping existing 'goodwish_chatbot' collection...")
-            client.delete_collection("goodwish_chatbot")
-            break
-    
-    # Create or update ChromaDB vector store
-    vectorstore = Chroma.from_documents(
-        documents=chunks,
-        embedding=embeddings,
-        client=client,  # Pass the client directly
-        collection_name="goodwish_chatbot"
+
+def validate_collection(collection, expected_ids):
+    """Check the new collection holds exactly the expected chunks and answers a query"""
+    if not expected_ids:
+        raise IngestionError(f"Collection {collection.name} would be empty")
+    actual_ids = set(collection.get(include=[])["ids"])
+    if actual_ids != expected_ids:
+        raise IngestionError(f"Collection {collection.name} has {len(actual_ids)} chunks, expected {len(expected_ids)}")
+    sample = collection.get(ids=[min(expected_ids)], include=["embeddings"])
+    result = collection.query(query_embeddings=sample["embeddings"], n_results=1, include=[])
+    if result["ids"][0] != sample["ids"]:
+        raise IngestionError(f"Collection {collection.name} failed a self-query check")
+
+
+def build_keyword_index(collection):
+    """Build and persist the BM25 index for a collection version"""
+    records = collection.get(include=["documents", "metadatas"])
+    KeywordIndex.build(records["ids"], records["documents"], records["metadatas"]).save(
+        keyword_index_path(collection.name)
     )
-    # No need to call persist() - it's handled automatically
-    
-    print(f"Embedded {len(chunks)} document chunks into ChromaDB")
+
+
+def export_vector_snapshot(collection):
+    """Export a collection version's embeddings for the in-memory retrieval engine"""
+    ids, embeddings, documents, metadatas = [], [], [], []
+    all_ids = collection.get(include=[])["ids"]
+    for start in range(0, len(all_ids), CHROMA_ADD_BATCH_SIZE):
+        records = collection.get(ids=all_ids[start:start + CHROMA_ADD_BATCH_SIZE],
+                                 include=["embeddings", "documents", "metadatas"])
+        ids.extend(records["ids"])
+        embeddings.extend(records["embeddings"])
+        documents.extend(records["documents"])
+        metadatas.extend(records["metadatas"])
+    VectorSnapshot.build(ids, embeddings, documents, metadatas).save(collection.name)
+
+
+def garbage_collect_collections(client, active_name):
+    """Delete superseded collection versions, keeping the most recent KEEP_PREVIOUS_VERSIONS"""
+    names = [
+        name for name in client.list_collections()
+        if name != active_name and (name == COLLECTION_NAME or name.startswith(f"{COLLECTION_NAME}_v"))
+    ]
+    # Versions sort by their timestamp suffix; the unversioned legacy collection is oldest
+    names.sort(key=lambda name: name[len(COLLECTION_NAME) + 2:] if name != COLLECTION_NAME else "", reverse=True)
+    for name in names[KEEP_PREVIOUS_VERSIONS:]:
+        print(f"Dropping superseded collection '{name}'")
+        client.delete_collection(name)
+        for path in (keyword_index_path(name), *vector_snapshot_paths(name)):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def ingest_documents():
+    """
+    Incrementally sync docs/ into a new versioned ChromaDB collection and switch to it.
+
+    Files whose hash matches the manifest are not re-chunked. Unchanged chunks are copied
+    from the active collection and only new ones are embedded. The new collection is
+    validated before the index version pointer is flipped, so running workers switch to
+    it atomically and never see a partially built or empty collection.
+    """
+    active_name = active_collection_name()
+    manifest = load_manifest(active_name)
+    document_files = discover_documents()
+    if not document_files:
+        print("Error: No documents were found in docs/.")
+        return
+
+    # Work out the desired chunk set, re-chunking only new or changed files
+    files = {}
+    changed = {}
+    for file_name in document_files:
+        sha256 = file_sha256(os.path.join(DOCUMENT_DIR, file_name))
+        previous = manifest["files"].get(file_name)
+        if previous and previous["sha256"] == sha256:
+            files[file_name] = previous
+        else:
+            changed[file_name] = sha256
+
+    new_chunks = {}
+    for file_name, chunks in split_documents(sorted(changed)):
+        print(f"Chunked {file_name} into {len(chunks)} chunks")
+        new_chunks.update(chunks)
+        files[file_name] = {"sha256": changed[file_name], "chunks": sorted(chunks)}
+    files = dict(sorted(files.items()))
+    desired_ids = {cid for entry in files.values() for cid in entry["chunks"]}
+    if not desired_ids:
+        # Never switch workers to an empty collection; the live one (if any) stays in place
+        print("Error: No text could be extracted from the documents in docs/.")
+        return
+
+    # Initialize ChromaDB client
+    os.makedirs(PERSIST_DIRECTORY, exist_ok=True)
+    client = chromadb.PersistentClient(path=PERSIST_DIRECTORY)
+    if active_name in client.list_collections():
+        active = client.get_collection(active_name)
+        existing_ids = set(active.get(include=[])["ids"])
+    else:
+        active = None
+        existing_ids = set()
+
+    if desired_ids == existing_ids:
+        save_manifest({"collection": active_name, "files": files})
+        print(f"Collection '{active_name}' is up to date ({len(desired_ids)} chunks from {len(files)} documents)")
+        if not os.path.exists(keyword_index_path(active_name)):
+            build_keyword_index(active)
+        if not os.path.exists(vector_snapshot_paths(active_name)[1]):
+            export_vector_snapshot(active)
+        garbage_collect_collections(client, active_name)
+        return
+
+    to_add = sorted(desired_ids - existing_ids)
+    missing = set(to_add) - set(new_chunks)
+    if missing:
+        # Manifest says these exist but the collection lost them; re-chunk their files
+        lost_files = [file_name for file_name, entry in files.items() if missing.intersection(entry["chunks"])]
+        for _, chunks in split_documents(lost_files):
+            new_chunks.update(chunks)
+    to_copy = sorted(desired_ids & existing_ids)
+
+    # Build the new version alongside the live one
+    new_name = versioned_collection_name()
+    target = client.create_collection(new_name)
+    try:
+        if to_copy:
+            _copy_chunks(active, target, to_copy)
+        if to_add:
+            _embed_chunks(target, new_chunks, to_add)
+        validate_collection(target, desired_ids)
+        build_keyword_index(target)
+        export_vector_snapshot(target)
+    except Exception:
+        client.delete_collection(new_name)
+        raise
+
+    # Flip the pointer; workers pick up the new collection (and drop their caches)
+    save_manifest({"collection": new_name, "files": files})
+    write_index_version(new_name)
+    print(f"Switched to collection '{new_name}': embedded {len(to_add)} new chunks, "
+          f"kept {len(to_copy)}, dropped {len(existing_ids - desired_ids)} "
+          f"({len(desired_ids)} chunks from {len(files)} documents)")
+
+    garbage_collect_collections(client, new_name)
 
 if __name__ == "__main__":
-    # For standalone execution, set up Django environment
+    # For standalone execution (python -m chatbot.document_ingestion), set up Django environment
     import sys
     import django
     project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     sys.path.append(project_dir)
     os.environ.setdefault("DJANGO_SETTINGS_MODULE", "goodwish_chatbot.settings")
     django.setup()
-    
-    ingest_documents()
\ No newline at end of file
+
+    ingest_documents()
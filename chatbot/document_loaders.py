@@ -0,0 +1,126 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+
+# File extension -> loader returning the documents (pages, slides, sheets...) in a file
+LOADERS: Dict[str, Callable[[str], List[Document]]] = {}
+
+
+def register_loader(*extensions):
+    """Register a loader function for one or more file extensions"""
+    def decorator(fn):
+        for extension in extensions:
+            LOADERS[extension.lower()] = fn
+        return fn
+    return decorator
+
+
+def supported_extensions() -> Tuple[str, ...]:
+    return tuple(LOADERS)
+
+
+def _document(text: str, path: str, **metadata) -> Document:
+    return Document(page_content=text, metadata={"source": os.path.basename(path), **metadata})
+
+
+@register_loader(".txt", ".md")
+def load_text(path: str) -> List[Document]:
+    with open(path, encoding="utf-8") as f:
+        return [_document(f.read(), path)]
+
+
+@register_loader(".pdf")
+def load_pdf(path: str) -> List[Document]:
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    return [
+        _document(text, path, page=number)
+        for number, page in enumerate(reader.pages, start=1)
+        if (text := (page.extract_text() or "").strip())
+    ]
+
+
+@register_loader(".docx")
+def load_docx(path: str) -> List[Document]:
+    import docx
+
+    document = docx.Document(path)
+    parts = [paragraph.text for paragraph in document.paragraphs if paragraph.text.strip()]
+    for table in document.tables:
+        for row in table.rows:
+            parts.append(" | ".join(cell.text.strip() for cell in row.cells))
+    return [_document("\n".join(parts), path)]
+
+
+@register_loader(".pptx")
+def load_pptx(path: str) -> List[Document]:
+    from pptx import Presentation
+
+    documents = []
+    for number, slide in enumerate(Presentation(path).slides, start=1):
+        texts = [shape.text_frame.text for shape in slide.shapes if shape.has_text_frame and shape.text_frame.text.strip()]
+        if texts:
+            documents.append(_document("\n".join(texts), path, slide=number))
+    return documents
+
+
+@register_loader(".xlsx")
+def load_xlsx(path: str) -> List[Document]:
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    documents = []
+    try:
+        for sheet in workbook.worksheets:
+            rows = [
+                " | ".join("" if value is None else str(value) for value in row)
+                for row in sheet.iter_rows(values_only=True)
+                if any(value is not None for value in row)
+            ]
+            if rows:
+                documents.append(_document("\n".join(rows), path, sheet=sheet.title))
+    finally:
+        workbook.close()
+    return documents
+
+
+@register_loader(".html", ".htm")
+def load_html(path: str) -> List[Document]:
+    from bs4 import BeautifulSoup
+
+    with open(path, encoding="utf-8", errors="replace") as f:
+        soup = BeautifulSoup(f.read(), "html.parser")
+    for element in soup(["script", "style", "noscript"]):
+        element.decompose()
+    text = "\n".join(line.strip() for line in soup.get_text("\n").splitlines() if line.strip())
+    return [_document(text, path, title=soup.title.string.strip() if soup.title and soup.title.string else "")]
+
+
+def load_document(path: str) -> List[Document]:
+    """Parse a file with the loader registered for its extension"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in LOADERS:
+        raise ValueError(f"No loader registered for {extension} files")
+    return LOADERS[extension](path)
+
+
+def parse_documents(paths: Sequence[str], max_workers: Optional[int] = None) -> Iterator[Tuple[str, List[Document]]]:
+    """
+    Parse files in parallel on a process pool, yielding (path, documents) as each finishes.
+
+    PDF and Office parsing is CPU-bound, so processes rather than threads; results stream
+    out in completion order so chunking starts before the slowest file is done.
+    """
+    if max_workers == 1 or len(paths) <= 1:
+        for path in paths:
+            yield path, load_document(path)
+        return
+
+    workers = min(max_workers or os.cpu_count() or 1, len(paths))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(load_document, path): path for path in paths}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
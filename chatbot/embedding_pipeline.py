@@ -0,0 +1,133 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from .retry import backoff_delay, is_retryable
+from .tokens import count_tokens
+
+
+class TokenBudget:
+    """Token bucket limiting the tokens sent per minute across all worker threads"""
+
+    def __init__(self, tokens_per_minute: int, clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60.0
+        self._available = float(tokens_per_minute)
+        self._updated = clock()
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int):
+        # A request larger than the whole budget waits for a full bucket rather than forever
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._available = min(self.capacity, self._available + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._available >= tokens:
+                    self._available -= tokens
+                    return
+                wait = (tokens - self._available) / self.rate
+            self._sleep(wait)
+
+
+class EmbeddingPipeline:
+    """
+    Embeds many texts through a batch embedding function (e.g. embed_documents).
+
+    Batches run on a bounded thread pool, each batch first reserves its tokens from the
+    per-minute budget, and rate-limit or transient failures are retried with jittered
+    backoff (honoring Retry-After). Finished batches are appended to a JSONL checkpoint,
+    so an interrupted run resumes without re-embedding what it already paid for.
+    """
+
+    def __init__(self, embed_fn: Callable[[List[str]], List[List[float]]], batch_size: int = 64,
+                 max_workers: int = 4, tokens_per_minute: Optional[int] = None, max_retries: int = 6,
+                 base_delay: float = 1.0, max_delay: float = 60.0, checkpoint_path: Optional[str] = None,
+                 sleep: Callable[[float], None] = time.sleep, progress: Callable[[str], None] = print):
+        self.embed_fn = embed_fn
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.budget = TokenBudget(tokens_per_minute, sleep=sleep) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.checkpoint_path = checkpoint_path
+        self._sleep = sleep
+        self._progress = progress
+        self._checkpoint_lock = threading.Lock()
+
+    def embed(self, items: Sequence[Tuple[str, str]]) -> Dict[str, List[float]]:
+        """Embed (id, text) pairs, returning {id: vector}; ids should be content hashes"""
+        vectors = self._load_checkpoint()
+        pending = [(item_id, text) for item_id, text in items if item_id not in vectors]
+        if vectors:
+            self._progress(f"Resuming from checkpoint: {len(items) - len(pending)}/{len(items)} chunks already embedded")
+        if not pending:
+            return {item_id: vectors[item_id] for item_id, _ in items}
+
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        done = len(items) - len(pending)
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="embed") as executor:
+            futures = [executor.submit(self._embed_batch, batch) for batch in batches]
+            for future in as_completed(futures):
+                result = future.result()
+                vectors.update(result)
+                done += len(result)
+                self._progress(f"Embedded {done}/{len(items)} chunks")
+
+        return {item_id: vectors[item_id] for item_id, _ in items}
+
+    def clear_checkpoint(self):
+        """Remove the checkpoint once its vectors are safely stored"""
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def _embed_batch(self, batch: List[Tuple[str, str]]) -> Dict[str, List[float]]:
+        texts = [text for _, text in batch]
+        if self.budget:
+            self.budget.acquire(sum(count_tokens(text) for text in texts))
+        attempt = 0
+        while True:
+            try:
+                result = dict(zip([item_id for item_id, _ in batch], self.embed_fn(texts)))
+                break
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = backoff_delay(attempt, self.base_delay, self.max_delay, e)
+                self._progress(f"Embedding batch failed ({e}), retrying in {delay:.1f}s")
+                self._sleep(delay)
+                attempt += 1
+        self._save_checkpoint(result)
+        return result
+
+    def _load_checkpoint(self) -> Dict[str, List[float]]:
+        vectors = {}
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return vectors
+        with open(self.checkpoint_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn final line from an interrupted run
+                    continue
+                vectors[entry["id"]] = entry["vector"]
+        return vectors
+
+    def _save_checkpoint(self, vectors: Dict[str, List[float]]):
+        if not self.checkpoint_path:
+            return
+        lines = "".join(json.dumps({"id": item_id, "vector": vector}) + "\n" for item_id, vector in vectors.items())
+        with self._checkpoint_lock:
+            with open(self.checkpoint_path, "a", encoding="utf-8") as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
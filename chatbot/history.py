@@ -0,0 +1,202 @@
+import atexit
+import logging
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .retry import backoff_delay
+
+logger = logging.getLogger(__name__)
+
+
+def _chain(target: Future, source: Future):
+    """Settle target with the outcome of source"""
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(None)
+
+
+class _Shard:
+    """Pending writes for the sessions owned by one worker thread"""
+
+    def __init__(self):
+        self.pending: "OrderedDict[str, List[Dict]]" = OrderedDict()
+        self.clears: Dict[str, Future] = {}  # Sessions whose stored history is deleted before their pending writes
+        self.failures: Dict[str, int] = {}  # Failed saves of each session's pending writes
+        self.condition = threading.Condition()
+        self.busy = False
+
+
+class HistoryWriter:
+    """
+    Write-behind persistence of chat messages to the conversation store.
+
+    Sessions are sharded over a fixed pool of worker threads by key, so all writes for
+    one session go through the same worker in order. Pending messages are coalesced per
+    session, and each worker inserts those of up to batch_size sessions with a single
+    bulk insert per transaction. Clearing a session goes through the same worker, so a
+    batch already being saved cannot bring a cleared history back.
+
+    A batch that fails to save goes back in front of the pending writes, merged with any
+    newer ones, and is retried with jittered exponential backoff; a session whose writes
+    have failed max_retries + 1 times is dropped and logged.
+    """
+
+    def __init__(self, workers: int = 2, batch_size: int = 50, flush_interval: float = 0.05,
+                 max_retries: int = 5, backoff_base: float = 0.5, backoff_max: float = 10):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._shards = [_Shard() for _ in range(max(1, workers))]
+        self._threads = []
+        self._start_lock = threading.Lock()
+
+    def enqueue(self, session_key: str, messages: List[Dict]):
+        """Schedule new chat history messages ({'role', 'content', 'image'}) to be appended"""
+        self._ensure_started()
+        shard = self._shard(session_key)
+        with shard.condition:
+            shard.pending.setdefault(session_key, []).extend(messages)
+            shard.condition.notify_all()
+
+    def clear(self, session_key: str, timeout: Optional[float] = 10.0):
+        """
+        Delete the session's stored history, dropping its pending writes, and wait until
+        done. Runs on the session's worker after any batch it is saving.
+        """
+        self._ensure_started()
+        shard = self._shard(session_key)
+        with shard.condition:
+            shard.pending[session_key] = []
+            future = shard.clears.setdefault(session_key, Future())
+            shard.condition.notify_all()
+        future.result(timeout)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every pending write has been saved; False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for shard in self._shards:
+            with shard.condition:
+                while shard.pending or shard.busy:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    shard.condition.wait(remaining)
+        return True
+
+    def _shard(self, session_key: str) -> _Shard:
+        return self._shards[zlib.crc32(session_key.encode("utf-8")) % len(self._shards)]
+
+    def _ensure_started(self):
+        if self._threads:
+            return
+        with self._start_lock:
+            if not self._threads:
+                for index, shard in enumerate(self._shards):
+                    thread = threading.Thread(target=self._run, args=(shard,), name=f"history-writer-{index}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+    def _run(self, shard: _Shard):
+        delay = self.flush_interval
+        while True:
+            with shard.condition:
+                while not shard.pending:
+                    shard.condition.wait()
+            # Let writes from a burst of requests accumulate into one batch (or back off after a failure)
+            time.sleep(delay)
+            with shard.condition:
+                batch = []
+                while shard.pending and len(batch) < self.batch_size:
+                    batch.append(shard.pending.popitem(last=False))
+                clears = {
+                    session_key: shard.clears.pop(session_key)
+                    for session_key, _ in batch if session_key in shard.clears
+                }
+                shard.busy = True
+            try:
+                self._save(batch, list(clears))
+            except Exception as e:
+                delay = self._retry(shard, batch, clears, e)
+            else:
+                delay = self.flush_interval
+                for session_key, _ in batch:
+                    shard.failures.pop(session_key, None)
+                for future in clears.values():
+                    future.set_result(None)
+            finally:
+                close_old_connections()
+                with shard.condition:
+                    shard.busy = False
+                    shard.condition.notify_all()
+
+    def _retry(self, shard: _Shard, batch, clears: Dict[str, Future], error: Exception) -> float:
+        """Requeue a batch that failed to save; returns the delay before the next attempt"""
+        attempts = 0
+        with shard.condition:
+            for session_key, messages in reversed(batch):
+                clear = clears.get(session_key)
+                failures = shard.failures.pop(session_key, 0) + 1
+                if failures > self.max_retries:
+                    logger.error("Dropping %d chat history messages of session %s after %d failed saves: %s",
+                                 len(messages), session_key, failures, error)
+                    if clear is not None:
+                        clear.set_exception(error)
+                    continue
+                newer_clear = shard.clears.get(session_key)
+                if newer_clear is not None:
+                    # Cleared again meanwhile, which deletes these messages as well
+                    if clear is not None:
+                        newer_clear.add_done_callback(lambda future, clear=clear: _chain(clear, future))
+                    continue
+                if clear is not None:
+                    shard.clears[session_key] = clear
+                shard.pending[session_key] = messages + shard.pending.get(session_key, [])
+                shard.pending.move_to_end(session_key, last=False)
+                shard.failures[session_key] = failures
+                attempts = max(attempts, failures)
+        if not attempts:
+            return self.flush_interval
+        delay = max(self.flush_interval, backoff_delay(attempts - 1, self.backoff_base, self.backoff_max))
+        logger.warning("Saving chat history for %d sessions failed, retrying in %.1fs: %s", len(batch), delay, error)
+        return delay
+
+    def _save(self, batch, clears=()):
+        from .models import Conversation, Message
+
+        session_keys = [session_key for session_key, _ in batch]
+        with transaction.atomic():
+            for session_key in clears:
+                Message.objects.clear_session(session_key)
+            Conversation.objects.bulk_create(
+                [Conversation(session_key=session_key) for session_key in session_keys],
+                ignore_conflicts=True,
+            )
+            conversations = dict(
+                Conversation.objects.filter(session_key__in=session_keys).values_list("session_key", "id")
+            )
+            Message.objects.bulk_create([
+                Message(
+                    conversation_id=conversations[session_key],
+                    role=message["role"],
+                    content=message.get("content") or "",
+                    image_hash=message["image"] if isinstance(message.get("image"), str) else "",
+                )
+                for session_key, messages in batch
+                for message in messages
+            ])
+
+
+HISTORY_WRITER = HistoryWriter(**getattr(settings, "CHATBOT_HISTORY_WRITER", {}))
+
+# Persist whatever is still pending when the worker process exits normally
+atexit.register(HISTORY_WRITER.flush, 5.0)
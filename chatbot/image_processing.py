@@ -0,0 +1,133 @@
+import base64
+import hashlib
+import io
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import BinaryIO, Iterator, Union
+
+from django.conf import settings
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Largest accepted upload, before any processing
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+
+# Decoded pixel limit, rejects decompression bombs before they are loaded
+MAX_PIXELS = 40_000_000
+
+# Vision model high-detail limits: the image is fitted in MAX_SIDE x MAX_SIDE, then its
+# shortest side scaled to SHORT_SIDE; anything larger is downscaled by the service anyway
+# and only costs upload time.
+MAX_SIDE = 2048
+SHORT_SIDE = 768
+
+JPEG_QUALITY = 85
+
+# Bytes read per base64 step (a multiple of 3, so chunks encode without padding)
+BASE64_CHUNK_SIZE = 3 * 64 * 1024
+
+
+class ImageProcessingError(ValueError):
+    """Raised when an upload is not a usable image"""
+    pass
+
+
+@dataclass(frozen=True)
+class ProcessedImage:
+    """A re-encoded image ready to send to the vision model"""
+    data_url: str = field(repr=False)  # data:<mime type>;base64,...
+    mime_type: str
+    width: int
+    height: int
+    content_hash: str  # sha256 of the re-encoded bytes, so uploads decoding to the same pixels share it
+
+
+def target_size(width: int, height: int):
+    """Size after fitting in MAX_SIDE and scaling the shortest side down to SHORT_SIDE"""
+    scale = min(1.0, MAX_SIDE / max(width, height), SHORT_SIDE / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def base64_chunks(source: Union[bytes, memoryview, BinaryIO], chunk_size: int = BASE64_CHUNK_SIZE) -> Iterator[str]:
+    """Base64 encode a buffer or file chunk by chunk, never holding a full encoded copy"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for start in range(0, len(view), chunk_size):
+            yield base64.b64encode(view[start:start + chunk_size]).decode("ascii")
+        return
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            return
+        yield base64.b64encode(chunk).decode("ascii")
+
+
+def data_url(source: Union[bytes, memoryview, BinaryIO], mime_type: str) -> str:
+    """data: URL built in a single join of the encoded chunks"""
+    return "".join([f"data:{mime_type};base64,", *base64_chunks(source)])
+
+
+def _upload_size(source: BinaryIO) -> int:
+    size = getattr(source, "size", None)
+    if size is None:
+        position = source.tell()
+        size = source.seek(0, io.SEEK_END)
+        source.seek(position)
+    return size
+
+
+def preprocess_image(source: Union[bytes, BinaryIO]) -> ProcessedImage:
+    """
+    Decode an uploaded image, apply its EXIF orientation, downscale it to the vision
+    model's limits and re-encode it (JPEG, or PNG when it has transparency).
+
+    source may be a file (e.g. a Django UploadedFile, spooled to disk when large), which
+    Pillow reads incrementally instead of it being loaded into memory first.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    if _upload_size(source) > MAX_UPLOAD_BYTES:
+        raise ImageProcessingError(f"Image is larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+    try:
+        source.seek(0)
+        image = Image.open(source)
+        if image.width * image.height > MAX_PIXELS:
+            raise ImageProcessingError("Image dimensions are too large")
+        # Let the JPEG decoder downscale by a power of two while decoding
+        image.draft("RGB", target_size(image.width, image.height))
+        image = ImageOps.exif_transpose(image)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError) as e:
+        raise ImageProcessingError("Invalid or unsupported image file") from e
+
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+    image = image.convert("RGBA" if has_alpha else "RGB")
+    size = target_size(image.width, image.height)
+    if size != image.size:
+        image = image.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+    buffer = io.BytesIO()
+    if has_alpha:
+        image.save(buffer, format="PNG", optimize=True)
+        mime_type = "image/png"
+    else:
+        image.save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        mime_type = "image/jpeg"
+
+    return ProcessedImage(
+        data_url=data_url(buffer.getbuffer(), mime_type),
+        mime_type=mime_type,
+        width=image.width,
+        height=image.height,
+        content_hash=hashlib.sha256(buffer.getbuffer()).hexdigest(),
+    )
+
+
+# Image decoding and resizing is CPU work; Pillow releases the GIL while doing it
+IMAGE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=getattr(settings, "CHATBOT_IMAGE_WORKERS", 2),
+    thread_name_prefix="image"
+)
+
+
+def submit_image(uploaded_file) -> Future:
+    """Start preprocessing an uploaded file on the image pool"""
+    return IMAGE_EXECUTOR.submit(preprocess_image, uploaded_file)
@@ -0,0 +1,127 @@
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Persisted indexes live next to the Chroma data, one file per collection version
+KEYWORD_INDEX_DIR = os.path.join(os.path.dirname(__file__), "chroma_db", "keyword_index")
+
+# URLs, emails and bare domains are kept whole so they can be matched exactly
+EXACT_TOKEN_PATTERN = re.compile(
+    r"https?://[^\s<>\"')\]]+"
+    r"|www\.[^\s<>\"')\]]+"
+    r"|[\w.+-]+@[\w-]+(?:\.[\w-]+)+"
+    r"|\b[\w-]+(?:\.[\w-]+)*\.(?:com|np|org|net|io|ai|co)\b[^\s<>\"')\]]*",
+    re.IGNORECASE,
+)
+WORD_PATTERN = re.compile(r"[\w\u0900-\u097F]+")
+
+STOPWORDS = {
+    "a", "an", "and", "are", "at", "be", "by", "can", "do", "does", "for", "from", "how", "http",
+    "https", "i", "in", "is", "it", "me", "my", "of", "on", "or", "the", "to", "what", "which",
+    "who", "with", "www", "you", "your",
+}
+
+
+def normalize_exact_token(token: str) -> str:
+    """Canonical form of a URL/email/domain: lowercase, no scheme, www. or trailing punctuation"""
+    token = token.lower().rstrip(".,;:!?/")
+    token = re.sub(r"^https?://", "", token)
+    return token[4:] if token.startswith("www.") else token
+
+
+def exact_tokens(text: str) -> List[str]:
+    """URLs, emails and domains in the text, plus the host of each URL"""
+    tokens = []
+    for match in EXACT_TOKEN_PATTERN.findall(text):
+        token = normalize_exact_token(match)
+        tokens.append(token)
+        host = token.split("/", 1)[0]
+        if host != token:
+            tokens.append(host)
+    return tokens
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens (stopwords removed) followed by exact URL/email/domain tokens"""
+    words = [word for word in WORD_PATTERN.findall(text.lower()) if word not in STOPWORDS]
+    return words + exact_tokens(text)
+
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence[str]], k: int = 60) -> List[str]:
+    """Merge ranked id lists: each id scores sum(1 / (k + rank)) over the lists it appears in"""
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking, start=1):
+            scores[item_id] += 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class KeywordIndex:
+    """BM25 inverted index over the chunks of one collection version"""
+
+    def __init__(self, ids: List[str], texts: List[str], metadatas: List[Dict],
+                 postings: Dict[str, List[Tuple[int, int]]], lengths: List[int],
+                 k1: float = 1.5, b: float = 0.75):
+        self.ids = ids
+        self.texts = texts
+        self.metadatas = metadatas
+        self.postings = postings  # term -> [(doc index, term frequency)]
+        self.lengths = lengths
+        self.k1 = k1
+        self.b = b
+        self.average_length = (sum(lengths) / len(lengths)) if lengths else 1.0
+        self.idf = {
+            term: math.log(1 + (len(ids) - len(entries) + 0.5) / (len(entries) + 0.5))
+            for term, entries in postings.items()
+        }
+
+    @classmethod
+    def build(cls, ids: List[str], texts: List[str], metadatas: Optional[List[Dict]] = None) -> "KeywordIndex":
+        postings = defaultdict(list)
+        lengths = []
+        for index, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            lengths.append(sum(counts.values()))
+            for term, frequency in counts.items():
+                postings[term].append((index, frequency))
+        return cls(ids, texts, metadatas or [{} for _ in ids], dict(postings), lengths)
+
+    def search(self, query: str, k: int = 3) -> List[Tuple[int, float]]:
+        """Top-k (doc index, BM25 score) for the query"""
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            for index, frequency in self.postings.get(term, ()):
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[index] / self.average_length)
+                scores[index] += self.idf[term] * frequency * (self.k1 + 1) / (frequency + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def exact_matches(self, query: str) -> List[str]:
+        """Exact tokens of the query (URLs, emails, domains) that occur in the corpus"""
+        return [token for token in exact_tokens(query) if token in self.postings]
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "ids": self.ids,
+                "texts": self.texts,
+                "metadatas": self.metadatas,
+                "postings": self.postings,
+                "lengths": self.lengths,
+            }, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "KeywordIndex":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        postings = {term: [tuple(entry) for entry in entries] for term, entries in data["postings"].items()}
+        return cls(data["ids"], data["texts"], data["metadatas"], postings, data["lengths"])
+
+
+def keyword_index_path(collection_name: str) -> str:
+    return os.path.join(KEYWORD_INDEX_DIR, f"{collection_name}.json")
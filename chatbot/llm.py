@@ -0,0 +1,285 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Sequence
+
+from .metrics import record_error
+from .retry import backoff_delay, is_retryable
+
+
+class LoopThread:
+    """
+    An event loop on a daemon thread, started on first use (and again in a forked worker).
+
+    Sync callers run coroutines on it and wait for the result, so any number of requests
+    can have attempts in flight without a thread each, and an abandoned attempt is
+    cancelled at once, closing its connection.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._loop = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None or self._pid != os.getpid():
+            with self._lock:
+                if self._loop is None or self._pid != os.getpid():
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name=self.name, daemon=True).start()
+                    self._loop, self._pid = loop, os.getpid()
+        return self._loop
+
+    def run(self, coro: Awaitable[Any]) -> Any:
+        return asyncio.run_coroutine_threadsafe(coro, self._get_loop()).result()
+
+
+# Event loop running the attempts of sync completion calls
+LLM_LOOP = LoopThread("llm")
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling Azure while the circuit breaker is open"""
+    pass
+
+
+class CircuitBreaker:
+    """
+    Fails fast after repeated failures.
+
+    Opens after failure_threshold consecutive failures; while open, calls are refused
+    for reset_timeout seconds. Then one trial call is let through (half-open): success
+    closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half-open" if self._clock() - self._opened_at >= self.reset_timeout else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._clock() - self._opened_at < self.reset_timeout or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.failure_threshold:
+                self._opened_at = self._clock()
+            self._trial = False
+
+
+class ResilientLLM:
+    """
+    Chat completions with a deadline per attempt, jittered retries of rate limits and
+    transient errors (honoring Retry-After), optional hedging and a circuit breaker.
+
+    Attempts are made with the async client, under asyncio.wait_for, so attempt_timeout
+    bounds the whole attempt rather than each read. The sync complete() runs them on
+    LLM_LOOP and waits. With hedge_delay set and more than one deployment, a request that
+    has not answered after hedge_delay seconds (or has failed) is repeated on the next
+    deployment; the first response wins and the others are cancelled. Retryable failures
+    count towards the breaker; client errors such as 400 are raised at once and do not.
+    """
+
+    def __init__(self, client_factory: Callable[[], Any], async_client_factory: Callable[[], Any],
+                 deployments: Sequence[str], attempt_timeout: float = 20, max_retries: int = 2,
+                 backoff_base: float = 0.5, backoff_max: float = 8, hedge_delay: Optional[float] = None,
+                 breaker: Optional[CircuitBreaker] = None, sleep: Callable[[float], None] = time.sleep):
+        self.client_factory = client_factory
+        self.async_client_factory = async_client_factory
+        self.deployments = [deployment for deployment in deployments if deployment]
+        self.attempt_timeout = attempt_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_delay = hedge_delay
+        self.breaker = breaker or CircuitBreaker()
+        self._sleep = sleep
+
+    @property
+    def deadline(self) -> float:
+        """Longest a call can take: every attempt timing out, with the longest backoff before each retry"""
+        return self.attempt_timeout * (self.max_retries + 1) + self.backoff_max * self.max_retries
+
+    def _hedges(self) -> List[str]:
+        return self.deployments if self.hedge_delay is not None else self.deployments[:1]
+
+    def _options(self, client):
+        # Retries are done here, with the breaker's knowledge; the SDK's own are disabled.
+        # The timeout bounds each read, which for a stream is the wait for its next chunk.
+        return client.with_options(timeout=self.attempt_timeout, max_retries=0)
+
+    def _retry_delay(self, attempt: int, exc: Exception) -> Optional[float]:
+        """Seconds to wait before retrying after exc, or None if it should be raised"""
+        if not is_retryable(exc):
+            # A client error (e.g. a content filter 400) still means Azure is answering
+            self.breaker.record_success()
+            return None
+        self.breaker.record_failure()
+        record_error("llm")
+        if attempt >= self.max_retries:
+            return None
+        delay = backoff_delay(attempt, self.backoff_base, self.backoff_max, exc)
+        print(f"Completion failed ({exc}), retrying in {delay:.1f}s")
+        return delay
+
+    def _check_breaker(self):
+        if not self.breaker.allow():
+            record_error("circuit_open")
+            raise CircuitOpenError("Azure OpenAI circuit breaker is open")
+
+    def complete(self, **kwargs) -> Any:
+        """chat.completions.create(**kwargs), with kwargs["model"] replaced by each deployment"""
+        attempt = 0
+        while True:
+            self._check_breaker()
+            try:
+                completion = LLM_LOOP.run(self._ahedged(kwargs))
+            except Exception as e:
+                delay = self._retry_delay(attempt, e)
+                if delay is None:
+                    raise
+                self._sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return completion
+
+    async def acomplete(self, **kwargs) -> Any:
+        """Async version of complete; losing hedged requests are cancelled"""
+        attempt = 0
+        while True:
+            self._check_breaker()
+            try:
+                completion = await self._ahedged(kwargs)
+            except Exception as e:
+                delay = self._retry_delay(attempt, e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return completion
+
+    async def _acall(self, deployment: str, kwargs: Dict) -> Any:
+        client = self._options(self.async_client_factory())
+        try:
+            return await asyncio.wait_for(
+                client.chat.completions.create(**{**kwargs, "model": deployment}), self.attempt_timeout
+            )
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"No completion from {deployment} within {self.attempt_timeout}s") from None
+
+    async def _ahedged(self, kwargs: Dict) -> Any:
+        deployments = self._hedges()
+        if len(deployments) == 1:
+            return await self._acall(deployments[0], kwargs)
+        pending = {asyncio.ensure_future(self._acall(deployments[0], kwargs))}
+        launched = 1
+        errors = []
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=self.hedge_delay if launched < len(deployments) else None,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    errors.append(task.exception())
+                if launched < len(deployments) and (not done or not pending):
+                    pending.add(asyncio.ensure_future(self._acall(deployments[launched], kwargs)))
+                    launched += 1
+            raise errors[0]
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stream(self, **kwargs) -> Iterator[Any]:
+        """
+        Streaming completion chunks. Attempts are retried until the first chunk arrives;
+        after that a failure is raised, since part of the answer has been sent. Streams
+        are not hedged.
+        """
+        attempt = 0
+        while True:
+            self._check_breaker()
+            try:
+                client = self._options(self.client_factory())
+                chunks = iter(client.chat.completions.create(**{**kwargs, "model": self.deployments[0], "stream": True}))
+                first = next(chunks, None)
+            except Exception as e:
+                delay = self._retry_delay(attempt, e)
+                if delay is None:
+                    raise
+                self._sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            if first is not None:
+                yield first
+                yield from chunks
+            return
+
+    async def astream(self, **kwargs) -> AsyncIterator[Any]:
+        """Async version of stream, with the async client; the first chunk is awaited under attempt_timeout"""
+        attempt = 0
+        while True:
+            self._check_breaker()
+            response = None
+            try:
+                client = self._options(self.async_client_factory())
+                response = await asyncio.wait_for(
+                    client.chat.completions.create(**{**kwargs, "model": self.deployments[0], "stream": True}),
+                    self.attempt_timeout
+                )
+                chunks = response.__aiter__()
+                first = await asyncio.wait_for(anext(chunks, None), self.attempt_timeout)
+            except Exception as e:
+                if response is not None:
+                    await response.close()
+                if isinstance(e, asyncio.TimeoutError):
+                    e = TimeoutError(f"No completion from {self.deployments[0]} within {self.attempt_timeout}s")
+                delay = self._retry_delay(attempt, e)
+                if delay is None:
+                    raise e
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            try:
+                if first is not None:
+                    yield first
+                    async for chunk in chunks:
+                        yield chunk
+            finally:
+                # Also when the client disconnects mid-answer, so the connection is released
+                await response.close()
+            return
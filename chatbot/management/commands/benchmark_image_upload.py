@@ -0,0 +1,73 @@
+import base64
+import io
+import time
+import tracemalloc
+
+from django.core.files.uploadedfile import InMemoryUploadedFile, TemporaryUploadedFile
+from django.core.management.base import BaseCommand
+from PIL import Image
+
+from chatbot.image_processing import preprocess_image
+
+
+def _photo(megapixels, quality):
+    """A noisy JPEG (compresses like a photo, unlike a flat colour image)"""
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = width * 3 // 4
+    noise = Image.effect_noise((width // 4, height // 4), 64).resize((width, height))
+    image = Image.merge("RGB", (noise, noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT), noise))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def _legacy(upload):
+    """The previous upload path: read, base64 encode and format the data URL"""
+    image_data = base64.b64encode(upload.read()).decode('utf-8')
+    return f"data:image/jpeg;base64,{image_data}"
+
+
+class Command(BaseCommand):
+    help = "Measure per-request peak Python memory of the image upload path (tracemalloc)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--megapixels", type=float, default=12.0)
+        parser.add_argument("--quality", type=int, default=95)
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def handle(self, *args, **options):
+        raw = _photo(options["megapixels"], options["quality"])
+        self.stdout.write(f"Upload: {options['megapixels']:g} MP JPEG, {len(raw) / 1e6:.1f} MB")
+
+        def in_memory():
+            return InMemoryUploadedFile(io.BytesIO(raw), "image", "photo.jpg", "image/jpeg", len(raw), None)
+
+        def spooled():
+            # What Django hands the view for uploads above FILE_UPLOAD_MAX_MEMORY_SIZE
+            upload = TemporaryUploadedFile("photo.jpg", "image/jpeg", len(raw), None)
+            upload.write(raw)
+            upload.seek(0)
+            return upload
+
+        cases = [
+            ("legacy base64 (in memory)", in_memory, _legacy),
+            ("preprocess (in memory)", in_memory, lambda upload: preprocess_image(upload).data_url),
+            ("preprocess (spooled to disk)", spooled, lambda upload: preprocess_image(upload).data_url),
+        ]
+        for name, make_upload, run in cases:
+            peaks, durations = [], []
+            for _ in range(options["repeat"]):
+                upload = make_upload()
+                tracemalloc.start()
+                start = time.perf_counter()
+                url = run(upload)
+                durations.append(time.perf_counter() - start)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+                upload.close()
+            self.stdout.write(
+                f"{name:30} peak {max(peaks) / 1e6:7.1f} MB "
+                f"({max(peaks) / len(raw):4.1f}x upload), "
+                f"{min(durations) * 1000:6.0f} ms, data URL {len(url) / 1e6:.2f} MB"
+            )
+        self.stdout.write("tracemalloc counts Python allocations (bytes/str copies), not Pillow's pixel buffers.")
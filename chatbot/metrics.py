@@ -0,0 +1,344 @@
+import glob
+import os
+import pickle
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+
+# Latency buckets in seconds, from cache hits up to slow LLM completions
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Token count buckets for prompt and completion sizes
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+# Observations waiting for the flusher; beyond this they are dropped (and counted)
+QUEUE_SIZE = 10000
+
+# With a metrics directory: seconds between snapshot writes while observations arrive,
+# and between heartbeat writes while idle. Workers whose snapshot is older than
+# STALE_SNAPSHOT are gone; their counters still count, their gauges are not reported.
+SNAPSHOT_INTERVAL = 1.0
+HEARTBEAT_INTERVAL = 15.0
+STALE_SNAPSHOT = 3 * HEARTBEAT_INTERVAL
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Iterable[Tuple[str, str]]) -> str:
+    labels = list(labels)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """Monotonic counter per label set"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def apply(self, labels: Tuple[str, ...], value: float):
+        self.values[labels] = self.values.get(labels, 0.0) + value
+
+    def current(self) -> Dict[Tuple[str, ...], float]:
+        return dict(self.values)
+
+    @staticmethod
+    def merge(total: Optional[float], value: float) -> float:
+        return (total or 0.0) + value
+
+    def samples(self, values: Dict[Tuple[str, ...], float], labelnames: Sequence[str]) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(zip(labelnames, labels))} {_format_value(value)}"
+            for labels, value in sorted(values.items())
+        ]
+
+
+class Histogram:
+    """Cumulative bucket histogram per label set (Prometheus semantics)"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[Tuple[str, ...], list] = {}  # labels -> [bucket counts..., sum, count]
+
+    def apply(self, labels: Tuple[str, ...], value: float):
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[index] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def current(self) -> Dict[Tuple[str, ...], list]:
+        return {labels: list(state) for labels, state in self.values.items()}
+
+    @staticmethod
+    def merge(total: Optional[list], state: list) -> list:
+        return list(state) if total is None else [a + b for a, b in zip(total, state)]
+
+    def samples(self, values: Dict[Tuple[str, ...], list], labelnames: Sequence[str]) -> List[str]:
+        lines = []
+        for labels, state in sorted(values.items()):
+            pairs = list(zip(labelnames, labels))
+            for bound, count in zip(self.buckets, state):
+                lines.append(f"{self.name}_bucket{_format_labels(pairs + [('le', _format_value(bound))])} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(pairs + [('le', '+Inf')])} {state[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(pairs)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(pairs)} {state[-1]}")
+        return lines
+
+
+class CallbackGauge:
+    """Values read from a callback at scrape time, for state kept by its owner (e.g. cache sizes)"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str],
+                 callback: Callable[[], Dict[Tuple[str, ...], float]]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+
+    def current(self) -> Dict[Tuple[str, ...], float]:
+        return dict(self.callback())
+
+    @staticmethod
+    def merge(total: Optional[float], value: float) -> float:
+        return value
+
+    def samples(self, values: Dict[Tuple[str, ...], float], labelnames: Sequence[str]) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(zip(labelnames, labels))} {_format_value(value)}"
+            for labels, value in sorted(values.items())
+        ]
+
+
+class MetricsRegistry:
+    """
+    Process-wide metrics fed through a bounded queue.
+
+    Request threads only enqueue (name, labels, value) tuples, which never blocks: when
+    the queue is full the observation is dropped and counted. A single daemon thread,
+    started on first use, drains the queue and updates the metrics.
+
+    Each worker process has its own registry. Without a directory, every series carries
+    a pid label and each worker has to be scraped on its own. With a directory shared by
+    the workers of a host, the flusher writes a snapshot of its process's metrics there
+    and render() reports them all: counters and histograms summed over the workers (dead
+    ones included, so totals never go back), gauges per pid of the live workers.
+    """
+
+    def __init__(self, queue_size: int = QUEUE_SIZE, directory: Optional[str] = None):
+        self.metrics: Dict[str, object] = {}
+        self.dropped = 0
+        self.directory = directory
+        self._queue_size = queue_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._flusher_lock = threading.Lock()
+        self._pid = os.getpid()
+        self._written = 0.0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str],
+              callback: Callable[[], Dict[Tuple[str, ...], float]]) -> CallbackGauge:
+        return self.metrics.setdefault(name, CallbackGauge(name, documentation, labelnames, callback))
+
+    def record(self, name: str, value: float = 1.0, **labels):
+        """Queue an observation (counter increment or histogram sample) for the flusher"""
+        metric = self.metrics[name]
+        key = tuple(str(labels.get(label, "")) for label in metric.labelnames)
+        self._ensure_flusher()
+        try:
+            self._queue.put_nowait((metric, key, value))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Block until every queued observation has been applied"""
+        self._queue.join()
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        snapshot = self._snapshot()
+        if self.directory is None:
+            snapshots = {os.getpid(): snapshot}
+        else:
+            self._write_snapshot(snapshot)
+            snapshots = self._read_snapshots()
+
+        lines = []
+        for metric in self.metrics.values():
+            per_worker = self.directory is None or isinstance(metric, CallbackGauge)
+            values = {}
+            for pid, worker in snapshots.items():
+                if isinstance(metric, CallbackGauge) and time.time() - worker["written"] > STALE_SNAPSHOT:
+                    continue
+                for labels, value in worker["metrics"].get(metric.name, {}).items():
+                    if per_worker:
+                        labels = labels + (str(pid),)
+                    values[labels] = metric.merge(values.get(labels), value)
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples(values, metric.labelnames + (("pid",) if per_worker else ())))
+        lines.append("# HELP chatbot_metrics_dropped_total Observations dropped because the metrics queue was full")
+        lines.append("# TYPE chatbot_metrics_dropped_total counter")
+        lines.append(f"chatbot_metrics_dropped_total {sum(worker['dropped'] for worker in snapshots.values())}")
+        return "\n".join(lines) + "\n"
+
+    def _snapshot(self) -> Dict:
+        """This process's metric values"""
+        with self._lock:
+            values = {
+                metric.name: metric.current()
+                for metric in self.metrics.values() if not isinstance(metric, CallbackGauge)
+            }
+        for metric in self.metrics.values():
+            if isinstance(metric, CallbackGauge):
+                values[metric.name] = metric.current()
+        return {"metrics": values, "dropped": self.dropped, "written": time.time()}
+
+    def _write_snapshot(self, snapshot: Dict):
+        try:
+            path = os.path.join(self.directory, f"{os.getpid()}.pickle")
+            with open(f"{path}.tmp", "wb") as f:
+                pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(f"{path}.tmp", path)
+            self._written = time.monotonic()
+        except OSError as e:
+            print(f"Writing metrics snapshot failed: {str(e)}")
+
+    def _read_snapshots(self) -> Dict[int, Dict]:
+        """Snapshots of every worker that has written one, by pid"""
+        snapshots = {}
+        for path in glob.glob(os.path.join(self.directory, "*.pickle")):
+            try:
+                with open(path, "rb") as f:
+                    snapshots[int(os.path.basename(path).split(".")[0])] = pickle.load(f)
+            except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+                continue  # Being replaced, or not a snapshot
+        return snapshots
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and self._pid == os.getpid():
+            return
+        with self._flusher_lock:
+            if self._pid != os.getpid():
+                # A forked worker starts from zero with its own queue and flusher
+                with self._lock:
+                    for metric in self.metrics.values():
+                        if not isinstance(metric, CallbackGauge):
+                            metric.values.clear()
+                self.dropped = 0
+                self._queue = queue.Queue(maxsize=self._queue_size)
+                self._flusher = None
+                self._pid = os.getpid()
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run, args=(self._queue,), name="metrics-flusher",
+                                                 daemon=True)
+                self._flusher.start()
+
+    def _run(self, observations: queue.Queue):
+        dirty = False
+        while True:
+            try:
+                batch = [observations.get(timeout=SNAPSHOT_INTERVAL if self.directory else None)]
+            except queue.Empty:
+                batch = []
+            # Apply whatever else is already waiting under one lock acquisition
+            while batch and len(batch) < 1000:
+                try:
+                    batch.append(observations.get_nowait())
+                except queue.Empty:
+                    break
+            with self._lock:
+                for metric, key, value in batch:
+                    metric.apply(key, value)
+            for _ in batch:
+                observations.task_done()
+
+            dirty = dirty or bool(batch)
+            if self.directory:
+                since_written = time.monotonic() - self._written
+                if (dirty and since_written >= SNAPSHOT_INTERVAL) or since_written >= HEARTBEAT_INTERVAL:
+                    self._write_snapshot(self._snapshot())
+                    dirty = False
+
+
+REGISTRY = MetricsRegistry(directory=getattr(settings, "CHATBOT_METRICS_DIR", None))
+
+REGISTRY.histogram("chatbot_request_duration_seconds", "End-to-end request latency", ["endpoint"])
+REGISTRY.histogram("chatbot_stage_duration_seconds", "Latency of each request stage", ["stage"])
+REGISTRY.histogram("chatbot_stage_overlap_seconds",
+                   "Stage time hidden by running request stages concurrently (their total minus wall time)")
+REGISTRY.histogram("chatbot_tokens", "Tokens per LLM completion", ["kind"], TOKEN_BUCKETS)
+REGISTRY.counter("chatbot_cache_requests_total", "Cache lookups by cache and result (hit/miss)", ["cache", "result"])
+REGISTRY.counter("chatbot_errors_total", "Requests that failed, by stage", ["stage"])
+
+
+def observe_stage(stage: str, seconds: float):
+    REGISTRY.record("chatbot_stage_duration_seconds", seconds, stage=stage)
+
+
+def observe_overlap(seconds: float):
+    REGISTRY.record("chatbot_stage_overlap_seconds", seconds)
+
+
+@contextmanager
+def timed(stage: str):
+    """Record the duration of the enclosed block as a stage timing"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def observe_request(endpoint: str, seconds: float):
+    REGISTRY.record("chatbot_request_duration_seconds", seconds, endpoint=endpoint)
+
+
+def record_tokens(prompt_tokens: int, completion_tokens: int):
+    REGISTRY.record("chatbot_tokens", prompt_tokens, kind="prompt")
+    REGISTRY.record("chatbot_tokens", completion_tokens, kind="completion")
+
+
+def record_cache(cache: str, hit: bool):
+    REGISTRY.record("chatbot_cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+
+def record_error(stage: str):
+    REGISTRY.record("chatbot_errors_total", stage=stage)
@@ -1,3 +1,68 @@
+from typing import Dict, List
+
 from django.db import models
 
-# Create your models here.
+
+class Conversation(models.Model):
+    """A chat conversation, identified by the Django session it belongs to"""
+    session_key = models.CharField(max_length=40, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.session_key
+
+
+class MessageQuerySet(models.QuerySet):
+    def history_window(self, session_key: str, size: int) -> List[Dict]:
+        """
+        Last `size` messages of a session's conversation, oldest first, as chat history dicts.
+
+        Served by the (conversation, -id) index, so the cost depends on the window size
+        and not on the length of the conversation.
+        """
+        if size <= 0:
+            return []
+        messages = list(
+            self.filter(conversation__session_key=session_key)
+            .order_by("-id")
+            .only("role", "content", "image_hash")[:size]
+        )
+        return [message.as_history() for message in reversed(messages)]
+
+    def clear_session(self, session_key: str):
+        self.filter(conversation__session_key=session_key).delete()
+
+
+class Message(models.Model):
+    """
+    One chat turn. Rows are only ever inserted; images are recorded by content hash,
+    never stored.
+    """
+    USER = "user"
+    ASSISTANT = "assistant"
+    ROLE_CHOICES = [(USER, "User"), (ASSISTANT, "Assistant")]
+
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="messages")
+    role = models.CharField(max_length=16, choices=ROLE_CHOICES)
+    content = models.TextField(blank=True)
+    image_hash = models.CharField(max_length=64, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        ordering = ["id"]
+        indexes = [
+            models.Index(fields=["conversation", "-id"], name="chatbot_message_recent_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.role}: {self.content[:50]}"
+
+    @property
+    def has_image(self) -> bool:
+        return bool(self.image_hash)
+
+    def as_history(self) -> Dict:
+        """Chat history dict used by the prompt builder ('image' is the image hash or None)"""
+        return {"role": self.role, "content": self.content, "image": self.image_hash or None}
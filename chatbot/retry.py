@@ -0,0 +1,49 @@
+import random
+from typing import Optional
+
+# HTTP statuses worth retrying: rate limiting and transient server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+def status_code(exc: Exception) -> Optional[int]:
+    """HTTP status of an API error (openai errors carry it on the exception or its response)"""
+    code = getattr(exc, "status_code", None)
+    if code is None:
+        code = getattr(getattr(exc, "response", None), "status_code", None)
+    return code
+
+
+def is_retryable(exc: Exception) -> bool:
+    """True for rate limits, transient server errors, timeouts and connection failures"""
+    code = status_code(exc)
+    if code is not None:
+        return code in RETRYABLE_STATUS_CODES
+    try:
+        import openai
+    except ImportError:
+        return isinstance(exc, (TimeoutError, ConnectionError))
+    return isinstance(exc, (openai.APIConnectionError, openai.APITimeoutError, TimeoutError, ConnectionError))
+
+
+def retry_after(exc: Exception) -> Optional[float]:
+    """Seconds the server asked us to wait (retry-after-ms / Retry-After headers), if any"""
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def backoff_delay(attempt: int, base: float = 1.0, maximum: float = 60.0, exc: Optional[Exception] = None) -> float:
+    """
+    Delay before retry number attempt (0-based): the server's Retry-After when given,
+    otherwise exponential backoff with full jitter.
+    """
+    server_delay = retry_after(exc) if exc is not None else None
+    if server_delay is not None:
+        return min(server_delay, maximum)
+    return random.uniform(0, min(maximum, base * (2 ** attempt)))
@@ -0,0 +1,146 @@
+import heapq
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+
+class _Shard:
+    """One lock stripe: LRU-ordered entries plus a heap of their scheduled expiry times"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[str, list]" = OrderedDict()  # key -> [value, expires, scheduled]
+        self.heap = []  # (scheduled, key)
+
+
+class SessionCache:
+    """
+    In-process cache of per-session values (chat histories) with a sliding TTL.
+
+    Keys are spread over lock-striped shards, so requests for different sessions rarely
+    contend. Every access is O(1) (plus O(log n) for a new key): expiry is done by a
+    background sweeper that pops due entries from each shard's heap instead of scanning
+    all sessions, and each shard evicts its least recently used entry past its size cap.
+    """
+
+    def __init__(self, shards: int = 16, ttl: float = 1800, max_entries: int = 50000,
+                 sweep_interval: float = 30, clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.shard_capacity = max(1, max_entries // max(1, shards))
+        self.sweep_interval = sweep_interval
+        self._shards = [_Shard() for _ in range(max(1, shards))]
+        self._clock = clock
+        self._sweeper = None
+        self._sweeper_lock = threading.Lock()
+
+    def _shard(self, key: str) -> _Shard:
+        return self._shards[zlib.crc32(key.encode("utf-8")) % len(self._shards)]
+
+    def get(self, key: str) -> Optional[Any]:
+        """Value for the key (refreshing its TTL), or None if missing or expired"""
+        shard = self._shard(key)
+        now = self._clock()
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                del shard.entries[key]
+                return None
+            entry[1] = now + self.ttl
+            shard.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: str, value: Any):
+        shard = self._shard(key)
+        with shard.lock:
+            self._store(shard, key, value)
+
+    def setdefault(self, key: str, value: Any) -> Any:
+        """Store value unless the key already has a live one; returns the cached value"""
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is not None and entry[1] > self._clock():
+                entry[1] = self._clock() + self.ttl
+                shard.entries.move_to_end(key)
+                return entry[0]
+            self._store(shard, key, value)
+            return value
+
+    def update(self, key: str, fn: Callable[[Optional[Any]], Any]) -> Any:
+        """
+        Atomically replace the key's value with fn(current value or None).
+
+        fn runs under the shard lock, so concurrent updates of one session are applied
+        one after the other; it must not block.
+        """
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            current = entry[0] if entry is not None and entry[1] > self._clock() else None
+            value = fn(current)
+            self._store(shard, key, value)
+            return value
+
+    def pop(self, key: str) -> Optional[Any]:
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.pop(key, None)
+        return entry[0] if entry is not None else None
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self._shards)
+
+    def _store(self, shard: _Shard, key: str, value: Any):
+        self._ensure_sweeper()
+        expires = self._clock() + self.ttl
+        entry = shard.entries.get(key)
+        if entry is None:
+            shard.entries[key] = [value, expires, expires]
+            heapq.heappush(shard.heap, (expires, key))
+            while len(shard.entries) > self.shard_capacity:
+                # Its heap record is skipped by the sweeper once the entry is gone
+                shard.entries.popitem(last=False)
+        else:
+            entry[0] = value
+            entry[1] = expires
+            shard.entries.move_to_end(key)
+
+    def sweep(self) -> int:
+        """Remove expired entries; returns how many were removed"""
+        removed = 0
+        now = self._clock()
+        for shard in self._shards:
+            with shard.lock:
+                while shard.heap and shard.heap[0][0] <= now:
+                    scheduled, key = heapq.heappop(shard.heap)
+                    entry = shard.entries.get(key)
+                    if entry is None or entry[2] != scheduled:
+                        continue  # evicted, removed or re-added since this record was pushed
+                    if entry[1] <= now:
+                        del shard.entries[key]
+                        removed += 1
+                    else:
+                        # Accessed since it was scheduled; check again at its new expiry
+                        entry[2] = entry[1]
+                        heapq.heappush(shard.heap, (entry[1], key))
+        return removed
+
+    def _ensure_sweeper(self):
+        if self._sweeper is not None:
+            return
+        with self._sweeper_lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._run, name="session-cache-sweeper", daemon=True)
+                self._sweeper.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Session cache sweep failed: {str(e)}")
@@ -0,0 +1,202 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+from .cache import shared_cache
+
+
+class FlightAbandoned(Exception):
+    """The leader went away (e.g. its request was cancelled); a waiting caller takes over"""
+    pass
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into one.
+
+    The first caller for a key (the leader) runs the call; callers arriving while it is in
+    flight wait for its result (or exception) instead of repeating it. Calls are tracked
+    with concurrent.futures.Future, so threads and coroutines waiting on the same key
+    share one flight.
+
+    With shared=True the leader also takes a short-lived lock in the shared cache, so a
+    leader in another worker process is waited for too: poll() is called until it returns
+    the value that worker cached, or its lock is gone, after which the call runs here.
+
+    A leader that is cancelled abandons the flight instead of failing it: its waiters
+    join again, and one of them becomes the new leader.
+    """
+
+    def __init__(self, timeout: float = 60, shared: bool = False, lock_timeout: float = 30,
+                 poll_interval: float = 0.1, alias: Optional[str] = None, prefix: str = "flight"):
+        self.timeout = timeout  # Longest wait for another caller's result
+        self.shared = shared
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.alias = alias
+        self.prefix = prefix
+        self._flights = {}  # key -> Future
+        self._lock = threading.Lock()
+
+    def join(self, key: str) -> Tuple[Future, bool]:
+        """The key's in-flight Future, and whether the caller is its leader (and must finish it)"""
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                return future, False
+            future = self._flights[key] = Future()
+            return future, True
+
+    def finish(self, key: str, future: Future, result: Any = None, error: Optional[BaseException] = None):
+        """Publish the leader's result (or exception) to the waiting callers"""
+        with self._lock:
+            if self._flights.get(key) is future:
+                del self._flights[key]
+        if not future.done():
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def abandon(self, key: str, future: Future):
+        """Give up the lead without a result; the waiting callers retry"""
+        self.finish(key, future, error=FlightAbandoned(key))
+
+    def do(self, key: str, fn: Callable[[], Any], poll: Optional[Callable[[], Any]] = None) -> Tuple[Any, bool]:
+        """Run fn() once for concurrent callers of key; returns (result, whether it was shared)"""
+        while True:
+            future, leader = self.join(key)
+            if leader:
+                break
+            try:
+                return future.result(timeout=self.timeout), True
+            except FlightAbandoned:
+                continue
+        try:
+            locked = self._acquire(key)
+            if not locked and poll is not None:
+                result = self._wait_remote(key, poll)
+                if result is not None:
+                    self.finish(key, future, result)
+                    return result, True
+                locked = self._acquire(key)
+            try:
+                result = fn()
+            finally:
+                if locked:
+                    self._release(key)
+        except BaseException as e:
+            self.finish(key, future, error=e)
+            raise
+        self.finish(key, future, result)
+        return result, False
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[Any]],
+                  poll: Optional[Callable[[], Any]] = None) -> Tuple[Any, bool]:
+        """
+        Async variant of do: fn is a coroutine function. Waiting, the shared cache lock and
+        poll() (run in a thread) do not block the event loop.
+        """
+        while True:
+            future, leader = self.join(key)
+            if leader:
+                break
+            try:
+                # Shielded, so a timed out waiter does not cancel the flight for the others
+                return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.timeout), True
+            except FlightAbandoned:
+                continue
+        try:
+            locked = await self._aacquire(key)
+            if not locked and poll is not None:
+                result = await self._await_remote(key, poll)
+                if result is not None:
+                    self.finish(key, future, result)
+                    return result, True
+                locked = await self._aacquire(key)
+            try:
+                result = await fn()
+            finally:
+                if locked:
+                    await self._arelease(key)
+        except asyncio.CancelledError:
+            self.abandon(key, future)
+            raise
+        except BaseException as e:
+            self.finish(key, future, error=e)
+            raise
+        self.finish(key, future, result)
+        return result, False
+
+    def _lock_key(self, key: str) -> str:
+        return f"{self.prefix}:{key}"
+
+    def _acquire(self, key: str) -> bool:
+        """Take the cross-worker lock; False if disabled, already held or the backend failed"""
+        if not self.shared:
+            return False
+        try:
+            return shared_cache(self.alias).add(self._lock_key(key), 1, self.lock_timeout)
+        except Exception as e:
+            print(f"Single-flight lock failed: {str(e)}")
+            return False
+
+    async def _aacquire(self, key: str) -> bool:
+        if not self.shared:
+            return False
+        try:
+            return await shared_cache(self.alias).aadd(self._lock_key(key), 1, self.lock_timeout)
+        except Exception as e:
+            print(f"Single-flight lock failed: {str(e)}")
+            return False
+
+    async def _arelease(self, key: str):
+        try:
+            await shared_cache(self.alias).adelete(self._lock_key(key))
+        except Exception as e:
+            print(f"Single-flight unlock failed: {str(e)}")
+
+    def _release(self, key: str):
+        try:
+            shared_cache(self.alias).delete(self._lock_key(key))
+        except Exception as e:
+            print(f"Single-flight unlock failed: {str(e)}")
+
+    def _remote_in_flight(self, key: str) -> bool:
+        try:
+            return shared_cache(self.alias).get(self._lock_key(key)) is not None
+        except Exception:
+            return False
+
+    async def _aremote_in_flight(self, key: str) -> bool:
+        try:
+            return await shared_cache(self.alias).aget(self._lock_key(key)) is not None
+        except Exception:
+            return False
+
+    def _wait_remote(self, key: str, poll: Callable[[], Any]) -> Optional[Any]:
+        """Value cached by another worker's leader for this key, or None if there is none"""
+        if not self.shared:
+            return None
+        deadline = time.monotonic() + self.timeout
+        while True:
+            value = poll()
+            if value is not None:
+                return value
+            if not self._remote_in_flight(key) or time.monotonic() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    async def _await_remote(self, key: str, poll: Callable[[], Any]) -> Optional[Any]:
+        if not self.shared:
+            return None
+        deadline = time.monotonic() + self.timeout
+        while True:
+            value = await asyncio.to_thread(poll)
+            if value is not None:
+                return value
+            if not await self._aremote_in_flight(key) or time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(self.poll_interval)
@@ -1,81 +1,361 @@
 # transcription_service.py
+import io
 import os
+import shutil
+import queue
+import subprocess
+import threading
+from dataclasses import dataclass
+from typing import BinaryIO, Iterable, Iterator, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import soundfile as sf
 from dotenv import load_dotenv
 import azure.cognitiveservices.speech as speechsdk
-from pydub import AudioSegment
 
 # Load environment variables
 load_dotenv()
 SPEECH_KEY = os.getenv("SPEECH_KEY")
 SPEECH_REGION = os.getenv("SPEECH_REGION")
 
+# Format the recognizer is fed: 16 kHz, 16-bit, mono PCM
+SAMPLE_RATE = 16000
+
+# Languages auto-detected by the recognizer
+LANGUAGES = ("en-US", "ne-NP")
+
+# Upload limits for voice queries
+MAX_AUDIO_BYTES = 25 * 1024 * 1024
+MAX_AUDIO_SECONDS = 300
+
+# Audio decoded (and pushed to the recognizer) per step
+BLOCK_SECONDS = 0.2
+
+AudioSource = Union[str, bytes, BinaryIO]
+
+
 class TranscriptionError(Exception):
     """Custom exception for transcription errors"""
     pass
 
-def convert_to_wav(input_file):
-    """Convert audio file to WAV format compatible with transcription service using soundfile"""
-    try:
-        import soundfile as sf
-        import os
-        import io
-        
-        # Create output filename
-        output_file = os.path.splitext(input_file)[0] + '_converted.wav'
-        
-        # For WebM files, we need to use a different approach
-        # since soundfile might not support WebM directly
-        if input_file.endswith('.webm'):
-            # If your frontend is sending WebM, you might need to install additional libraries
-            # or use a subprocess to call ffmpeg directly
-            raise NotImplementedError("WebM conversion requires ffmpeg. Please install ffmpeg or use a different format.")
-        
-        # For WAV files that might have incorrect headers
+
+class AudioDecodeError(TranscriptionError):
+    """The upload is not audio in a supported format (WAV, OGG or WebM)"""
+    pass
+
+
+def _upload_size(source: BinaryIO) -> int:
+    size = getattr(source, "size", None)
+    if size is None:
+        position = source.tell()
+        size = source.seek(0, io.SEEK_END)
+        source.seek(position)
+    return size
+
+
+def sniff_format(header: bytes) -> Optional[str]:
+    """Container format from the file's magic bytes"""
+    if header[:4] == b"RIFF" and header[8:12] == b"WAVE":
+        return "wav"
+    if header[:4] == b"OggS":
+        return "ogg"
+    if header[:4] == b"\x1a\x45\xdf\xa3":  # EBML, the Matroska/WebM header
+        return "webm"
+    return None
+
+
+class Resampler:
+    """
+    Streaming resampler for mono audio, fed one block at a time.
+
+    Downsampling first applies a windowed-sinc low-pass filter at the new Nyquist
+    frequency, so content above it does not alias into the speech band. The filter
+    history and interpolation position carry over between blocks, so the output does not
+    depend on how the input was split.
+    """
+    TAPS = 32  # Filter half-width, in input samples
+
+    def __init__(self, rate: int, target_rate: int = SAMPLE_RATE):
+        self.step = rate / target_rate
+        self.kernel = None
+        if target_rate < rate:
+            cutoff = target_rate / rate / 2
+            taps = np.arange(-self.TAPS, self.TAPS + 1)
+            kernel = 2 * cutoff * np.sinc(2 * cutoff * taps) * np.hamming(len(taps))
+            self.kernel = (kernel / kernel.sum()).astype(np.float32)
+            self._history = np.zeros(len(kernel) - 1, dtype=np.float32)
+        self._tail = np.zeros(0, dtype=np.float32)  # Last sample of the previous block
+        self._base = 0  # Input index of the first buffered sample
+        self._position = 0.0  # Input index of the next output sample
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        block = np.asarray(block, dtype=np.float32)
+        if self.step == 1:
+            return block
+        if self.kernel is not None:
+            padded = np.concatenate([self._history, block])
+            self._history = padded[len(padded) - len(self._history):]
+            block = np.convolve(padded, self.kernel, mode="valid")
+        samples = np.concatenate([self._tail, block])
+        if len(samples) == 0:
+            return samples
+        last = self._base + len(samples) - 1
+        count = int((last - self._position) // self.step) + 1 if last >= self._position else 0
+        positions = self._position + np.arange(count) * self.step
+        output = np.interp(positions - self._base, np.arange(len(samples)), samples)
+        self._position += count * self.step
+        self._base = last
+        self._tail = samples[-1:]
+        return output.astype(np.float32)
+
+
+def resample(samples: np.ndarray, rate: int, target_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """Resample a whole mono signal"""
+    return Resampler(rate, target_rate).process(samples)
+
+
+def _soundfile_blocks(sound: sf.SoundFile, block_frames: int) -> Iterator[np.ndarray]:
+    with sound:
         try:
-            # Read the audio data
-            data, samplerate = sf.read(input_file)
-            
-            # Write to a new file with standard WAV format
-            sf.write(output_file, data, samplerate, subtype='PCM_16', format='WAV')
-            
-            print(f"Successfully converted audio to {output_file}")
-            return output_file
-        except Exception as e:
-            print(f"Error in soundfile conversion: {e}")
-            raise
-    
-    except Exception as e:
-        print(f"Error converting audio: {e}")
-        raise
+            for block in sound.blocks(blocksize=block_frames, dtype="float32", always_2d=True):
+                yield block.mean(axis=1)
+        except RuntimeError as e:
+            raise AudioDecodeError(f"Could not decode audio: {str(e)}")
+
+
+def _webm_blocks(source: BinaryIO, ffmpeg: str, block_frames: int) -> Iterator[np.ndarray]:
+    """Decode WebM (Opus) through ffmpeg pipes as it is read, without temporary files"""
+    process = subprocess.Popen(
+        [ffmpeg, "-loglevel", "error", "-i", "pipe:0", "-f", "s16le", "-ac", "1", "-ar", str(SAMPLE_RATE), "pipe:1"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
 
-def transcribe_audio(file_path):
-    """Transcribe audio using Azure Speech Services"""
-    if not SPEECH_KEY or not SPEECH_REGION:
-        raise TranscriptionError("Azure Speech credentials not found")
-    
+    def write():
+        try:
+            for chunk in iter(lambda: source.read(64 * 1024), b""):
+                process.stdin.write(chunk)
+        except (BrokenPipeError, ValueError):
+            pass  # ffmpeg exited (invalid input) or was killed
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    writer = threading.Thread(target=write, name="webm-decoder", daemon=True)
+    writer.start()
     try:
-        # Configure speech services
-        speech_config = speechsdk.SpeechConfig(subscription=SPEECH_KEY, region=SPEECH_REGION)
-        auto_detect_config = speechsdk.languageconfig.AutoDetectSourceLanguageConfig(
-            languages=["en-US", "ne-NP"]
-        )
-        audio_config = speechsdk.audio.AudioConfig(filename=file_path)
-        
-        # Create recognizer and transcribe
+        while True:
+            data = process.stdout.read(block_frames * 2)
+            if not data:
+                break
+            yield np.frombuffer(data[:len(data) // 2 * 2], dtype="<i2").astype(np.float32) / 32768.0
+        if process.wait(timeout=30) != 0:
+            raise AudioDecodeError(f"Could not decode WebM audio: {process.stderr.read().decode(errors='replace').strip()}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        writer.join()
+        process.stdout.close()
+        process.stderr.close()
+
+
+def _resampled(blocks: Iterator[np.ndarray], rate: int) -> Iterator[np.ndarray]:
+    resampler = Resampler(rate)
+    frames = 0
+    try:
+        for block in blocks:
+            frames += len(block)
+            if frames > MAX_AUDIO_SECONDS * rate:
+                raise AudioDecodeError(f"Audio is longer than {MAX_AUDIO_SECONDS} seconds")
+            output = resampler.process(block)
+            if len(output):
+                yield output
+    finally:
+        blocks.close()
+
+
+def open_audio(source: AudioSource, block_seconds: float = BLOCK_SECONDS) -> Iterator[np.ndarray]:
+    """
+    Open WAV, OGG (Vorbis/Opus) or WebM audio for decoding.
+
+    The format, size and (where the header records it) duration are checked up front;
+    the returned iterator then decodes the audio block by block as it is consumed,
+    yielding 16 kHz mono float32 samples.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    elif isinstance(source, str):
+        with open(source, "rb") as f:
+            source = io.BytesIO(f.read())
+    if _upload_size(source) > MAX_AUDIO_BYTES:
+        raise AudioDecodeError(f"Audio is larger than {MAX_AUDIO_BYTES // (1024 * 1024)} MB")
+    source.seek(0)
+    audio_format = sniff_format(source.read(12))
+    source.seek(0)
+    if audio_format is None:
+        raise AudioDecodeError("Unsupported audio format, expected WAV, OGG or WebM")
+
+    if audio_format == "webm":
+        ffmpeg = shutil.which("ffmpeg")
+        if ffmpeg is None:
+            raise AudioDecodeError("WebM audio requires ffmpeg on the server")
+        return _resampled(_webm_blocks(source, ffmpeg, int(block_seconds * SAMPLE_RATE)), SAMPLE_RATE)
+
+    try:
+        sound = sf.SoundFile(source)
+    except RuntimeError as e:
+        raise AudioDecodeError(f"Could not decode {audio_format.upper()} audio: {str(e)}")
+    if sound.frames > MAX_AUDIO_SECONDS * sound.samplerate:
+        sound.close()
+        raise AudioDecodeError(f"Audio is longer than {MAX_AUDIO_SECONDS} seconds")
+    return _resampled(_soundfile_blocks(sound, int(block_seconds * sound.samplerate)), sound.samplerate)
+
+
+def to_pcm16(samples: np.ndarray) -> bytes:
+    return (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+
+
+def pcm_chunks(source: AudioSource) -> Iterator[bytes]:
+    """Open an upload as a stream of 16 kHz mono 16-bit PCM chunks for the recognizer"""
+    return map(to_pcm16, open_audio(source))
+
+
+def prepare_audio(source: AudioSource) -> bytes:
+    """Decode a whole upload to 16 kHz mono 16-bit PCM"""
+    return b"".join(pcm_chunks(source))
+
+
+def convert_to_wav(input_file: AudioSource) -> bytes:
+    """Convert audio to a 16 kHz mono PCM_16 WAV file, returned as bytes (nothing is written to disk)"""
+    buffer = io.BytesIO()
+    samples = np.concatenate([np.zeros(0, dtype=np.float32), *open_audio(input_file)])
+    sf.write(buffer, samples, SAMPLE_RATE, subtype="PCM_16", format="WAV")
+    return buffer.getvalue()
+
+
+@dataclass(frozen=True)
+class SpeechEvent:
+    """A recognition result: "partial" hypotheses of a segment are revised until its "final" text"""
+    kind: str
+    text: str
+    language: Optional[str] = None
+
+
+class AzureSpeechRecognizer:
+    """
+    Transcribes PCM audio with Azure Speech, auto-detecting English or Nepali.
+
+    The speech and language configs are built once and shared by every request; only the
+    SpeechRecognizer, which is bound to one audio stream, is created per transcription.
+    """
+
+    def __init__(self, key: Optional[str] = None, region: Optional[str] = None,
+                 languages: Sequence[str] = LANGUAGES, timeout: float = 30):
+        key = key or SPEECH_KEY
+        region = region or SPEECH_REGION
+        if not key or not region:
+            raise TranscriptionError("Azure Speech credentials not found")
+        self.speech_config = speechsdk.SpeechConfig(subscription=key, region=region)
+        # Detect the language of every segment, not only the first
+        self.speech_config.set_property(speechsdk.PropertyId.SpeechServiceConnection_LanguageIdMode, "Continuous")
+        self.language_config = speechsdk.languageconfig.AutoDetectSourceLanguageConfig(languages=list(languages))
+        self.timeout = timeout  # Longest wait for the next recognition event
+
+    def stream(self, chunks: Iterable[bytes], sample_rate: int = SAMPLE_RATE) -> Iterator[SpeechEvent]:
+        """
+        Continuously recognize 16-bit mono PCM chunks, yielding partial and final results.
+
+        The chunks are pushed to the service from a feeder thread as they are produced,
+        so recognition of the start of a message overlaps decoding of the rest, and
+        recognition does not stop at the first pause like recognize_once.
+        """
+        events = queue.Queue()
+        stream_format = speechsdk.audio.AudioStreamFormat(samples_per_second=sample_rate, bits_per_sample=16, channels=1)
+        stream = speechsdk.audio.PushAudioInputStream(stream_format=stream_format)
         speech_recognizer = speechsdk.SpeechRecognizer(
-            speech_config=speech_config,
-            auto_detect_source_language_config=auto_detect_config,
-            audio_config=audio_config
+            speech_config=self.speech_config,
+            auto_detect_source_language_config=self.language_config,
+            audio_config=speechsdk.audio.AudioConfig(stream=stream)
         )
-        
-        # Get transcription result
-        result = speech_recognizer.recognize_once_async().get()
-        source_language = speechsdk.AutoDetectSourceLanguageResult(result)
-        
-        if result.reason == speechsdk.ResultReason.RecognizedSpeech:
-            return result.text, source_language.language
-        else:
-            raise TranscriptionError(f"Speech recognition failed: {result.reason}")
-            
+
+        def recognized(evt):
+            if evt.result.reason == speechsdk.ResultReason.RecognizedSpeech and evt.result.text:
+                language = speechsdk.AutoDetectSourceLanguageResult(evt.result).language
+                events.put(SpeechEvent("final", evt.result.text, language))
+
+        def canceled(evt):
+            if evt.cancellation_details.reason == speechsdk.CancellationReason.Error:
+                events.put(TranscriptionError(
+                    f"Speech recognition failed: {evt.cancellation_details.error_details}"
+                ))
+            events.put(None)
+
+        speech_recognizer.recognizing.connect(lambda evt: events.put(SpeechEvent("partial", evt.result.text)))
+        speech_recognizer.recognized.connect(recognized)
+        speech_recognizer.canceled.connect(canceled)
+        speech_recognizer.session_stopped.connect(lambda evt: events.put(None))
+
+        def feed():
+            try:
+                for chunk in chunks:
+                    stream.write(chunk)
+            except Exception as e:
+                events.put(e)
+            finally:
+                stream.close()  # End of audio: the session stops once it is recognized
+
+        speech_recognizer.start_continuous_recognition_async().get()
+        feeder = threading.Thread(target=feed, name="speech-feeder", daemon=True)
+        feeder.start()
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TranscriptionError("Speech recognition timed out")
+                if event is None:
+                    return
+                if isinstance(event, Exception):
+                    raise event
+                yield event
+        finally:
+            speech_recognizer.stop_continuous_recognition_async().get()
+
+    def transcribe(self, chunks: Iterable[bytes], sample_rate: int = SAMPLE_RATE) -> Tuple[str, str]:
+        """Return (text of all segments, language of the first) for a stream of PCM chunks"""
+        segments = [event for event in self.stream(chunks, sample_rate) if event.kind == "final"]
+        if not segments:
+            raise TranscriptionError("No speech could be recognized")
+        return " ".join(segment.text for segment in segments), segments[0].language
+
+    def recognize(self, pcm: bytes, sample_rate: int = SAMPLE_RATE) -> Tuple[str, str]:
+        """Return (text, detected language) for 16-bit mono PCM audio"""
+        return self.transcribe([pcm], sample_rate)
+
+
+_default_recognizer = None
+_recognizer_lock = threading.Lock()
+
+
+def get_recognizer() -> AzureSpeechRecognizer:
+    """Shared Azure recognizer, created on first use"""
+    global _default_recognizer
+    if _default_recognizer is None:
+        with _recognizer_lock:
+            if _default_recognizer is None:
+                _default_recognizer = AzureSpeechRecognizer()
+    return _default_recognizer
+
+
+def transcribe_audio(source: AudioSource, recognizer=None) -> Tuple[str, str]:
+    """Transcribe an audio file (path, bytes or file object); returns (text, language)"""
+    chunks = pcm_chunks(source)
+    recognizer = recognizer or get_recognizer()
+    try:
+        return recognizer.transcribe(chunks, SAMPLE_RATE)
+    except TranscriptionError:
+        raise
     except Exception as e:
-        raise TranscriptionError(f"Transcription failed: {str(e)}")
\ No newline at end of file
+        raise TranscriptionError(f"Transcription failed: {str(e)}")
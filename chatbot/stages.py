@@ -0,0 +1,79 @@
+import asyncio
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from django.conf import settings
+
+from .metrics import observe_overlap, observe_stage
+
+# Threads running the independent stages of a request (history, retrieval, ...)
+STAGE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=getattr(settings, "CHATBOT_STAGE_WORKERS", 8),
+    thread_name_prefix="stage"
+)
+
+
+class StageGraph:
+    """
+    The preparation stages of one request, started as soon as their inputs are known and
+    joined where their results are needed.
+
+    Each stage's start offset and duration is kept; close() records the graph's wall time
+    ("prepare" stage) and how much of the stages' total time overlapped, and prints the
+    trace when CHATBOT_STAGE_TRACE is set. Stages must not wait on each other's futures
+    (joins happen in the request), so the shared pool cannot deadlock.
+    """
+
+    def __init__(self, name: str, executor: ThreadPoolExecutor = None):
+        self.name = name
+        self.executor = executor or STAGE_EXECUTOR
+        self.started = time.perf_counter()
+        self.timings: Dict[str, Tuple[float, float]] = {}  # stage -> (start offset, duration)
+
+    def _timed(self, stage: str, fn: Callable[..., Any]) -> Callable[..., Any]:
+        def run(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.timings[stage] = (start - self.started, time.perf_counter() - start)
+        return run
+
+    def submit(self, stage: str, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        """Run a blocking stage on the stage pool"""
+        return self.executor.submit(self._timed(stage, fn), *args, **kwargs)
+
+    def run(self, stage: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run a stage in the calling thread (it depends on the results joined so far)"""
+        return self._timed(stage, fn)(*args, **kwargs)
+
+    def join(self, stage: str, future: Future) -> Any:
+        """Wait for a future started outside the graph (e.g. image preprocessing), timed as a stage"""
+        return self._timed(stage, future.result)()
+
+    def create_task(self, stage: str, coro: Awaitable[Any]) -> "asyncio.Task":
+        """Run a stage as a task on the running event loop"""
+        async def run():
+            start = time.perf_counter()
+            try:
+                return await coro
+            finally:
+                self.timings[stage] = (start - self.started, time.perf_counter() - start)
+        task = asyncio.ensure_future(run())
+        # A speculative stage may never be awaited; don't report its error as unretrieved
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+        return task
+
+    def trace(self) -> str:
+        return ", ".join(
+            f"{stage} +{start * 1000:.0f}ms {duration * 1000:.0f}ms"
+            for stage, (start, duration) in sorted(self.timings.items(), key=lambda item: item[1][0])
+        )
+
+    def close(self):
+        wall = time.perf_counter() - self.started
+        observe_stage("prepare", wall)
+        observe_overlap(max(0.0, sum(duration for _, duration in self.timings.values()) - wall))
+        if getattr(settings, "CHATBOT_STAGE_TRACE", False):
+            print(f"{self.name} stages ({wall * 1000:.0f}ms): {self.trace()}")
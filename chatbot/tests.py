@@ -1,3 +1,935 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import soundfile as sf
+import chromadb
+from chromadb.api.client import SharedSystemClient
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from openai import AsyncAzureOpenAI, AzureOpenAI
+
+from . import cache, cache_backends, chatbot_rag, document_ingestion, keyword_index, vector_snapshot, views
+from .cache import read_index_version, shared_cache
+from .cache_backends import SQLiteCache
+from .embedding_pipeline import EmbeddingPipeline, TokenBudget
+from .history import HistoryWriter
+from .models import Conversation, Message
+from .llm import LLM_LOOP, CircuitBreaker, CircuitOpenError, ResilientLLM
+from .metrics import MetricsRegistry
+from .single_flight import SingleFlight
+from .speech_to_text import SAMPLE_RATE, AzureSpeechRecognizer, Resampler, SpeechEvent, resample
+
+
+# Tests use in-memory caches, so no state carries over between runs (or into a checkout's cache files)
+LOCMEM_CACHES = override_settings(CACHES={
+    alias: {**config, "BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": f"test-{alias}"}
+    for alias, config in settings.CACHES.items()
+})
+
+
+def setUpModule():
+    LOCMEM_CACHES.enable()
+
+
+def tearDownModule():
+    LOCMEM_CACHES.disable()
+
+
+class RateLimitError(Exception):
+    """Stand-in for openai.RateLimitError (status code and response headers)"""
+
+    def __init__(self, retry_after=None):
+        super().__init__("429 Too Many Requests")
+        self.status_code = 429
+        self.response = SimpleNamespace(headers={"retry-after": retry_after} if retry_after else {})
+
+
+class FakeEmbedder:
+    """Embeds each text as [len(text)], failing with a 429 on the first `failures` calls"""
+
+    def __init__(self, failures=0, retry_after=None):
+        self.failures = failures
+        self.retry_after = retry_after
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        if self.failures:
+            self.failures -= 1
+            raise RateLimitError(self.retry_after)
+        return [[float(len(text))] for text in texts]
+
+
+class SQLiteCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = SQLiteCache(os.path.join(directory.name, "cache.sqlite3"),
+                                 {"TIMEOUT": 300, "OPTIONS": {"MAX_ENTRIES": 10, "CULL_FREQUENCY": 2}})
+
+    def test_get_set_add_delete(self):
+        self.assertIsNone(self.cache.get("missing"))
+        self.assertEqual(self.cache.get("missing", "default"), "default")
+        self.cache.set("key", {"answer": [1, 2]})
+        self.assertEqual(self.cache.get("key"), {"answer": [1, 2]})
+
+        self.assertFalse(self.cache.add("key", "other"))
+        self.assertTrue(self.cache.add("new", "value"))
+        self.assertEqual(self.cache.get("key"), {"answer": [1, 2]})
+
+        self.assertTrue(self.cache.delete("key"))
+        self.assertFalse(self.cache.delete("key"))
+        self.assertIsNone(self.cache.get("key"))
+
+    def test_expired_entries_are_misses(self):
+        self.cache.set("key", "value", timeout=0.05)
+        self.cache.set("lasting", "value", timeout=None)
+        time.sleep(0.1)
+
+        self.assertIsNone(self.cache.get("key"))
+        self.assertFalse(self.cache.has_key("key"))
+        self.assertTrue(self.cache.add("key", "again"))
+        self.assertEqual(self.cache.get("key"), "again")
+        self.assertEqual(self.cache.get("lasting"), "value")
+
+    def test_culls_oldest_expiring_entries_over_max_entries(self):
+        with mock.patch.object(cache_backends, "CULL_CHECK_INTERVAL", 1):
+            for index in range(30):
+                self.cache.set(f"key{index}", index, timeout=100 + index)
+        count = self.cache._connection().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+        self.assertLessEqual(count, 10)
+        self.assertIsNone(self.cache.get("key0"))
+        self.assertEqual(self.cache.get("key29"), 29)
+
+
+class EmbeddingPipelineTests(SimpleTestCase):
+    def setUp(self):
+        self.sleeps = []
+        self.items = [(f"id{i}", "x" * (i + 1)) for i in range(10)]
+
+    def make_pipeline(self, embedder, **kwargs):
+        kwargs.setdefault("batch_size", 3)
+        kwargs.setdefault("max_workers", 2)
+        return EmbeddingPipeline(embedder, sleep=self.sleeps.append, progress=lambda message: None, **kwargs)
+
+    def test_embeds_all_items_in_batches(self):
+        embedder = FakeEmbedder()
+        vectors = self.make_pipeline(embedder).embed(self.items)
+
+        self.assertEqual(vectors, {item_id: [float(len(text))] for item_id, text in self.items})
+        self.assertEqual(sorted(len(batch) for batch in embedder.calls), [1, 3, 3, 3])
+
+    def test_retries_rate_limits_honoring_retry_after(self):
+        embedder = FakeEmbedder(failures=2, retry_after="7")
+        vectors = self.make_pipeline(embedder, max_workers=1).embed(self.items)
+
+        self.assertEqual(len(vectors), len(self.items))
+        self.assertEqual(self.sleeps, [7.0, 7.0])
+
+    def test_gives_up_after_max_retries(self):
+        embedder = FakeEmbedder(failures=10)
+        with self.assertRaises(RateLimitError):
+            self.make_pipeline(embedder, max_workers=1, max_retries=2).embed(self.items[:1])
+        self.assertEqual(len(embedder.calls), 3)
+
+    def test_resumes_from_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, "checkpoint.jsonl")
+            self.make_pipeline(FakeEmbedder(), checkpoint_path=checkpoint).embed(self.items[:6])
+
+            embedder = FakeEmbedder()
+            pipeline = self.make_pipeline(embedder, checkpoint_path=checkpoint)
+            vectors = pipeline.embed(self.items)
+
+            self.assertEqual(len(vectors), len(self.items))
+            self.assertEqual(sorted(text for batch in embedder.calls for text in batch),
+                             sorted(text for _, text in self.items[6:]))
+            pipeline.clear_checkpoint()
+            self.assertFalse(os.path.exists(checkpoint))
+
+
+class TokenBudgetTests(SimpleTestCase):
+    def test_waits_for_tokens_to_refill(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        budget = TokenBudget(600, clock=lambda: now[0], sleep=sleep)  # 10 tokens per second
+        budget.acquire(600)
+        budget.acquire(50)
+
+        self.assertEqual(len(sleeps), 1)
+        self.assertAlmostEqual(sleeps[0], 5.0)
+
+
+def tone(seconds, rate, channels=1, frequency=440.0):
+    t = np.arange(int(seconds * rate)) / rate
+    samples = 0.5 * np.sin(2 * np.pi * frequency * t).astype(np.float32)
+    return np.repeat(samples[:, None], channels, axis=1)
+
+
+def audio_upload(name, fmt, seconds=1.0, rate=44100, channels=2):
+    buffer = io.BytesIO()
+    sf.write(buffer, tone(seconds, rate, channels), rate, format=fmt)
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type=f"audio/{fmt.lower()}")
+
+
+class FakeRecognizer(AzureSpeechRecognizer):
+    """Stand-in for the Azure recognizer: consumes the pushed audio, then emits one segment per text"""
+
+    def __init__(self, segments=("What courses do you offer?",), language="en-US"):
+        self.segments = list(segments)
+        self.language = language
+        self.chunks = []
+        self.sample_rate = None
+
+    def stream(self, chunks, sample_rate=SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.chunks.extend(chunks)
+        for text in self.segments:
+            yield SpeechEvent("partial", text.split()[0])
+            yield SpeechEvent("final", text, self.language)
+
+    @property
+    def pcm(self):
+        return b"".join(self.chunks)
+
+
+class ResampleTests(SimpleTestCase):
+    def test_resamples_to_target_rate(self):
+        samples = resample(tone(2.0, 44100)[:, 0], 44100)
+        self.assertEqual(len(samples), 2 * SAMPLE_RATE)
+        self.assertAlmostEqual(float(np.abs(samples[1000:-1000]).max()), 0.5, places=2)
+
+    def test_block_by_block_matches_whole_signal(self):
+        samples = tone(1.0, 44100)[:, 0]
+        resampler = Resampler(44100)
+        blocks = np.concatenate([resampler.process(block) for block in np.array_split(samples, 7)])
+        np.testing.assert_allclose(blocks, resample(samples, 44100), atol=1e-6)
+
+    def test_filters_frequencies_above_new_nyquist(self):
+        # 12 kHz is above the 8 kHz Nyquist frequency of 16 kHz audio, and would alias to 4 kHz
+        samples = resample(tone(1.0, 48000, frequency=12000.0)[:, 0], 48000)
+        self.assertLess(float(np.abs(samples[1000:-1000]).max()), 0.05)
+
+
+class VoiceQueryViewTests(TestCase):
+    def setUp(self):
+        self.recognizer = FakeRecognizer()
+        patches = [
+            mock.patch.object(views.VoiceQueryView, "recognizer", self.recognizer),
+            mock.patch.object(views, "get_chatbot_response", return_value="We offer robotics courses."),
+            mock.patch.object(views, "stream_chatbot_response", return_value=iter(["We offer ", "robotics courses."])),
+            mock.patch.object(views, "HISTORY_WRITER"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def post(self, upload):
+        return self.client.post(reverse("chatbot-voice-query"), {"audio": upload})
+
+    def test_transcribes_wav_and_answers(self):
+        response = self.post(audio_upload("query.wav", "WAV"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            "transcript": "What courses do you offer?",
+            "language": "en-US",
+            "response": "We offer robotics courses.",
+        })
+        self.assertEqual(self.recognizer.sample_rate, SAMPLE_RATE)
+        self.assertEqual(len(self.recognizer.pcm), SAMPLE_RATE * 2)  # one second of 16-bit mono
+        self.assertGreater(len(self.recognizer.chunks), 1)  # pushed block by block
+        views.get_chatbot_response.assert_called_once()
+        self.assertEqual(views.get_chatbot_response.call_args.args[0], "What courses do you offer?")
+
+    def test_transcribes_ogg(self):
+        response = self.post(audio_upload("query.ogg", "OGG", rate=48000, channels=1))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.recognizer.pcm), SAMPLE_RATE * 2)
+
+    def test_rejects_unsupported_audio(self):
+        response = self.post(SimpleUploadedFile("query.mp4", b"\x00\x00\x00\x18ftypmp42", content_type="audio/mp4"))
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.recognizer.chunks, [])
+
+    def test_reports_when_no_speech_is_recognized(self):
+        self.recognizer.segments = []
+        response = self.post(audio_upload("silence.wav", "WAV"))
+
+        self.assertEqual(response.status_code, 422)
+        views.get_chatbot_response.assert_not_called()
+
+    def test_joins_segments_of_long_messages(self):
+        self.recognizer.segments = ["What courses", "do you offer?"]
+        response = self.post(audio_upload("query.wav", "WAV"))
+
+        self.assertEqual(response.json()["transcript"], "What courses do you offer?")
+
+    def test_streams_partial_results_then_answer(self):
+        self.recognizer.segments = ["What courses", "do you offer?"]
+        response = self.client.post(reverse("chatbot-voice-stream"), {"audio": audio_upload("query.wav", "WAV")})
+        body = b"".join(response.streaming_content).decode()
+        events = [message.split("\n")[0][len("event: "):] for message in body.strip().split("\n\n")]
+
+        self.assertEqual(events[:6], ["partial", "segment", "partial", "segment", "transcript", "token"])
+        self.assertEqual(events[-1], "done")
+        self.assertIn('"text": "What courses do you offer?"', body)
+        self.assertIn('"response": "We offer robotics courses."', body)
+        views.stream_chatbot_response.assert_called_once()
+
+
+class FakeDocumentEmbeddings:
+    """Stand-in for AzureOpenAIEmbeddings: 8 dimensions derived from each text's hash"""
+    texts = []
+
+    def __init__(self, **kwargs):
+        pass
+
+    def embed_documents(self, texts):
+        FakeDocumentEmbeddings.texts.extend(texts)
+        return [[byte / 255 for byte in hashlib.sha256(text.encode()).digest()[:8]] for text in texts]
+
+
+@override_settings(CHATBOT_INGEST_PARSE_WORKERS=1,
+                   CHATBOT_INGEST_EMBEDDING={"batch_size": 16, "max_workers": 1})
+class DocumentIngestionTests(SimpleTestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.docs = os.path.join(root, "docs")
+        os.makedirs(self.docs)
+        persist = os.path.join(root, "chroma_db")
+        patches = [
+            mock.patch.object(document_ingestion, "DOCUMENT_DIR", self.docs),
+            mock.patch.object(document_ingestion, "PERSIST_DIRECTORY", persist),
+            mock.patch.object(document_ingestion, "MANIFEST_PATH", os.path.join(persist, "ingest_manifest.json")),
+            mock.patch.object(document_ingestion, "CHECKPOINT_PATH", os.path.join(persist, "checkpoint.jsonl")),
+            mock.patch.object(document_ingestion, "AzureOpenAIEmbeddings", FakeDocumentEmbeddings),
+            mock.patch.object(cache, "INDEX_VERSION_FILE", os.path.join(persist, "index_version")),
+            mock.patch.object(keyword_index, "KEYWORD_INDEX_DIR", os.path.join(persist, "keyword_index")),
+            mock.patch.object(vector_snapshot, "VECTOR_SNAPSHOT_DIR", os.path.join(persist, "vector_snapshot")),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        FakeDocumentEmbeddings.texts = []
+        self.persist = persist
+        self.addCleanup(shutil.rmtree, root, True)
+        self.addCleanup(SharedSystemClient.clear_system_cache)
+
+    def write(self, name, text):
+        with open(os.path.join(self.docs, name), "w", encoding="utf-8") as f:
+            f.write(text)
+
+    def ingest(self):
+        FakeDocumentEmbeddings.texts = []
+        document_ingestion.ingest_documents()
+        return read_index_version()
+
+    def chroma(self):
+        return chromadb.PersistentClient(path=self.persist)
+
+    def chunk_ids(self, name):
+        return set(self.chroma().get_collection(name).get(include=[])["ids"])
+
+    def test_first_run_builds_validates_and_switches(self):
+        self.write("courses.txt", "Robotics classes run on Saturdays.")
+        self.write("fees.txt", "The fee is 100 dollars per term.")
+        version = self.ingest()
+
+        self.assertTrue(version.startswith("goodwish_chatbot_v"))
+        self.assertEqual(len(self.chunk_ids(version)), 2)
+        self.assertEqual(len(FakeDocumentEmbeddings.texts), 2)
+        self.assertTrue(os.path.exists(keyword_index.keyword_index_path(version)))
+        self.assertTrue(os.path.exists(vector_snapshot.vector_snapshot_paths(version)[1]))
+        with open(document_ingestion.MANIFEST_PATH, encoding="utf-8") as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest["collection"], version)
+        self.assertEqual(sorted(manifest["files"]), ["courses.txt", "fees.txt"])
+
+    def test_changed_file_is_embedded_and_unchanged_chunks_are_copied(self):
+        self.write("courses.txt", "Robotics classes run on Saturdays.")
+        self.write("fees.txt", "The fee is 100 dollars per term.")
+        first = self.ingest()
+        courses_id = document_ingestion.chunk_id("courses.txt", "Robotics classes run on Saturdays.")
+
+        self.write("fees.txt", "The fee is 120 dollars per term.")
+        second = self.ingest()
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(FakeDocumentEmbeddings.texts, ["The fee is 120 dollars per term."])
+        self.assertEqual(self.chunk_ids(second), {
+            courses_id, document_ingestion.chunk_id("fees.txt", "The fee is 120 dollars per term.")
+        })
+        copied = self.chroma().get_collection(second).get(ids=[courses_id], include=["embeddings"])
+        original = self.chroma().get_collection(first).get(ids=[courses_id], include=["embeddings"])
+        np.testing.assert_array_equal(copied["embeddings"], original["embeddings"])
+        self.assertEqual(len(self.chunk_ids(first)), 2)  # The previous version is kept for running requests
+
+    def test_unchanged_documents_keep_the_collection(self):
+        self.write("courses.txt", "Robotics classes run on Saturdays.")
+        first = self.ingest()
+
+        self.assertEqual(self.ingest(), first)
+        self.assertEqual(FakeDocumentEmbeddings.texts, [])
+
+    def test_garbage_collects_superseded_versions(self):
+        versions = []
+        for fee in (100, 120, 140):
+            self.write("fees.txt", f"The fee is {fee} dollars per term.")
+            versions.append(self.ingest())
+
+        names = {name for name in self.chroma().list_collections()}
+        self.assertEqual(names, set(versions[1:]))
+        self.assertFalse(os.path.exists(keyword_index.keyword_index_path(versions[0])))
+        self.assertFalse(any(os.path.exists(path) for path in vector_snapshot.vector_snapshot_paths(versions[0])))
+
+    def test_failed_validation_keeps_the_live_collection(self):
+        self.write("courses.txt", "Robotics classes run on Saturdays.")
+        live = self.ingest()
+        self.write("courses.txt", "Robotics classes run on Sundays.")
+
+        error = document_ingestion.IngestionError("self-query failed")
+        with mock.patch.object(document_ingestion, "validate_collection", side_effect=error):
+            with self.assertRaises(document_ingestion.IngestionError):
+                self.ingest()
+
+        self.assertEqual(read_index_version(), live)
+        self.assertEqual(self.chroma().list_collections(), [live])
+
+    def test_documents_without_text_do_not_switch(self):
+        self.write("empty.txt", "   ")
+        self.assertEqual(self.ingest(), "")
+
+        self.write("courses.txt", "Robotics classes run on Saturdays.")
+        live = self.ingest()
+        os.remove(os.path.join(self.docs, "courses.txt"))
+        self.assertEqual(self.ingest(), live)
+        self.assertEqual(len(self.chunk_ids(live)), 1)
+
+    def test_validation_rejects_an_empty_chunk_set(self):
+        collection = self.chroma().create_collection("goodwish_chatbot_vempty")
+
+        with self.assertRaises(document_ingestion.IngestionError):
+            document_ingestion.validate_collection(collection, set())
+
+
+class MetricsRegistryTests(SimpleTestCase):
+    def registry(self, directory=None):
+        registry = MetricsRegistry(directory=directory)
+        registry.counter("requests_total", "Requests", ["endpoint"])
+        registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+        registry.gauge("entries", "Cache entries", ["cache"], lambda: {("response",): 3})
+        registry.record("requests_total", endpoint="text")
+        registry.record("latency_seconds", 0.05)
+        registry.flush()
+        return registry
+
+    def write_worker(self, directory, pid, written):
+        """Snapshot of another worker that answered two requests"""
+        with open(os.path.join(directory, f"{pid}.pickle"), "wb") as f:
+            pickle.dump({
+                "metrics": {
+                    "requests_total": {("text",): 2.0},
+                    "latency_seconds": {(): [1, 2, 0.6, 2]},
+                    "entries": {("response",): 5},
+                },
+                "dropped": 1,
+                "written": written,
+            }, f)
+
+    def test_labels_series_with_pid_without_directory(self):
+        text = self.registry().render()
+
+        self.assertIn(f'requests_total{{endpoint="text",pid="{os.getpid()}"}} 1', text)
+        self.assertIn(f'entries{{cache="response",pid="{os.getpid()}"}} 3', text)
+
+    def test_sums_workers_sharing_a_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_worker(directory, 1, time.time())
+            text = self.registry(directory).render()
+
+        self.assertIn('requests_total{endpoint="text"} 3', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="1"} 3', text)
+        self.assertIn("latency_seconds_count 3", text)
+        self.assertIn('entries{cache="response",pid="1"} 5', text)
+        self.assertIn(f'entries{{cache="response",pid="{os.getpid()}"}} 3', text)
+        self.assertIn("chatbot_metrics_dropped_total 1", text)
+
+    def test_keeps_counters_of_dead_workers_but_not_their_gauges(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_worker(directory, 1, time.time() - 3600)
+            text = self.registry(directory).render()
+
+        self.assertIn('requests_total{endpoint="text"} 3', text)
+        self.assertNotIn('pid="1"', text)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def run_concurrently(self, flight, key, fn, followers=4):
+        """Start a leader calling fn, then followers joining while it is in flight; returns their outcomes"""
+        started, release = threading.Event(), threading.Event()
+        outcomes = []
+
+        def leader_fn():
+            started.set()
+            release.wait(5)
+            return fn()
+
+        def call(fn):
+            try:
+                outcomes.append(flight.do(key, fn))
+            except Exception as e:
+                outcomes.append(e)
+
+        threads = [threading.Thread(target=call, args=(leader_fn,))]
+        threads[0].start()
+        started.wait(5)
+        for _ in range(followers):
+            threads.append(threading.Thread(target=call, args=(fn,)))
+            threads[-1].start()
+        time.sleep(0.1)  # The followers are waiting on the flight
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        return outcomes
+
+    def test_coalesces_concurrent_calls(self):
+        calls = []
+        outcomes = self.run_concurrently(SingleFlight(timeout=5), "q", lambda: calls.append(1) or "answer")
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(outcomes), [("answer", False)] + [("answer", True)] * 4)
+
+    def test_leader_exception_reaches_followers_then_next_call_runs(self):
+        flight = SingleFlight(timeout=5)
+
+        def fail():
+            raise ValueError("Azure is down")
+
+        outcomes = self.run_concurrently(flight, "q", fail)
+        self.assertEqual(len(outcomes), 5)
+        self.assertTrue(all(isinstance(outcome, ValueError) for outcome in outcomes))
+        self.assertEqual(flight.do("q", lambda: "answer"), ("answer", False))
+
+    def test_follower_takes_over_from_abandoned_leader(self):
+        flight = SingleFlight(timeout=5)
+        future, leader = flight.join("q")
+        self.assertTrue(leader)
+        outcomes = []
+        follower = threading.Thread(target=lambda: outcomes.append(flight.do("q", lambda: "answer")))
+        follower.start()
+        time.sleep(0.1)
+        flight.abandon("q", future)
+        follower.join(5)
+
+        self.assertEqual(outcomes, [("answer", False)])
+
+    def test_waits_for_remote_leader_until_its_lock_expires(self):
+        flight = SingleFlight(timeout=5, shared=True, lock_timeout=0.3, poll_interval=0.02)
+        # A leader in another worker took the lock and went away without releasing it
+        self.assertTrue(shared_cache().add("flight:q", 1, 0.3))
+        started = time.perf_counter()
+
+        self.assertEqual(flight.do("q", lambda: "answer", poll=lambda: None), ("answer", False))
+        self.assertGreaterEqual(time.perf_counter() - started, 0.25)
+        self.assertIsNone(shared_cache().get("flight:q"))  # Released after the call
+
+    def test_uses_value_cached_by_remote_leader(self):
+        flight = SingleFlight(timeout=5, shared=True, lock_timeout=5, poll_interval=0.02)
+        shared_cache().add("flight:q", 1, 5)
+        cached = []
+        threading.Timer(0.1, cached.append, args=("remote answer",)).start()
+
+        self.assertEqual(flight.do("q", lambda: "answer", poll=lambda: cached[0] if cached else None),
+                         ("remote answer", True))
+        shared_cache().delete("flight:q")
+
+    def test_response_lock_outlives_completion_retries(self):
+        self.assertEqual(chatbot_rag.RESPONSE_FLIGHTS.lock_timeout, chatbot_rag.LLM.deadline)
+        llm = ResilientLLM(None, None, ["primary"], attempt_timeout=20, max_retries=2, backoff_max=8)
+        self.assertEqual(llm.deadline, 76)
+
+    def test_stream_followers_get_leaders_degraded_answer(self):
+        started, release = threading.Event(), threading.Event()
+
+        def failing_stream(**kwargs):
+            started.set()
+            release.wait(5)
+            raise TimeoutError("No completion")
+            yield
+
+        results = {}
+
+        def stream(name):
+            results[name] = list(chatbot_rag.stream_chatbot_response("When are robotics classes?"))
+
+        prepared = ([], None, "Robotics classes run on Saturdays.", None, None)
+        with mock.patch.object(chatbot_rag, "_prepare", return_value=prepared), \
+                mock.patch.object(chatbot_rag.LLM, "stream", failing_stream), \
+                mock.patch.object(chatbot_rag, "record_error") as record_error:
+            leader = threading.Thread(target=stream, args=("leader",))
+            leader.start()
+            started.wait(5)
+            follower = threading.Thread(target=stream, args=("follower",))
+            follower.start()
+            time.sleep(0.1)
+            release.set()
+            leader.join(5)
+            follower.join(5)
+
+        self.assertIn("Saturdays", results["leader"][0])
+        self.assertEqual(results["follower"], results["leader"])
+        record_error.assert_called_once_with("stream")  # The follower was handed the answer, it did not fail
+
+
+class FlakyHistoryWriter(HistoryWriter):
+    """Records saved batches instead of writing them, failing the first `failures` saves"""
+
+    def __init__(self, failures=0, **kwargs):
+        super().__init__(workers=1, flush_interval=0.01, backoff_base=0.01, backoff_max=0.05, **kwargs)
+        self.failures = failures
+        self.saved = []
+
+    def _save(self, batch, clears=()):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("database is locked")
+        self.saved.extend(batch)
+
+
+class HistoryWriterRetryTests(SimpleTestCase):
+    def test_failed_batch_is_retried_ahead_of_newer_writes(self):
+        writer = FlakyHistoryWriter(failures=2)
+        with self.assertLogs("chatbot.history", "WARNING"):
+            writer.enqueue("a", [{"role": "user", "content": "1"}])
+            time.sleep(0.05)  # The first save has failed
+            writer.enqueue("a", [{"role": "user", "content": "2"}])
+            self.assertTrue(writer.flush(5))
+
+        contents = [message["content"] for _, messages in writer.saved for message in messages]
+        self.assertEqual(contents, ["1", "2"])
+
+    def test_drops_batch_once_retries_are_exhausted(self):
+        writer = FlakyHistoryWriter(failures=10, max_retries=2)
+        with self.assertLogs("chatbot.history", "ERROR") as logs:
+            writer.enqueue("a", [{"role": "user", "content": "1"}])
+            self.assertTrue(writer.flush(5))
+
+        self.assertEqual(writer.saved, [])
+        self.assertEqual(writer.failures, 7)
+        self.assertIn("Dropping 1 chat history messages of session a", logs.output[-1])
+
+
+def turn(number, image=None):
+    return [{"role": "user", "content": f"Question {number}", "image": image},
+            {"role": "assistant", "content": f"Answer {number}"}]
+
+
+class SlowHistoryWriter(HistoryWriter):
+    """Signals when a save starts and holds it until released"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.saving, self.release = threading.Event(), threading.Event()
+
+    def _save(self, batch, clears=()):
+        self.saving.set()
+        self.release.wait(5)
+        super()._save(batch, clears)
+
+
+# Writer threads use their own connections, so the tests are not wrapped in a transaction
+class HistoryWriterDatabaseTests(TransactionTestCase):
+    def writer(self, cls=HistoryWriter):
+        return cls(workers=2, flush_interval=0.01, backoff_base=0.01, backoff_max=0.05)
+
+    def contents(self, session_key):
+        return [message["content"] for message in Message.objects.history_window(session_key, 100)]
+
+    def test_saves_each_sessions_messages_in_order(self):
+        writer = self.writer()
+        for number in range(12):
+            writer.enqueue("session-a" if number % 3 else "session-b", turn(number))
+            time.sleep(0.005)  # Spread the turns over several batches
+        self.assertTrue(writer.flush(5))
+
+        self.assertEqual(self.contents("session-a"), [
+            text for number in range(12) if number % 3 for text in (f"Question {number}", f"Answer {number}")
+        ])
+        self.assertEqual(self.contents("session-b"), [
+            text for number in (0, 3, 6, 9) for text in (f"Question {number}", f"Answer {number}")
+        ])
+
+    def test_clear_drops_pending_writes(self):
+        writer = self.writer()
+        writer.enqueue("session-a", turn(1))
+        self.assertTrue(writer.flush(5))
+
+        writer.enqueue("session-a", turn(2))
+        writer.clear("session-a")
+        writer.enqueue("session-a", turn(3))
+        self.assertTrue(writer.flush(5))
+
+        self.assertEqual(self.contents("session-a"), ["Question 3", "Answer 3"])
+
+    def test_clear_is_not_overtaken_by_a_save_in_progress(self):
+        writer = self.writer(SlowHistoryWriter)
+        writer.enqueue("session-a", turn(1))
+        self.assertTrue(writer.saving.wait(5))
+
+        clearing = threading.Thread(target=writer.clear, args=("session-a",))
+        clearing.start()
+        time.sleep(0.05)  # The clear waits behind the batch being saved
+        writer.release.set()
+        clearing.join(5)
+        self.assertTrue(writer.flush(5))
+
+        self.assertEqual(self.contents("session-a"), [])
+
+    def test_history_window(self):
+        writer = self.writer()
+        writer.enqueue("session-a", turn(1) + turn(2, image="a" * 64) + turn(3))
+        writer.enqueue("session-b", turn(4))
+        self.assertTrue(writer.flush(5))
+
+        self.assertEqual(Message.objects.history_window("session-a", 3), [
+            {"role": "assistant", "content": "Answer 2", "image": None},
+            {"role": "user", "content": "Question 3", "image": None},
+            {"role": "assistant", "content": "Answer 3", "image": None},
+        ])
+        self.assertEqual(Message.objects.history_window("session-a", 4)[0]["image"], "a" * 64)
+        self.assertEqual(Message.objects.history_window("session-a", 0), [])
+        self.assertEqual(Message.objects.history_window("unknown", 3), [])
+        self.assertEqual(Conversation.objects.count(), 2)
+
+
+class AsyncStreamViewTests(TestCase):
+    async def test_text_stream_sends_filtered_tokens(self):
+        fragments = ["Visit https://exa", "mple.com for ", "robotics courses."]
+
+        async def answer(*args):
+            for fragment in fragments:
+                yield fragment
+
+        request = AsyncRequestFactory().post("/chat/text/stream/", {"query": "Courses?"},
+                                             content_type="application/json")
+        request.session = SessionStore()
+        with mock.patch.object(views, "astream_chatbot_response", answer), \
+                mock.patch.object(views, "HISTORY_WRITER") as writer:
+            response = await views.AsyncTextOnlyChatbotStreamView.as_view()(request)
+            self.assertTrue(response.is_async)
+            body = "".join([chunk.decode() async for chunk in response.streaming_content])
+
+        events = [json.loads(message.split("\n")[1][len("data: "):]) for message in body.strip().split("\n\n")]
+        tokens = [event["token"] for event in events[:-1]]
+        self.assertGreater(len(tokens), 1)
+        self.assertEqual("".join(tokens), views.filter_response("".join(fragments)))
+        self.assertEqual(events[-1], {"response": "".join(tokens)})
+        writer.enqueue.assert_called_once()
+
+
+class FakeAzureHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        deployment = self.path.split("/")[3]
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.calls.append(deployment)
+        script = self.server.scripts[deployment]
+        status, headers, delay, *trickle = script.pop(0) if len(script) > 1 else script[0]
+        time.sleep(delay)
+        if status == 200 and request.get("stream"):
+            return self.send_stream(deployment)
+        if status != 200:
+            body = json.dumps({"error": {"code": str(status), "message": "Scripted failure"}}).encode()
+        else:
+            body = json.dumps({
+                "id": "chatcmpl-test", "object": "chat.completion", "created": 0, "model": deployment,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": f"Answer from {deployment}"}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 3, "total_tokens": 13},
+            }).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        # With a trickle interval the body is sent a few bytes at a time
+        step = 8 if trickle else len(body)
+        for start in range(0, len(body), step):
+            self.wfile.write(body[start:start + step])
+            self.wfile.flush()
+            if trickle:
+                time.sleep(trickle[0])
+
+    def send_stream(self, deployment):
+        """Answer as Server-Sent Events, one chunk per word"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for word in ["Answer ", "from ", deployment]:
+            chunk = {
+                "id": "chatcmpl-test", "object": "chat.completion.chunk", "created": 0, "model": deployment,
+                "choices": [{"index": 0, "finish_reason": None, "delta": {"content": word}}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeAzureServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the Azure OpenAI chat completions endpoint. scripts maps a
+    deployment to its (status, headers, delay[, trickle]) responses, the last one repeating.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeAzureHandler)
+        self.scripts = {}
+        self.calls = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def handle_error(self, request, client_address):
+        pass  # Clients that timed out have closed the connection
+
+
+class ResilientLLMTests(SimpleTestCase):
+    def setUp(self):
+        self.server = FakeAzureServer()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.client = AzureOpenAI(azure_endpoint=self.server.url, api_key="test",
+                                  api_version="2025-01-01-preview", max_retries=0)
+        self.addCleanup(self.client.close)
+        # Used on LLM_LOOP, where sync completions are attempted
+        self.async_client = AsyncAzureOpenAI(azure_endpoint=self.server.url, api_key="test",
+                                             api_version="2025-01-01-preview", max_retries=0)
+        self.addCleanup(lambda: LLM_LOOP.run(self.async_client.close()))
+        self.sleeps = []
+        self.now = 0.0
+
+    def llm(self, deployments=("primary",), **kwargs):
+        kwargs.setdefault("breaker", CircuitBreaker(clock=lambda: self.now))
+        return ResilientLLM(lambda: self.client, lambda: self.async_client, deployments,
+                            sleep=self.sleeps.append, **kwargs)
+
+    def complete(self, llm):
+        return llm.complete(model="ignored", messages=[{"role": "user", "content": "Hi"}])
+
+    def test_retries_rate_limit_after_retry_after(self):
+        self.server.scripts["primary"] = [(429, {"Retry-After": "3"}, 0), (200, {}, 0)]
+        completion = self.complete(self.llm())
+
+        self.assertEqual(completion.choices[0].message.content, "Answer from primary")
+        self.assertEqual(self.server.calls, ["primary", "primary"])
+        self.assertEqual(self.sleeps, [3.0])
+
+    def test_retries_attempt_that_misses_its_deadline(self):
+        self.server.scripts["primary"] = [(200, {}, 1.0), (200, {}, 0)]
+        completion = self.complete(self.llm(attempt_timeout=0.2))
+
+        self.assertEqual(completion.choices[0].message.content, "Answer from primary")
+        self.assertEqual(len(self.sleeps), 1)
+
+    def test_deadline_covers_whole_attempt(self):
+        # Every read returns within the timeout, but the body takes about 1.5s in total
+        self.server.scripts["primary"] = [(200, {}, 0, 0.05), (200, {}, 0)]
+        started = time.perf_counter()
+        completion = self.complete(self.llm(attempt_timeout=0.3))
+
+        self.assertEqual(completion.choices[0].message.content, "Answer from primary")
+        self.assertEqual(len(self.sleeps), 1)
+        self.assertLess(time.perf_counter() - started, 1.0)
+
+    def test_does_not_retry_client_errors(self):
+        self.server.scripts["primary"] = [(400, {}, 0)]
+        llm = self.llm()
+
+        with self.assertRaises(Exception):
+            self.complete(llm)
+        self.assertEqual(self.server.calls, ["primary"])
+        self.assertEqual(llm.breaker.state, "closed")
+
+    def test_hedges_slow_deployment(self):
+        self.server.scripts["primary"] = [(200, {}, 1.0)]
+        self.server.scripts["secondary"] = [(200, {}, 0)]
+        started = time.perf_counter()
+        completion = self.complete(self.llm(("primary", "secondary"), hedge_delay=0.1))
+
+        self.assertEqual(completion.choices[0].message.content, "Answer from secondary")
+        self.assertLess(time.perf_counter() - started, 0.9)
+
+    def test_async_hedge_cancels_losing_request(self):
+        self.server.scripts["primary"] = [(200, {}, 1.0)]
+        self.server.scripts["secondary"] = [(200, {}, 0)]
+
+        async def run():
+            async with AsyncAzureOpenAI(azure_endpoint=self.server.url, api_key="test",
+                                        api_version="2025-01-01-preview", max_retries=0) as client:
+                llm = ResilientLLM(None, lambda: client, ["primary", "secondary"], hedge_delay=0.1)
+                return await llm.acomplete(model="ignored", messages=[{"role": "user", "content": "Hi"}])
+
+        completion = asyncio.run(run())
+        self.assertEqual(completion.choices[0].message.content, "Answer from secondary")
+
+    def test_circuit_opens_then_lets_one_trial_through(self):
+        self.server.scripts["primary"] = [(503, {}, 0)]
+        llm = self.llm(max_retries=0, breaker=CircuitBreaker(failure_threshold=2, reset_timeout=30,
+                                                             clock=lambda: self.now))
+        for _ in range(2):
+            with self.assertRaises(Exception):
+                self.complete(llm)
+
+        with self.assertRaises(CircuitOpenError):
+            self.complete(llm)
+        self.assertEqual(len(self.server.calls), 2)
+
+        self.now += 30
+        self.server.scripts["primary"] = [(200, {}, 0)]
+        self.assertEqual(llm.breaker.state, "half-open")
+        self.complete(llm)
+        self.assertEqual(llm.breaker.state, "closed")
+
+    def test_async_stream_retries_until_first_chunk(self):
+        self.server.scripts["primary"] = [(503, {}, 0), (200, {}, 0)]
+
+        async def run():
+            async with AsyncAzureOpenAI(azure_endpoint=self.server.url, api_key="test",
+                                        api_version="2025-01-01-preview", max_retries=0) as client:
+                llm = ResilientLLM(None, lambda: client, ["primary"], backoff_base=0.01)
+                chunks = llm.astream(model="ignored", messages=[{"role": "user", "content": "Hi"}])
+                return [chunk.choices[0].delta.content async for chunk in chunks]
+
+        self.assertEqual(asyncio.run(run()), ["Answer ", "from ", "primary"])
+        self.assertEqual(self.server.calls, ["primary", "primary"])
@@ -0,0 +1,39 @@
+from functools import lru_cache
+
+# Encoding of the embedding models (text-embedding-ada-002 / -3-*)
+EMBEDDING_ENCODING = "cl100k_base"
+
+# Encoding of the GPT-4o family chat deployments
+CHAT_ENCODING = "o200k_base"
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str):
+    """tiktoken encoding by name, or None if tiktoken or its encoding file is unavailable"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        print(f"tiktoken encoding {name} unavailable, estimating token counts: {str(e)}")
+        return None
+
+
+def count_tokens(text: str, encoding_name: str = EMBEDDING_ENCODING) -> int:
+    """Token count of the text (rough 4 characters per token estimate without tiktoken)"""
+    if not text:
+        return 0
+    encoding = get_encoding(encoding_name)
+    if encoding is None:
+        return max(1, len(text) // 4)
+    return len(encoding.encode(text))
+
+
+def truncate_tokens(text: str, max_tokens: int, encoding_name: str = EMBEDDING_ENCODING) -> str:
+    """Longest prefix of the text that fits in max_tokens"""
+    if max_tokens <= 0:
+        return ""
+    encoding = get_encoding(encoding_name)
+    if encoding is None:
+        return text[:max_tokens * 4]
+    tokens = encoding.encode(text)
+    return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
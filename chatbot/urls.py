@@ -1,9 +1,37 @@
+from django.conf import settings
 from django.urls import path, include
-from .views import ChatbotQueryView, ClearChatHistoryView, TextOnlyChatbotView
+from .views import (
+    AsyncChatbotQueryStreamView,
+    AsyncChatbotQueryView,
+    AsyncClearChatHistoryView,
+    AsyncTextOnlyChatbotStreamView,
+    AsyncTextOnlyChatbotView,
+    ChatbotQueryView,
+    ChatbotQueryStreamView,
+    ClearChatHistoryView,
+    MetricsView,
+    TextOnlyChatbotStreamView,
+    TextOnlyChatbotView,
+    VoiceQueryStreamView,
+    VoiceQueryView,
+)
+
+# Under ASGI the async views keep the event loop free during the Azure round trips
+if settings.CHATBOT_ASYNC_VIEWS:
+    query_view, text_view, clear_view = AsyncChatbotQueryView, AsyncTextOnlyChatbotView, AsyncClearChatHistoryView
+    query_stream_view, text_stream_view = AsyncChatbotQueryStreamView, AsyncTextOnlyChatbotStreamView
+else:
+    query_view, text_view, clear_view = ChatbotQueryView, TextOnlyChatbotView, ClearChatHistoryView
+    query_stream_view, text_stream_view = ChatbotQueryStreamView, TextOnlyChatbotStreamView
 
 
 urlpatterns = [
-    path('query-chatbot/', ChatbotQueryView.as_view(), name="Chatbot Query"),
-     path('chat/text/', TextOnlyChatbotView.as_view(), name='chatbot-text-query'),
-    path('clear-history/', ClearChatHistoryView.as_view(), name='clear_history'),
+    path('query-chatbot/', query_view.as_view(), name="Chatbot Query"),
+    path('query-chatbot/stream/', query_stream_view.as_view(), name='chatbot-query-stream'),
+     path('chat/text/', text_view.as_view(), name='chatbot-text-query'),
+    path('chat/text/stream/', text_stream_view.as_view(), name='chatbot-text-stream'),
+    path('voice/', VoiceQueryView.as_view(), name='chatbot-voice-query'),
+    path('voice/stream/', VoiceQueryStreamView.as_view(), name='chatbot-voice-stream'),
+    path('clear-history/', clear_view.as_view(), name='clear_history'),
+    path('metrics', MetricsView.as_view(), name='metrics'),
 ]
\ No newline at end of file
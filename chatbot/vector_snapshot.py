@@ -0,0 +1,82 @@
+import json
+import os
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+
+# Snapshots live next to the Chroma data, one .npy + .json pair per collection version
+VECTOR_SNAPSHOT_DIR = os.path.join(os.path.dirname(__file__), "chroma_db", "vector_snapshot")
+
+
+class VectorSnapshot:
+    """
+    Read-only copy of a collection's embeddings as one contiguous float32 matrix.
+
+    Rows are L2-normalized, so a query is a single matrix-vector dot product (cosine
+    similarity) plus a partial sort. The matrix is memory-mapped, so every worker on
+    the host shares the same page-cache copy and no SQLite lock is taken per query.
+    """
+
+    def __init__(self, matrix: np.ndarray, ids: List[str], texts: List[str], metadatas: List[Dict]):
+        self.matrix = matrix
+        self.ids = ids
+        self.texts = texts
+        self.metadatas = metadatas
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, ids: List[str], embeddings: Sequence[Sequence[float]], texts: List[str],
+              metadatas: Optional[List[Dict]] = None) -> "VectorSnapshot":
+        matrix = np.array(embeddings, dtype=np.float32).reshape(len(ids), -1) if len(ids) else np.zeros((0, 0), np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1.0, norms)
+        return cls(matrix, list(ids), list(texts), metadatas or [{} for _ in ids])
+
+    def search(self, vector: Sequence[float], k: int = 3) -> List[Document]:
+        """Top-k chunks by cosine similarity to the query vector"""
+        if not self.ids:
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        scores = self.matrix @ (query / (np.linalg.norm(query) or 1.0))
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            Document(id=self.ids[i], page_content=self.texts[i], metadata=self.metadatas[i])
+            for i in top
+        ]
+
+    def save(self, collection_name: str):
+        """Write the matrix and its metadata; the .json is written last and marks the pair complete"""
+        matrix_path, meta_path = vector_snapshot_paths(collection_name)
+        os.makedirs(os.path.dirname(matrix_path), exist_ok=True)
+        with open(f"{matrix_path}.tmp", "wb") as f:
+            np.save(f, self.matrix)
+        os.replace(f"{matrix_path}.tmp", matrix_path)
+        with open(f"{meta_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump({
+                "collection": collection_name,
+                "dimensions": int(self.matrix.shape[1]) if self.matrix.ndim == 2 else 0,
+                "ids": self.ids,
+                "texts": self.texts,
+                "metadatas": self.metadatas,
+            }, f, ensure_ascii=False)
+        os.replace(f"{meta_path}.tmp", meta_path)
+
+    @classmethod
+    def load(cls, collection_name: str) -> "VectorSnapshot":
+        matrix_path, meta_path = vector_snapshot_paths(collection_name)
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        matrix = np.load(matrix_path, mmap_mode="r")
+        if matrix.shape[0] != len(meta["ids"]):
+            raise ValueError(f"Snapshot for {collection_name} has {matrix.shape[0]} rows, expected {len(meta['ids'])}")
+        return cls(matrix, meta["ids"], meta["texts"], meta["metadatas"])
+
+
+def vector_snapshot_paths(collection_name: str):
+    base = os.path.join(VECTOR_SNAPSHOT_DIR, collection_name)
+    return f"{base}.npy", f"{base}.json"
@@ -2,21 +2,191 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
-from .chatbot_rag import get_chatbot_response  
-import base64
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from .cache import shared_delete, shared_get, shared_set
+from .chatbot_rag import aget_chatbot_response, astream_chatbot_response, get_chatbot_response, stream_chatbot_response
+from .history import HISTORY_WRITER
+from .image_processing import ImageProcessingError, submit_image
+from .models import Message
+from .session_cache import SessionCache
+from .speech_to_text import SAMPLE_RATE, AudioDecodeError, TranscriptionError, get_recognizer, pcm_chunks
+from .metrics import REGISTRY, observe_request, timed
 from rest_framework.permissions import AllowAny
+import asyncio
+import json
 import os
+import re
 import tempfile
-import threading
 import time
 
 # Session cache with expiration
-SESSION_CACHE = {}
-SESSION_EXPIRY = {}  # Track when cache entries should expire
-SESSION_LOCK = threading.Lock()
 CACHE_EXPIRY_SECONDS = 1800  # 30 minutes
+SESSION_CACHE = SessionCache(**{"ttl": CACHE_EXPIRY_SECONDS, **getattr(settings, "CHATBOT_SESSION_CACHE", {})})
 
-class ChatbotQueryView(APIView):
+# Messages of chat history kept per session
+HISTORY_MESSAGES = 6
+
+
+def history_cache_key(session_key):
+    """Key of a session's chat history in the shared cache"""
+    return f"history:{session_key}"
+
+
+def filter_response(response):
+    """Filter out links and brackets from response"""
+    # Replace URLs with a placeholder
+    url_pattern = r'https?://[^\s<>"\')]+|www\.[^\s<>"\')]+\.[^\s<>"\')]+' 
+    filtered_text = re.sub(url_pattern, "[link removed]", response)
+    
+    # Remove brackets and their contents
+    bracket_pattern = r'\[.*?\]'
+    filtered_text = re.sub(bracket_pattern, "", filtered_text)
+    
+    # Clean up any extra whitespace caused by the removals
+    filtered_text = re.sub(r'\s+', ' ', filtered_text)
+    filtered_text = filtered_text.strip()
+    
+    return filtered_text
+
+
+class StreamFilter:
+    """
+    Apply filter_response to a token stream.
+
+    Text is released a whole word at a time, since a URL is only recognisable once
+    it is complete. Words are re-joined with single spaces, matching the whitespace
+    collapsing of the non-streaming filter.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.started = False
+
+    def feed(self, fragment):
+        """Filtered text of the words completed by fragment ('' if none)"""
+        self.buffer += fragment
+        boundary = max(self.buffer.rfind(" "), self.buffer.rfind("\n"), self.buffer.rfind("\t"))
+        if boundary == -1:
+            return ""
+        ready, self.buffer = self.buffer[:boundary], self.buffer[boundary:]
+        return self._release(ready)
+
+    def flush(self):
+        """Filtered text of the last word"""
+        ready, self.buffer = self.buffer, ""
+        return self._release(ready)
+
+    def _release(self, text):
+        filtered = filter_response(text)
+        if not filtered:
+            return ""
+        filtered = (" " if self.started else "") + filtered
+        self.started = True
+        return filtered
+
+
+def filter_stream(fragments):
+    """Apply filter_response to a token stream (see StreamFilter)"""
+    stream_filter = StreamFilter()
+    for fragment in fragments:
+        filtered = stream_filter.feed(fragment)
+        if filtered:
+            yield filtered
+    filtered = stream_filter.flush()
+    if filtered:
+        yield filtered
+
+
+async def afilter_stream(fragments):
+    """Async version of filter_stream"""
+    stream_filter = StreamFilter()
+    async for fragment in fragments:
+        filtered = stream_filter.feed(fragment)
+        if filtered:
+            yield filtered
+    filtered = stream_filter.flush()
+    if filtered:
+        yield filtered
+
+
+def image_hash(image_data):
+    """Content hash recorded in the history instead of the image itself"""
+    return image_data.content_hash if image_data else None
+
+
+def load_history(session_key, request):
+    """Chat history from the conversation store, or a session saved before it existed"""
+    chat_history = Message.objects.history_window(session_key, HISTORY_MESSAGES)
+    return chat_history or request.session.get('chat_history', [])
+
+
+def update_history(session_key, chat_history, user_message, response):
+    """
+    Append a turn to the session's chat history.
+
+    The in-process and shared caches are updated before returning, so the next request
+    sees the turn at once; the messages are appended to the conversation store by the
+    HISTORY_WRITER pool.
+    """
+    new_messages = [user_message, {'role': 'assistant', 'content': response}]
+
+    def append(current_history):
+        # Start from the latest chat history (it might have been updated by other requests)
+        HISTORY_WRITER.enqueue(session_key, new_messages)
+        return ((chat_history if current_history is None else current_history) + new_messages)[-HISTORY_MESSAGES:]
+
+    current_history = SESSION_CACHE.update(session_key, append)
+    shared_set(history_cache_key(session_key), current_history, CACHE_EXPIRY_SECONDS)
+    return current_history
+
+
+def cached_chat_history(session_key):
+    """
+    The session's chat history if this worker has it cached, else None: the response's
+    history stage then loads it while the context is retrieved.
+    """
+    chat_history = SESSION_CACHE.get(session_key)
+    return chat_history.copy() if chat_history is not None else None
+
+
+def sse_event(event, data):
+    """Format a Server-Sent Events message with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def sse_response(events):
+    """Wrap an iterator (or async iterator) of SSE messages in an unbuffered streaming response"""
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Disable proxy buffering (nginx)
+    return response
+
+
+class ChatHistoryMixin:
+    """Chat history lookup shared by the sync views"""
+
+    def _get_chat_history(self, session_key, request):
+        """Cached chat history of the session; a miss reads the shared cache, then the store"""
+        chat_history = SESSION_CACHE.get(session_key)
+        if chat_history is None:
+            # Another worker may have served this session already
+            chat_history = shared_get(history_cache_key(session_key))
+            if chat_history is None:
+                chat_history = load_history(session_key, request)
+            chat_history = SESSION_CACHE.setdefault(session_key, chat_history)
+        return chat_history.copy()  # Return a copy to avoid race conditions
+
+    def _history_loader(self, request):
+        """Loads a session's chat history in the response's history stage"""
+        return lambda session_key: self._get_chat_history(session_key, request)
+
+
+class ChatbotQueryView(ChatHistoryMixin, APIView):
     """Endpoint for multipart requests (text and/or image)"""
     permission_classes = [AllowAny]
     parser_classes = (MultiPartParser, FormParser)  # Support file uploads
@@ -33,37 +203,40 @@ class ChatbotQueryView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
+        if image and not image.content_type.startswith('image/'):
+            return Response(
+                {'error': 'Invalid file type. Please upload an image'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
         try:
+            # Downscale and re-encode the image on the image pool while the history loads and the context is retrieved
+            image_future = submit_image(image) if image else None
+
             # Use session key as cache key
             session_key = request.session.session_key
             if not session_key:
                 request.session.create()
                 session_key = request.session.session_key
 
-            # Get chat history from cache with expiry management
-            chat_history = self._get_chat_history(session_key, request)
+            # Get chat history from cache with expiry management (on a miss it loads during retrieval)
+            with timed("session"):
+                chat_history = cached_chat_history(session_key)
 
-            # Prepare image data if provided
-            image_data = None
-            if image:
-                if not image.content_type.startswith('image/'):
-                    return Response(
-                        {'error': 'Invalid file type. Please upload an image'},
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
-                # Convert image to base64 for Azure OpenAI
-                image_data = base64.b64encode(image.read()).decode('utf-8')
-
-            # Generate response
-            response = get_chatbot_response(query, image_data, chat_history)
+            # Generate response (retrieval runs while the image is still being preprocessed)
+            response = get_chatbot_response(query, image_future, chat_history, session_key, self._history_loader(request))
+            image_data = image_future.result() if image_future else None
+            if chat_history is None:
+                chat_history = self._get_chat_history(session_key, request)
 
             # Update chat history in background (non-blocking)
             self._update_history_async(session_key, request, query, response, image_data, chat_history)
 
-            processing_time = time.time() - start_time
-            print(f"Response processed in {processing_time:.2f}s")
+            observe_request("query", time.time() - start_time)
             return Response({'response': response}, status=status.HTTP_200_OK)
 
+        except ImageProcessingError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             print(f"Error: {str(e)}")
             return Response(
@@ -71,60 +244,15 @@ class ChatbotQueryView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
-    def _get_chat_history(self, session_key, request):
-        """Get chat history with cache expiry management"""
-        with SESSION_LOCK:
-            # Clean expired cache entries
-            current_time = time.time()
-            expired_keys = [k for k, v in SESSION_EXPIRY.items() if v < current_time]
-            for k in expired_keys:
-                if k in SESSION_CACHE:
-                    del SESSION_CACHE[k]
-                if k in SESSION_EXPIRY:
-                    del SESSION_EXPIRY[k]
-            
-            # Get or create chat history
-            if session_key in SESSION_CACHE:
-                chat_history = SESSION_CACHE[session_key]
-            else:
-                chat_history = request.session.get('chat_history', [])
-                SESSION_CACHE[session_key] = chat_history
-                
-            # Update expiry time
-            SESSION_EXPIRY[session_key] = time.time() + CACHE_EXPIRY_SECONDS
-            
-            return chat_history.copy()  # Return a copy to avoid race conditions
-
     def _update_history_async(self, session_key, request, query, response, image_data, chat_history):
-        """Update chat history asynchronously"""
-        def update_history():
-            with SESSION_LOCK:
-                # Get the latest chat history (it might have been updated by other requests)
-                current_history = SESSION_CACHE.get(session_key, chat_history)
-                
-                # Append new messages
-                current_history.append({
-                    'role': 'user',
-                    'content': query,
-                    'image': True if image_data else None
-                })
-                current_history.append({'role': 'assistant', 'content': response})
-                
-                # Limit to last 6 messages
-                current_history = current_history[-6:]
-                
-                # Update cache
-                SESSION_CACHE[session_key] = current_history
-                
-                # Update session
-                request.session['chat_history'] = current_history
-                request.session.modified = True
-        
-        thread = threading.Thread(target=update_history)
-        thread.daemon = True
-        thread.start()
+        """Update the cached chat history now; HISTORY_WRITER appends the turn to the conversation store"""
+        update_history(session_key, chat_history, {
+            'role': 'user',
+            'content': query,
+            'image': image_hash(image_data)
+        }, response)
 
-class TextOnlyChatbotView(APIView):
+class TextOnlyChatbotView(ChatHistoryMixin, APIView):
     """Endpoint for text-only JSON requests (more efficient)"""
     permission_classes = [AllowAny]
     parser_classes = (JSONParser,)  # Support JSON requests only
@@ -147,11 +275,14 @@ class TextOnlyChatbotView(APIView):
                 request.session.create()
                 session_key = request.session.session_key
 
-            # Get chat history from cache with expiry management
-            chat_history = self._get_chat_history(session_key, request)
+            # Get chat history from cache with expiry management (on a miss it loads during retrieval)
+            with timed("session"):
+                chat_history = cached_chat_history(session_key)
 
             # Generate response (no image data for this endpoint)
-            response = get_chatbot_response(query, None, chat_history)
+            response = get_chatbot_response(query, None, chat_history, session_key, self._history_loader(request))
+            if chat_history is None:
+                chat_history = self._get_chat_history(session_key, request)
             
             # Filter out links and brackets from response
             filtered_response = self._filter_response(response)
@@ -159,8 +290,7 @@ class TextOnlyChatbotView(APIView):
             # Update chat history in background (non-blocking)
             self._update_history_async(session_key, request, query, filtered_response, chat_history)
 
-            processing_time = time.time() - start_time
-            print(f"Text-only response processed in {processing_time:.2f}s")
+            observe_request("text", time.time() - start_time)
             return Response({'response': filtered_response}, status=status.HTTP_200_OK)
 
         except Exception as e:
@@ -172,70 +302,229 @@ class TextOnlyChatbotView(APIView):
 
     def _filter_response(self, response):
         """Filter out links and brackets from response"""
-        import re
-        
-        # Replace URLs with a placeholder
-        url_pattern = r'https?://[^\s<>"\')]+|www\.[^\s<>"\')]+\.[^\s<>"\')]+' 
-        filtered_text = re.sub(url_pattern, "[link removed]", response)
-        
-        # Remove brackets and their contents
-        bracket_pattern = r'\[.*?\]'
-        filtered_text = re.sub(bracket_pattern, "", filtered_text)
-        
-        # Clean up any extra whitespace caused by the removals
-        filtered_text = re.sub(r'\s+', ' ', filtered_text)
-        filtered_text = filtered_text.strip()
-        
-        return filtered_text
-
-    def _get_chat_history(self, session_key, request):
-        """Get chat history with cache expiry management"""
-        with SESSION_LOCK:
-            # Clean expired cache entries
-            current_time = time.time()
-            expired_keys = [k for k, v in SESSION_EXPIRY.items() if v < current_time]
-            for k in expired_keys:
-                if k in SESSION_CACHE:
-                    del SESSION_CACHE[k]
-                if k in SESSION_EXPIRY:
-                    del SESSION_EXPIRY[k]
-            
-            # Get or create chat history
-            if session_key in SESSION_CACHE:
-                chat_history = SESSION_CACHE[session_key]
-            else:
-                chat_history = request.session.get('chat_history', [])
-                SESSION_CACHE[session_key] = chat_history
-                
-            # Update expiry time
-            SESSION_EXPIRY[session_key] = time.time() + CACHE_EXPIRY_SECONDS
-            
-            return chat_history.copy()  # Return a copy to avoid race conditions
+        return filter_response(response)
 
     def _update_history_async(self, session_key, request, query, response, chat_history):
-        """Update chat history asynchronously"""
-        def update_history():
-            with SESSION_LOCK:
-                # Get the latest chat history (it might have been updated by other requests)
-                current_history = SESSION_CACHE.get(session_key, chat_history)
-                
-                # Append new messages
-                current_history.append({'role': 'user', 'content': query})
-                current_history.append({'role': 'assistant', 'content': response})
-                
-                # Limit to last 6 messages
-                current_history = current_history[-6:]
-                
-                # Update cache
-                SESSION_CACHE[session_key] = current_history
-                
-                # Update session
-                request.session['chat_history'] = current_history
-                request.session.modified = True
-        
-        thread = threading.Thread(target=update_history)
-        thread.daemon = True
-        thread.start()
+        """Update the cached chat history now; HISTORY_WRITER appends the turn to the conversation store"""
+        update_history(session_key, chat_history, {'role': 'user', 'content': query}, response)
+
+class ChatbotQueryStreamView(ChatbotQueryView):
+    """Streaming (SSE) variant of ChatbotQueryView"""
+
+    def post(self, request):
+        query = request.data.get('query', '')
+        image = request.FILES.get('image')
+
+        # Validate: at least one of query or image must be provided
+        if not query and not image:
+            return Response(
+                {'error': 'At least one of query or image is required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if image and not image.content_type.startswith('image/'):
+            return Response(
+                {'error': 'Invalid file type. Please upload an image'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        image_future = submit_image(image) if image else None
+
+        session_key = request.session.session_key
+        if not session_key:
+            request.session.create()
+            session_key = request.session.session_key
+        with timed("session"):
+            chat_history = cached_chat_history(session_key)
+
+        image_data = None
+        if image_future:
+            try:
+                with timed("image"):
+                    image_data = image_future.result()
+            except ImageProcessingError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        def events():
+            start_time = time.time()
+            fragments = []
+            for fragment in stream_chatbot_response(query, image_data, chat_history, session_key,
+                                                    self._history_loader(request)):
+                fragments.append(fragment)
+                yield sse_event('token', {'token': fragment})
+            response = "".join(fragments)
+            yield sse_event('done', {'response': response})
+
+            history = chat_history if chat_history is not None else self._get_chat_history(session_key, request)
+            self._update_history_async(session_key, request, query, response, image_data, history)
+            observe_request("query_stream", time.time() - start_time)
+
+        return sse_response(events())
+
+class TextOnlyChatbotStreamView(TextOnlyChatbotView):
+    """Streaming (SSE) variant of TextOnlyChatbotView"""
+
+    def post(self, request):
+        query = request.data.get('query', '')
+
+        # Validate query
+        if not query:
+            return Response(
+                {'error': 'Query is required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        session_key = request.session.session_key
+        if not session_key:
+            request.session.create()
+            session_key = request.session.session_key
+        with timed("session"):
+            chat_history = cached_chat_history(session_key)
+
+        def events():
+            start_time = time.time()
+            fragments = []
+            responses = stream_chatbot_response(query, None, chat_history, session_key, self._history_loader(request))
+            for fragment in self._filter_stream(responses):
+                fragments.append(fragment)
+                yield sse_event('token', {'token': fragment})
+            response = "".join(fragments)
+            yield sse_event('done', {'response': response})
+
+            history = chat_history if chat_history is not None else self._get_chat_history(session_key, request)
+            self._update_history_async(session_key, request, query, response, history)
+            observe_request("text_stream", time.time() - start_time)
+
+        return sse_response(events())
+
+    def _filter_stream(self, fragments):
+        """Apply _filter_response to a token stream"""
+        return filter_stream(fragments)
+
+class VoiceQueryView(ChatHistoryMixin, APIView):
+    """Endpoint for spoken queries: transcribes an audio upload and answers it as text"""
+    permission_classes = [AllowAny]
+    parser_classes = (MultiPartParser,)
+    recognizer = None  # Defaults to the shared Azure recognizer
+
+    def post(self, request):
+        start_time = time.time()
+        audio = request.FILES.get('audio')
+
+        if not audio:
+            return Response({'error': 'Audio file is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            # Decoded in memory block by block, while the first blocks are being recognized
+            with timed("transcribe"):
+                query, language = self._get_recognizer().transcribe(pcm_chunks(audio), SAMPLE_RATE)
+
+            session_key = request.session.session_key
+            if not session_key:
+                request.session.create()
+                session_key = request.session.session_key
+
+            with timed("session"):
+                chat_history = cached_chat_history(session_key)
+
+            response = filter_response(
+                get_chatbot_response(query, None, chat_history, session_key, self._history_loader(request))
+            )
+            if chat_history is None:
+                chat_history = self._get_chat_history(session_key, request)
+            update_history(session_key, chat_history, {'role': 'user', 'content': query}, response)
+
+            observe_request("voice", time.time() - start_time)
+            return Response(
+                {'transcript': query, 'language': language, 'response': response},
+                status=status.HTTP_200_OK
+            )
+
+        except AudioDecodeError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except TranscriptionError as e:
+            return Response({'error': str(e)}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            return Response(
+                {'error': f'An error occurred: {str(e)}'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        finally:
+            # Release a spooled upload's temporary file now rather than at garbage collection
+            audio.close()
+
+    def _get_recognizer(self):
+        return self.recognizer or get_recognizer()
+
+class VoiceQueryStreamView(VoiceQueryView):
+    """
+    Streaming (SSE) variant of VoiceQueryView.
+
+    Sends "partial" events with the recognizer's running hypothesis and a "segment" event
+    for each recognized utterance, then a "transcript" event once the audio ends, after
+    which the answer is streamed like TextOnlyChatbotStreamView.
+    """
+
+    def post(self, request):
+        audio = request.FILES.get('audio')
+
+        if not audio:
+            return Response({'error': 'Audio file is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Format and size are checked before the stream starts; decoding happens as it is recognized
+        try:
+            chunks = pcm_chunks(audio)
+            recognizer = self._get_recognizer()
+        except AudioDecodeError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except TranscriptionError as e:
+            return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        session_key = request.session.session_key
+        if not session_key:
+            request.session.create()
+            session_key = request.session.session_key
+        with timed("session"):
+            chat_history = cached_chat_history(session_key)
+
+        def events():
+            start_time = time.time()
+            segments = []
+            language = None
+            try:
+                with timed("transcribe"):
+                    for event in recognizer.stream(chunks, SAMPLE_RATE):
+                        if event.kind == "final":
+                            segments.append(event.text)
+                            language = language or event.language
+                            yield sse_event('segment', {'text': event.text, 'language': event.language})
+                        else:
+                            yield sse_event('partial', {'text': event.text})
+            except TranscriptionError as e:
+                yield sse_event('error', {'error': str(e)})
+                return
+            finally:
+                audio.close()
+            if not segments:
+                yield sse_event('error', {'error': 'No speech could be recognized'})
+                return
+
+            query = " ".join(segments)
+            yield sse_event('transcript', {'text': query, 'language': language})
+
+            fragments = []
+            responses = stream_chatbot_response(query, None, chat_history, session_key, self._history_loader(request))
+            for fragment in filter_stream(responses):
+                fragments.append(fragment)
+                yield sse_event('token', {'token': fragment})
+            response = "".join(fragments)
+            yield sse_event('done', {'response': response})
+
+            history = chat_history if chat_history is not None else self._get_chat_history(session_key, request)
+            update_history(session_key, history, {'role': 'user', 'content': query}, response)
+            observe_request("voice_stream", time.time() - start_time)
+
+        return sse_response(events())
 
 class ClearChatHistoryView(APIView):
     """Endpoint to clear chat history"""
@@ -251,10 +540,234 @@ class ClearChatHistoryView(APIView):
                 request.session.modified = True
             
             # Clear from cache
-            with SESSION_LOCK:
-                if session_key in SESSION_CACHE:
-                    del SESSION_CACHE[session_key]
-                if session_key in SESSION_EXPIRY:
-                    del SESSION_EXPIRY[session_key]
+            SESSION_CACHE.pop(session_key)
+            shared_delete(history_cache_key(session_key))
+            HISTORY_WRITER.clear(session_key)
         
-        return Response({'message': 'Chat history cleared'}, status=status.HTTP_200_OK)
\ No newline at end of file
+        return Response({'message': 'Chat history cleared'}, status=status.HTTP_200_OK)
+
+
+class AsyncChatHistoryMixin:
+    """Session history helpers for the native async views"""
+
+    async def _asession_key(self, request):
+        session_key = request.session.session_key
+        if not session_key:
+            await request.session.acreate()
+            session_key = request.session.session_key
+        return session_key
+
+    async def _aget_chat_history(self, session_key, request):
+        """Async version of _get_chat_history; only a cache miss touches the session store"""
+        chat_history = SESSION_CACHE.get(session_key)
+        if chat_history is not None:
+            return chat_history.copy()
+
+        chat_history = await sync_to_async(shared_get)(history_cache_key(session_key))
+        if chat_history is None:
+            chat_history = await sync_to_async(Message.objects.history_window)(session_key, HISTORY_MESSAGES)
+        if not chat_history:
+            chat_history = await request.session.aget('chat_history', [])
+        return SESSION_CACHE.setdefault(session_key, chat_history).copy()
+
+    def _ahistory_loader(self, request):
+        """Loads a session's chat history in the response's history stage"""
+        return lambda session_key: self._aget_chat_history(session_key, request)
+
+    async def _aupdate_history(self, session_key, request, chat_history, user_message, response):
+        """Async version of update_history (the shared cache write runs in a thread)"""
+        await sync_to_async(update_history)(session_key, chat_history, user_message, response)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncChatbotQueryView(AsyncChatHistoryMixin, View):
+    """Native async version of ChatbotQueryView (multipart text and/or image)"""
+
+    async def post(self, request):
+        start_time = time.time()
+        query = request.POST.get('query', '')
+        image = request.FILES.get('image')
+
+        # Validate: at least one of query or image must be provided
+        if not query and not image:
+            return JsonResponse({'error': 'At least one of query or image is required'}, status=400)
+
+        if image and not image.content_type.startswith('image/'):
+            return JsonResponse({'error': 'Invalid file type. Please upload an image'}, status=400)
+
+        try:
+            # Preprocessed on the image pool while the history loads and the context is retrieved
+            image_future = submit_image(image) if image else None
+
+            session_key = await self._asession_key(request)
+            with timed("session"):
+                chat_history = cached_chat_history(session_key)
+
+            response = await aget_chatbot_response(
+                query, image_future, chat_history, session_key, self._ahistory_loader(request)
+            )
+            image_data = image_future.result() if image_future else None
+            if chat_history is None:
+                chat_history = await self._aget_chat_history(session_key, request)
+            await self._aupdate_history(
+                session_key, request, chat_history,
+                {'role': 'user', 'content': query, 'image': image_hash(image_data)},
+                response
+            )
+
+            observe_request("query", time.time() - start_time)
+            return JsonResponse({'response': response})
+
+        except ImageProcessingError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            return JsonResponse({'error': f'An error occurred: {str(e)}'}, status=500)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncTextOnlyChatbotView(AsyncChatHistoryMixin, View):
+    """Native async version of TextOnlyChatbotView (JSON text queries)"""
+
+    async def post(self, request):
+        start_time = time.time()
+        try:
+            query = json.loads(request.body or b'{}').get('query', '')
+        except (ValueError, AttributeError):
+            return JsonResponse({'error': 'Invalid JSON body'}, status=400)
+
+        # Validate query
+        if not query:
+            return JsonResponse({'error': 'Query is required'}, status=400)
+
+        try:
+            session_key = await self._asession_key(request)
+            with timed("session"):
+                chat_history = cached_chat_history(session_key)
+
+            response = await aget_chatbot_response(query, None, chat_history, session_key, self._ahistory_loader(request))
+            if chat_history is None:
+                chat_history = await self._aget_chat_history(session_key, request)
+            filtered_response = filter_response(response)
+            await self._aupdate_history(
+                session_key, request, chat_history, {'role': 'user', 'content': query}, filtered_response
+            )
+
+            observe_request("text", time.time() - start_time)
+            return JsonResponse({'response': filtered_response})
+
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            return JsonResponse({'error': f'An error occurred: {str(e)}'}, status=500)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncChatbotQueryStreamView(AsyncChatHistoryMixin, View):
+    """Native async version of ChatbotQueryStreamView; the response is an async generator"""
+
+    async def post(self, request):
+        query = request.POST.get('query', '')
+        image = request.FILES.get('image')
+
+        # Validate: at least one of query or image must be provided
+        if not query and not image:
+            return JsonResponse({'error': 'At least one of query or image is required'}, status=400)
+
+        if image and not image.content_type.startswith('image/'):
+            return JsonResponse({'error': 'Invalid file type. Please upload an image'}, status=400)
+        image_future = submit_image(image) if image else None
+
+        session_key = await self._asession_key(request)
+        with timed("session"):
+            chat_history = cached_chat_history(session_key)
+
+        image_data = None
+        if image_future:
+            try:
+                with timed("image"):
+                    image_data = await asyncio.wrap_future(image_future)
+            except ImageProcessingError as e:
+                return JsonResponse({'error': str(e)}, status=400)
+
+        async def events():
+            start_time = time.time()
+            fragments = []
+            async for fragment in astream_chatbot_response(query, image_data, chat_history, session_key,
+                                                           self._ahistory_loader(request)):
+                fragments.append(fragment)
+                yield sse_event('token', {'token': fragment})
+            response = "".join(fragments)
+            yield sse_event('done', {'response': response})
+
+            history = chat_history if chat_history is not None else await self._aget_chat_history(session_key, request)
+            await self._aupdate_history(
+                session_key, request, history,
+                {'role': 'user', 'content': query, 'image': image_hash(image_data)},
+                response
+            )
+            observe_request("query_stream", time.time() - start_time)
+
+        return sse_response(events())
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncTextOnlyChatbotStreamView(AsyncChatHistoryMixin, View):
+    """Native async version of TextOnlyChatbotStreamView"""
+
+    async def post(self, request):
+        try:
+            query = json.loads(request.body or b'{}').get('query', '')
+        except (ValueError, AttributeError):
+            return JsonResponse({'error': 'Invalid JSON body'}, status=400)
+
+        # Validate query
+        if not query:
+            return JsonResponse({'error': 'Query is required'}, status=400)
+
+        session_key = await self._asession_key(request)
+        with timed("session"):
+            chat_history = cached_chat_history(session_key)
+
+        async def events():
+            start_time = time.time()
+            fragments = []
+            responses = astream_chatbot_response(query, None, chat_history, session_key, self._ahistory_loader(request))
+            async for fragment in afilter_stream(responses):
+                fragments.append(fragment)
+                yield sse_event('token', {'token': fragment})
+            response = "".join(fragments)
+            yield sse_event('done', {'response': response})
+
+            history = chat_history if chat_history is not None else await self._aget_chat_history(session_key, request)
+            await self._aupdate_history(
+                session_key, request, history, {'role': 'user', 'content': query}, response
+            )
+            observe_request("text_stream", time.time() - start_time)
+
+        return sse_response(events())
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncClearChatHistoryView(View):
+    """Native async version of ClearChatHistoryView"""
+
+    async def post(self, request):
+        session_key = request.session.session_key
+
+        if session_key:
+            await request.session.apop('chat_history', None)
+            SESSION_CACHE.pop(session_key)
+            await sync_to_async(shared_delete)(history_cache_key(session_key))
+            await sync_to_async(HISTORY_WRITER.clear)(session_key)
+
+        return JsonResponse({'message': 'Chat history cleared'})
+
+
+class MetricsView(View):
+    """
+    Prometheus scrape endpoint for the latency, token and cache metrics: those of all
+    workers with CHATBOT_METRICS_DIR, else of the worker that answers (labelled by pid)
+    """
+
+    def get(self, request):
+        return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
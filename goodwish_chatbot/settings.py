@@ -156,4 +156,159 @@ AZURE_OPENAI_DEPLOYMENT_NAME = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
 AZURE_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_EMBEDDING_DEPLOYMENT")
 AZURE_EMBEDDING_API_VERSION = os.getenv("AZURE_EMBEDDING_API_VERSION")
 
+# Serve the chat routes with the native async views (run under goodwish_chatbot.asgi)
+CHATBOT_ASYNC_VIEWS = os.getenv("CHATBOT_ASYNC_VIEWS", "False").lower() in ("1", "true", "yes")
+
+# Caches shared by all workers on the host. CHATBOT_CACHE_BACKEND selects the
+# chatbot tier: "locmem" (per process), "file" or "sqlite" (shared across workers)
+CHATBOT_CACHE_BACKEND = os.getenv("CHATBOT_CACHE_BACKEND", "sqlite")
+CHATBOT_CACHE_ALIAS = "chatbot"
+CHATBOT_CACHE_BACKENDS = {
+    "locmem": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "goodwish-chatbot",
+    },
+    "file": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": BASE_DIR / "cache" / "chatbot",
+    },
+    "sqlite": {
+        "BACKEND": "chatbot.cache_backends.SQLiteCache",
+        "LOCATION": BASE_DIR / "cache" / "chatbot.sqlite3",
+    },
+}
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    CHATBOT_CACHE_ALIAS: {
+        **CHATBOT_CACHE_BACKENDS[CHATBOT_CACHE_BACKEND],
+        "TIMEOUT": 3600,
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+    # Query embeddings persist on disk so restarts don't start cold
+    "embeddings": {
+        "BACKEND": "chatbot.cache_backends.SQLiteCache",
+        "LOCATION": BASE_DIR / "cache" / "embeddings.sqlite3",
+        "TIMEOUT": None,
+        "OPTIONS": {"MAX_ENTRIES": 50000},
+    },
+}
+
+# Per-process response cache bounds (entries, total bytes, TTL in seconds)
+CHATBOT_RESPONSE_CACHE = {
+    "max_entries": int(os.getenv("CHATBOT_RESPONSE_CACHE_ENTRIES", 1000)),
+    "max_bytes": int(os.getenv("CHATBOT_RESPONSE_CACHE_BYTES", 5 * 1024 * 1024)),
+    "ttl": int(os.getenv("CHATBOT_RESPONSE_CACHE_TTL", 3600)),
+}
+
+# Semantic (paraphrase) answer cache: minimum cosine similarity for a hit
+CHATBOT_SEMANTIC_CACHE = {
+    "threshold": float(os.getenv("CHATBOT_SEMANTIC_CACHE_THRESHOLD", 0.95)),
+    "max_entries": int(os.getenv("CHATBOT_SEMANTIC_CACHE_ENTRIES", 2000)),
+    "ttl": int(os.getenv("CHATBOT_RESPONSE_CACHE_TTL", 3600)),
+}
+# Ingestion embedding pipeline: batch size, concurrent requests and Azure TPM quota
+CHATBOT_INGEST_EMBEDDING = {
+    "batch_size": int(os.getenv("CHATBOT_EMBEDDING_BATCH_SIZE", 64)),
+    "max_workers": int(os.getenv("CHATBOT_EMBEDDING_WORKERS", 4)),
+    "tokens_per_minute": int(os.getenv("CHATBOT_EMBEDDING_TPM", 120000)),
+}
+
+# Processes used to parse documents during ingestion (None = one per CPU core)
+CHATBOT_INGEST_PARSE_WORKERS = int(os.getenv("CHATBOT_INGEST_PARSE_WORKERS", 0)) or None
+
+# Vector search engine: "chroma" (PersistentClient) or "snapshot" (memory-mapped
+# NumPy export written by ingest_documents, falls back to chroma if missing)
+CHATBOT_RETRIEVAL_ENGINE = os.getenv("CHATBOT_RETRIEVAL_ENGINE", "chroma")
+
+# Prompt token budgets for the retrieved context and the chat history
+CHATBOT_PROMPT_BUDGET = {
+    "context_tokens": int(os.getenv("CHATBOT_CONTEXT_TOKENS", 1200)),
+    "history_tokens": int(os.getenv("CHATBOT_HISTORY_TOKENS", 400)),
+}
+
+# Write-behind pool persisting chat histories to the session store; failed saves are
+# retried max_retries times with backoff (seconds) before being dropped
+CHATBOT_HISTORY_WRITER = {
+    "workers": int(os.getenv("CHATBOT_HISTORY_WRITERS", 2)),
+    "batch_size": 50,
+    "flush_interval": 0.05,
+    "max_retries": 5,
+    "backoff_base": 0.5,
+    "backoff_max": 10,
+}
+
+# Directory where each worker process writes its metrics, so that /metrics reports the
+# totals of all workers on the host (empty it when the service is redeployed). Unset,
+# every series is labelled with the worker's pid and each worker must be scraped.
+CHATBOT_METRICS_DIR = os.getenv("CHATBOT_METRICS_DIR") or None
+
+# Warnings and errors of the chatbot app's background workers go to the console
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {"chatbot": {"handlers": ["console"], "level": os.getenv("CHATBOT_LOG_LEVEL", "WARNING")}},
+}
+
+# In-process chat history cache: lock stripes, session cap (LRU) and sweeper period
+CHATBOT_SESSION_CACHE = {
+    "shards": 16,
+    "max_entries": int(os.getenv("CHATBOT_SESSION_CACHE_ENTRIES", 50000)),
+    "sweep_interval": 30,
+}
+
+# Uploads above this size are spooled to a temporary file instead of held in memory
+FILE_UPLOAD_MAX_MEMORY_SIZE = int(os.getenv("CHATBOT_UPLOAD_SPOOL_BYTES", 1024 * 1024))
+
+# Threads preprocessing uploaded images (decode, downscale, re-encode)
+CHATBOT_IMAGE_WORKERS = int(os.getenv("CHATBOT_IMAGE_WORKERS", 2))
+
+# Request coalescing: concurrent identical cache misses wait for one completion; with
+# shared, workers coordinate through the chatbot cache as well. The wait ("timeout") and
+# the lock's lifetime ("lock_timeout") default to the CHATBOT_LLM deadline with retries.
+CHATBOT_SINGLE_FLIGHT = {
+    "shared": os.getenv("CHATBOT_SINGLE_FLIGHT_SHARED", "True").lower() in ("1", "true", "yes"),
+    "alias": CHATBOT_CACHE_ALIAS,
+}
+
+# Threads overlapping the stages of a request (retrieval, history, ...); with
+# CHATBOT_STAGE_TRACE each request's stage timeline is printed
+CHATBOT_STAGE_WORKERS = int(os.getenv("CHATBOT_STAGE_WORKERS", 8))
+CHATBOT_STAGE_TRACE = os.getenv("CHATBOT_STAGE_TRACE", "False").lower() in ("1", "true", "yes")
+
+# HTTP connection pool of the Azure OpenAI clients (HTTP/2 needs the h2 package)
+CHATBOT_HTTP = {
+    "max_connections": int(os.getenv("CHATBOT_HTTP_MAX_CONNECTIONS", 100)),
+    "max_keepalive_connections": int(os.getenv("CHATBOT_HTTP_KEEPALIVE_CONNECTIONS", 20)),
+    "keepalive_expiry": 60,
+    "connect_timeout": float(os.getenv("CHATBOT_HTTP_CONNECT_TIMEOUT", 5)),
+    "read_timeout": float(os.getenv("CHATBOT_HTTP_READ_TIMEOUT", 60)),
+    "http2": os.getenv("CHATBOT_HTTP2", "True").lower() in ("1", "true", "yes"),
+}
+
+# Build clients, connect to Azure and load the vector index when goodwish_chatbot.wsgi or
+# goodwish_chatbot.asgi is loaded (server processes only, not scripts or management commands)
+CHATBOT_WARM_UP = os.getenv("CHATBOT_WARM_UP", "True").lower() in ("1", "true", "yes")
+
+# Completion calls: deadline per attempt, retries of 429/5xx and the circuit breaker.
+# With CHATBOT_LLM_HEDGE_DELAY set, a request still unanswered after that many seconds
+# is repeated on the next deployment of CHATBOT_LLM_DEPLOYMENTS (comma-separated).
+CHATBOT_LLM = {
+    "deployments": [
+        name.strip()
+        for name in os.getenv("CHATBOT_LLM_DEPLOYMENTS", os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "")).split(",")
+        if name.strip()
+    ],
+    "attempt_timeout": float(os.getenv("CHATBOT_LLM_ATTEMPT_TIMEOUT", 20)),
+    "max_retries": int(os.getenv("CHATBOT_LLM_MAX_RETRIES", 2)),
+    "hedge_delay": float(os.environ["CHATBOT_LLM_HEDGE_DELAY"]) if os.getenv("CHATBOT_LLM_HEDGE_DELAY") else None,
+    "failure_threshold": int(os.getenv("CHATBOT_LLM_FAILURE_THRESHOLD", 5)),
+    "reset_timeout": float(os.getenv("CHATBOT_LLM_RESET_TIMEOUT", 30)),
+}
+
+CHATBOT_SEMANTIC_CACHE_ENABLED = os.getenv("CHATBOT_SEMANTIC_CACHE_ENABLED", "True").lower() in ("1", "true", "yes")
+
 CORS_ALLOW_ALL_ORIGINS = True
\ No newline at end of file
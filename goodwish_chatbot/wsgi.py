@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'goodwish_chatbot.settings')
 
 application = get_wsgi_application()
+
+# Pay the client, connection and index start-up costs before the first request
+if settings.CHATBOT_WARM_UP:
+    from chatbot.chatbot_rag import warm_up
+    warm_up()